@@ -0,0 +1,128 @@
+"""This file sends concurrent requests to a running classification service
+(python -m src.components.service) and reports throughput and latency on
+the client side together with the batch sizes reported by the service.
+
+python -m src.analysis.service.load_benchmark --url http://127.0.0.1:8080 \
+    --concurrency 32 --requests 2000
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Dict, List
+
+import httpx
+import numpy as np
+from tomark import Tomark
+
+TITLES = [
+    "Haushaltsplan",
+    "Bebauungspläne",
+    "Wahlergebnisse Kommunalwahl 2020",
+    "Standorte der öffentlichen Toiletten",
+    "Haltestellen des ÖPNV",
+    "Kindertagesstätten",
+    "Grillplätze im Stadtgebiet",
+    "Parkhäuser mit aktueller Belegung",
+    "Einwohner nach Stadtteilen und Altersgruppen",
+    "Baumkataster",
+]
+
+
+async def _client(
+    client: httpx.AsyncClient,
+    url: str,
+    n_requests: int,
+    titles_per_request: int,
+    latencies: List[float],
+    errors: List[int],
+) -> None:
+    for _ in range(n_requests):
+        titles = random.choices(TITLES, k=titles_per_request)
+        start = time.perf_counter()
+        try:
+            response = await client.post(f"{url}/predict", json={"titles": titles})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors.append(1)
+
+
+async def run_load_test(
+    url: str, concurrency: int, n_requests: int, titles_per_request: int
+) -> Dict:
+    """sends n_requests from concurrency parallel clients
+
+    Parameters
+    ----------
+    url : str
+        base url of the service
+    concurrency : int
+        number of parallel clients
+    n_requests : int
+        total number of requests
+    titles_per_request : int
+        titles in each request
+
+    Returns
+    -------
+    Dict
+        client side results and the metrics of the service
+    """
+    latencies: List[float] = []
+    errors: List[int] = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[
+                _client(
+                    client,
+                    url,
+                    n_requests // concurrency,
+                    titles_per_request,
+                    latencies,
+                    errors,
+                )
+                for _ in range(concurrency)
+            ]
+        )
+        duration = time.perf_counter() - start
+        metrics = (await client.get(f"{url}/metrics")).json()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "***concurrency***": concurrency,
+        "***requests***": len(latencies) + len(errors),
+        "***errors***": len(errors),
+        "***requests per second***": round(len(latencies) / duration, 1),
+        "***titles per second***": round(
+            len(latencies) * titles_per_request / duration, 1
+        ),
+        "***p50 (ms)***": round(float(np.percentile(latencies_ms, 50)), 2),
+        "***p95 (ms)***": round(float(np.percentile(latencies_ms, 95)), 2),
+        "***p99 (ms)***": round(float(np.percentile(latencies_ms, 99)), 2),
+        "***mean batch size (service)***": metrics["mean_batch_size"],
+    }
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(
+        description="Load test of the classification service"
+    )
+    argument_parser.add_argument("--url", default="http://127.0.0.1:8080")
+    argument_parser.add_argument("--concurrency", type=int, default=32)
+    argument_parser.add_argument("--requests", type=int, default=2000)
+    argument_parser.add_argument("--titles-per-request", type=int, default=1)
+    args = argument_parser.parse_args()
+
+    report = asyncio.run(
+        run_load_test(
+            url=args.url,
+            concurrency=args.concurrency,
+            n_requests=args.requests,
+            titles_per_request=args.titles_per_request,
+        )
+    )
+    print(Tomark.table([report]))
@@ -0,0 +1,110 @@
+"""This file compares the torch and ONNX Runtime backends of BertSim on the
+test split: cosine similarity of the embeddings with torch, agreement of the
+predictions, latency of single titles and throughput of batches on CPU.
+The onnx models are exported with
+python -m src.components.onnx_backend \
+    --output models/musterdatenkatalog_clf_onnx --quantize
+"""
+
+import time
+from typing import Dict, List
+
+import numpy as np
+import torch
+from datasets import load_dataset
+from tomark import Tomark
+
+from src.analysis.training.evaluate import MODEL_PATH, create_corpus
+from src.components.bert_sim import CORPUS_EMBEDDINGS_CACHE, BertSim
+from src.settings import Settings
+from src.utils.data import load_json
+
+settings = Settings(_env_file="paths/.env.dev")
+
+ONNX_MODEL_PATH = "models/musterdatenkatalog_clf_onnx"
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+BATCH_SIZE = 64
+LATENCY_SAMPLES = 200
+
+
+def report_backend(
+    backend: str,
+    texts: List[str],
+    corpus: List[str],
+    reference: torch.Tensor,
+    reference_predictions: List[str],
+) -> Dict:
+    """equivalence and speed of one backend
+
+    Parameters
+    ----------
+    backend : str
+        backend of BertSim
+    texts : List[str]
+        titles of the test split
+    corpus : List[str]
+        labels of the taxonomy
+    reference : torch.Tensor
+        normalized torch embeddings of the titles
+    reference_predictions : List[str]
+        predictions of the torch backend
+
+    Returns
+    -------
+    Dict
+        row of the report
+    """
+    bert_sim = BertSim(
+        model=MODEL_PATH if backend == "torch" else ONNX_MODEL_PATH,
+        corpus=corpus,
+        embedding_cache_dir=CORPUS_EMBEDDINGS_CACHE,
+        backend=backend,
+    )
+    latencies = []
+    for text in texts[:LATENCY_SAMPLES]:
+        start = time.perf_counter()
+        bert_sim._encode([text], batch_size=1)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    embeddings = bert_sim._encode(texts, batch_size=BATCH_SIZE)
+    duration = time.perf_counter() - start
+    predictions = [el["prediction"] for el in bert_sim.predict(texts, BATCH_SIZE)]
+    cosine = (embeddings.float() * reference).sum(dim=1)
+
+    return {
+        "***backend***": backend,
+        "***min cosine with torch***": round(cosine.min().item(), 5),
+        "***agreement with torch***": round(
+            np.mean([p == r for p, r in zip(predictions, reference_predictions)]), 4
+        ),
+        "***p50 latency (ms)***": round(np.percentile(latencies, 50) * 1000, 2),
+        "***p95 latency (ms)***": round(np.percentile(latencies, 95) * 1000, 2),
+        "***titles per second***": round(len(texts) / duration, 1),
+    }
+
+
+if __name__ == "__main__":
+    texts = list(
+        load_dataset(
+            "and-effect/mdk_gov_data_titles_clf",
+            data_dir="large",
+            use_auth_token=True,
+            revision="172e61bb1dd20e43903f4c51e5cbec61ec9ae6e6",  # pragma: allowlist secret
+        )["test"].to_pandas()["title"]
+    )
+    corpus = create_corpus(taxonomy=load_json(path=str(settings.TAXONOMY_PROCESSED_V3)))
+
+    torch_bert_sim = BertSim(
+        model=MODEL_PATH, corpus=corpus, embedding_cache_dir=CORPUS_EMBEDDINGS_CACHE
+    )
+    reference = torch_bert_sim._encode(texts, batch_size=BATCH_SIZE).float()
+    reference_predictions = [
+        el["prediction"] for el in torch_bert_sim.predict(texts, BATCH_SIZE)
+    ]
+
+    report = [
+        report_backend(backend, texts, corpus, reference, reference_predictions)
+        for backend in BACKENDS
+    ]
+    print(Tomark.table(report))
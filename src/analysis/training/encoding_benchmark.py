@@ -0,0 +1,101 @@
+"""This file compares the throughput of encoding GovData titles on CPU in
+input order, with the length sorting of SentenceTransformer.encode and with
+token budget batches from src.components.batching"""
+
+import time
+from typing import Callable, Dict, List
+
+import torch
+from datasets import load_dataset
+from sentence_transformers import SentenceTransformer
+from tomark import Tomark
+
+from src.analysis.training.evaluate import MODEL_PATH
+from src.components.batching import encode_bucketed
+from src.utils.data import chunks
+
+BATCH_SIZE = 32
+TOKEN_BUDGETS = [2048, 8192]
+REPEATS = 3
+
+
+def encode_input_order(model: SentenceTransformer, texts: List[str]) -> torch.Tensor:
+    """fixed size batches in input order, every batch is padded to its
+    longest title"""
+    return torch.cat(
+        [
+            model.encode(
+                batch,
+                batch_size=BATCH_SIZE,
+                convert_to_tensor=True,
+                show_progress_bar=False,
+            )
+            for batch in chunks(texts, BATCH_SIZE)
+        ]
+    )
+
+
+def benchmark(
+    name: str, encode: Callable[[List[str]], torch.Tensor], texts: List[str]
+) -> Dict:
+    """best of REPEATS runs
+
+    Parameters
+    ----------
+    name : str
+        name of the batching strategy
+    encode : Callable[[List[str]], torch.Tensor]
+        encodes a list of texts
+    texts : List[str]
+        titles to encode
+
+    Returns
+    -------
+    Dict
+        row of the report
+    """
+    durations = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        encode(texts)
+        durations.append(time.perf_counter() - start)
+    return {
+        "***batching***": name,
+        "***seconds***": round(min(durations), 2),
+        "***titles per second***": round(len(texts) / min(durations), 1),
+    }
+
+
+if __name__ == "__main__":
+    texts = list(
+        load_dataset(
+            "and-effect/mdk_gov_data_titles_clf",
+            data_dir="large",
+            use_auth_token=True,
+            revision="172e61bb1dd20e43903f4c51e5cbec61ec9ae6e6",  # pragma: allowlist secret
+        )["test"].to_pandas()["title"]
+    )
+    model = SentenceTransformer(MODEL_PATH, device="cpu")
+
+    report = [
+        benchmark("input order", lambda x: encode_input_order(model, x), texts),
+        benchmark(
+            "length sorted (encode)",
+            lambda x: model.encode(
+                x,
+                batch_size=BATCH_SIZE,
+                convert_to_tensor=True,
+                show_progress_bar=False,
+            ),
+            texts,
+        ),
+    ]
+    for token_budget in TOKEN_BUDGETS:
+        report.append(
+            benchmark(
+                f"token budget {token_budget}",
+                lambda x: encode_bucketed(model, x, max_tokens=token_budget),
+                texts,
+            )
+        )
+    print(Tomark.table(report))
@@ -10,7 +10,7 @@ from dotenv import load_dotenv
 from huggingface_hub import EvalResult, ModelCard, ModelCardData
 from tomark import Tomark
 
-from src.components.bert_sim import BertSim
+from src.components.bert_sim import CORPUS_EMBEDDINGS_CACHE, BertSim, split_label
 from src.settings import Settings
 from src.utils.data import load_json
 import os
@@ -21,6 +21,8 @@ MODEL_PATH = "and-effect/musterdatenkatalog_clf"
 CORPUS_PATH = settings.TAXONOMY_PROCESSED_V3
 
 EXCLUDE_LABELS = 2
+# query embeddings of the test titles, reused by repeated predictions and runs
+QUERY_CACHE = "extraction/query_embeddings.sqlite"
 
 dotenv_path = ".env"
 load_dotenv(dotenv_path)
@@ -206,7 +208,12 @@ if __name__ == "__main__":
     labels = list(current_data_corrected["labels_name"])
 
     # Load Model
-    bert_sim = BertSim(model=MODEL_PATH, corpus=corpus)
+    bert_sim = BertSim(
+        model=MODEL_PATH,
+        corpus=corpus,
+        embedding_cache_dir=CORPUS_EMBEDDINGS_CACHE,
+        query_cache_path=QUERY_CACHE,
+    )
 
     # Evaluation Bezeichnung Level
     print("***Evaluation of test data***")
@@ -249,10 +256,8 @@ if __name__ == "__main__":
 
     # Evaluation Thema Level
     print("Result on Level 'Thema'")
-    predictions_thema = [
-        prediction.split("-")[0].rstrip() for prediction in predictions
-    ]
-    y_true_thema = [el.split("-")[0].rstrip() for el in labels]
+    predictions_thema = [doc["thema"] for doc in predicted_docs]
+    y_true_thema = [split_label(el)[0] for el in labels]
     report = bert_sim.classification_report_macro(predictions_thema, y_true_thema)
 
     eval_results_args.append(
@@ -321,10 +326,8 @@ if __name__ == "__main__":
 
     # Evaluation Thema Level validation
     print("Result on Level 'Thema'")
-    predictions_thema = [
-        prediction.split("-")[0].rstrip() for prediction in predictions
-    ]
-    y_true_thema = [el.split("-")[0].rstrip() for el in labels]
+    predictions_thema = [doc["thema"] for doc in predicted_docs]
+    y_true_thema = [split_label(el)[0] for el in labels]
     report = bert_sim.classification_report_macro(predictions_thema, y_true_thema)
     print(report)
 
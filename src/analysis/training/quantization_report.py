@@ -0,0 +1,118 @@
+"""This file compares the float16 and int8 embedding index of BertSim with the
+float32 baseline on the test split. Reported are accuracy, agreement with the
+float32 predictions, memory of the corpus embeddings and scoring time"""
+
+import time
+from typing import Dict, List, Union
+
+import pandas as pd
+import torch
+from datasets import load_dataset
+from tomark import Tomark
+
+from src.analysis.training.evaluate import MODEL_PATH, correct_data, create_corpus
+from src.components.bert_sim import CORPUS_EMBEDDINGS_CACHE, BertSim
+from src.components.embedding_index import INDEX_DTYPES, QuantizedIndex
+from src.settings import Settings
+from src.utils.data import load_json
+
+settings = Settings(_env_file="paths/.env.dev")
+
+REPEATS = 20
+
+
+def score_index(
+    query_embeddings: torch.Tensor,
+    corpus_embeddings: torch.Tensor,
+    index: Union[QuantizedIndex, None],
+) -> torch.Tensor:
+    if index is None:
+        return query_embeddings @ corpus_embeddings.T
+    return index.scores(query_embeddings)
+
+
+def report_index(
+    dtype: str,
+    query_embeddings: torch.Tensor,
+    bert_sim: BertSim,
+    labels: List,
+    baseline: torch.Tensor,
+) -> Dict:
+    """accuracy and speed of one index
+
+    Parameters
+    ----------
+    dtype : str
+        float32 for the baseline, float16 or int8
+    query_embeddings : torch.Tensor
+        normalized embeddings of the test titles
+    bert_sim : BertSim
+        classifier with the float32 corpus embeddings
+    labels : List
+        true labels of the test titles
+    baseline : torch.Tensor
+        predicted corpus ids of the float32 baseline
+
+    Returns
+    -------
+    Dict
+        row of the report
+    """
+    corpus_embeddings = bert_sim.corpus_embeddings.float()
+    index = None
+    nbytes = corpus_embeddings.element_size() * corpus_embeddings.nelement()
+    if dtype != "float32":
+        index = QuantizedIndex.from_embeddings(corpus_embeddings, dtype=dtype)
+        nbytes = index.nbytes
+
+    durations = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        scores = score_index(query_embeddings, corpus_embeddings, index)
+        durations.append(time.perf_counter() - start)
+    predicted_ids = scores.argmax(dim=1)
+    predictions = [bert_sim.corpus[idx] for idx in predicted_ids.tolist()]
+
+    return {
+        "***index***": dtype,
+        "***accuracy***": round(
+            sum(p == t for p, t in zip(predictions, labels)) / len(labels), 4
+        ),
+        "***agreement with float32***": round(
+            (predicted_ids == baseline).float().mean().item(), 4
+        ),
+        "***corpus embeddings (KiB)***": round(nbytes / 1024, 1),
+        "***scoring per 1000 titles (ms)***": round(
+            sorted(durations)[len(durations) // 2] / len(labels) * 1e6, 3
+        ),
+    }
+
+
+if __name__ == "__main__":
+    test_data = load_dataset(
+        "and-effect/mdk_gov_data_titles_clf",
+        data_dir="large",
+        use_auth_token=True,
+        revision="172e61bb1dd20e43903f4c51e5cbec61ec9ae6e6",  # pragma: allowlist secret
+    )["test"].to_pandas()
+    mapper_v3_v4_data = pd.read_excel(
+        f"{settings.BASE_PATH_ANNOTATIONS}/mapper/2023_02_21_v3_v4_mapper.xlsx"
+    )
+    test_data = correct_data(
+        test_data, dict(zip(mapper_v3_v4_data.old, mapper_v3_v4_data.new))
+    )
+    test_data = test_data[test_data["labels_name"] != "Sonstiges - Sonstiges"]
+
+    corpus = create_corpus(taxonomy=load_json(path=str(settings.TAXONOMY_PROCESSED_V3)))
+    bert_sim = BertSim(
+        model=MODEL_PATH, corpus=corpus, embedding_cache_dir=CORPUS_EMBEDDINGS_CACHE
+    )
+    query_embeddings = bert_sim._encode(list(test_data["title"]), batch_size=64)
+    labels = list(test_data["labels_name"])
+    baseline = (query_embeddings @ bert_sim.corpus_embeddings.float().T).argmax(dim=1)
+
+    report = [
+        report_index(dtype, query_embeddings.float(), bert_sim, labels, baseline)
+        for dtype in ["float32"] + INDEX_DTYPES
+    ]
+    print(Tomark.table(report))
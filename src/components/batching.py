@@ -0,0 +1,121 @@
+"""Pipeline component: length-bucketed batching for the sentence transformer
+of bert_sim.py. Texts are sorted by token length and grouped into batches
+with a bounded number of padded tokens, so many short titles are encoded
+together and long titles do not pad a whole batch"""
+
+from typing import List
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+
+def token_lengths(model: SentenceTransformer, texts: List[str]) -> List[int]:
+    """number of tokens of each text including special tokens, truncated to
+    the max_seq_length of the model
+
+    Parameters
+    ----------
+    model : SentenceTransformer
+        model with the tokenizer
+    texts : List[str]
+        texts to encode
+
+    Returns
+    -------
+    List[int]
+        token length by text
+    """
+    encodings = model.tokenizer(
+        texts,
+        truncation=True,
+        max_length=model.max_seq_length,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return [len(input_ids) for input_ids in encodings["input_ids"]]
+
+
+def token_budget_batches(
+    lengths: List[int], max_tokens: int, max_batch_size: int = 256
+) -> List[List[int]]:
+    """groups texts by descending token length into batches whose padded
+    size (number of texts times longest text) stays within max_tokens
+
+    Parameters
+    ----------
+    lengths : List[int]
+        token length by text
+    max_tokens : int
+        maximum number of padded tokens per batch, a single longer text
+        still gets its own batch
+    max_batch_size : int, optional
+        maximum number of texts per batch, by default 256
+
+    Returns
+    -------
+    List[List[int]]
+        indices of the texts in each batch
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: -lengths[idx])
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    for idx in order:
+        # the first text of a batch is the longest one
+        if batch and (
+            (len(batch) + 1) * lengths[batch[0]] > max_tokens
+            or len(batch) >= max_batch_size
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode_bucketed(
+    model: SentenceTransformer,
+    texts: List[str],
+    max_tokens: int = 8192,
+    max_batch_size: int = 256,
+) -> torch.Tensor:
+    """encodes texts in token budget batches and returns the embeddings in
+    the original order
+
+    Parameters
+    ----------
+    model : SentenceTransformer
+        model to encode with
+    texts : List[str]
+        texts to encode
+    max_tokens : int, optional
+        maximum number of padded tokens per batch, by default 8192
+    max_batch_size : int, optional
+        maximum number of texts per batch, by default 256
+
+    Returns
+    -------
+    torch.Tensor
+        one embedding per text
+    """
+    batches = token_budget_batches(
+        token_lengths(model, texts),
+        max_tokens=max_tokens,
+        max_batch_size=max_batch_size,
+    )
+    embeddings = None
+    for batch in batches:
+        batch_embeddings = model.encode(
+            [texts[idx] for idx in batch],
+            batch_size=len(batch),
+            convert_to_tensor=True,
+            show_progress_bar=False,
+        )
+        if embeddings is None:
+            embeddings = batch_embeddings.new_empty(
+                (len(texts), batch_embeddings.shape[1])
+            )
+        embeddings[torch.tensor(batch)] = batch_embeddings
+    if embeddings is None:
+        return torch.empty((0, model.get_sentence_embedding_dimension()))
+    return embeddings
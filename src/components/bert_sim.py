@@ -2,60 +2,565 @@
 of parsed data from parser.py.
 Provides also evaluation measurements"""
 
-from typing import Dict, List
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer, util
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
 
+from src.components.batching import encode_bucketed
+from src.components.embedding_index import QuantizedIndex
+from src.components.onnx_backend import ONNX_FILE, ONNX_QUANTIZED_FILE, OnnxEncoder
+from src.components.prediction_memo import PredictionMemo
+from src.components.query_cache import QueryEmbeddingCache
+from src.utils.data import chunks
+
+CORPUS_EMBEDDINGS_CACHE = "extraction/corpus_embeddings"
+# encoded together with the key, so a changed model without new revision
+# does not reuse the embeddings of the old weights
+FINGERPRINT_SENTENCE = "Musterdatenkatalog"
+# onnx backends expect the folder written by src.components.onnx_backend
+ONNX_BACKENDS = {"onnx": ONNX_FILE, "onnx-int8": ONNX_QUANTIZED_FILE}
+
+
+def load_encoder(
+    model: str, backend: str = "torch"
+) -> Union[SentenceTransformer, OnnxEncoder]:
+    """sentence encoder of the model for the backend
+
+    Parameters
+    ----------
+    model : str
+        model name or path, the onnx folder for the onnx backends
+    backend : str, optional
+        torch or one of ONNX_BACKENDS, by default "torch"
+
+    Returns
+    -------
+    Union[SentenceTransformer, OnnxEncoder]
+        encoder with an encode method
+    """
+    if backend == "torch":
+        return SentenceTransformer(model_name_or_path=model)
+    if backend in ONNX_BACKENDS:
+        return OnnxEncoder(model, file_name=ONNX_BACKENDS[backend])
+    raise ValueError(
+        f"unknown backend {backend}, expected torch or one of {list(ONNX_BACKENDS)}"  # noqa: E501
+    )
+
+
+def model_fingerprint(encoder: Union[SentenceTransformer, OnnxEncoder]) -> bytes:
+    """rounded embedding of FINGERPRINT_SENTENCE, changes with the weights"""
+    fingerprint = encoder.encode(FINGERPRINT_SENTENCE)
+    return np.round(fingerprint, 4).astype(np.float32).tobytes()
+
+
+def normalize_query(query: str) -> str:
+    """unicode NFC and collapsed whitespace, titles which only differ in
+    these are predicted once"""
+    return " ".join(unicodedata.normalize("NFC", str(query)).split())
+
+
+def split_label(label: str) -> Tuple[str, str]:
+    """splits a corpus label "Thema - Bezeichnung" into its two levels
+
+    Parameters
+    ----------
+    label : str
+        label of the corpus
+
+    Returns
+    -------
+    Tuple[str, str]
+        thema and bezeichnung
+    """
+    thema, _, bezeichnung = label.partition(" - ")
+    return thema.strip(), bezeichnung.strip()
+
 
 class BertSim:
     """Cosine Similarity based Text Classification"""
 
-    def __init__(self, model: SentenceTransformer, corpus: List) -> None:
-        self.model = SentenceTransformer(model_name_or_path=model)
+    def __init__(
+        self,
+        model: SentenceTransformer,
+        corpus: List,
+        revision: Union[str, None] = None,
+        embedding_cache_dir: Union[str, None] = None,
+        memo_size: int = 0,
+        memo_path: Union[str, None] = None,
+        index_dtype: Union[str, None] = None,
+        token_budget: Union[int, None] = None,
+        corpus_embeddings_path: Union[str, None] = None,
+        n_workers: int = 0,
+        threads_per_worker: Union[int, None] = None,
+        backend: str = "torch",
+        query_cache_size: int = 0,
+        query_cache_path: Union[str, None] = None,
+        encoder: Union[SentenceTransformer, OnnxEncoder, None] = None,
+    ) -> None:
+        self.model_name = str(model)
+        self.backend = backend
+        # an encoder loaded by the caller, e.g. for the model fingerprint,
+        # is not loaded a second time
+        self.model = encoder if encoder is not None else load_encoder(model, backend)
         self.corpus: List = corpus
-        self.corpus_embeddings: torch.Tensor
+        self.revision = revision
+        self.embedding_cache_dir = embedding_cache_dir
+        self.token_budget = token_budget
+        self.corpus_embeddings_path = corpus_embeddings_path
+        self.corpus_embeddings: Union[torch.Tensor, None]
         self._load_corpus()
+        self.device = self.corpus_embeddings.device
+        self._load_groups()
+        self.index_dtype = index_dtype
+        self.index: Union[QuantizedIndex, None] = None
+        if index_dtype is not None:
+            self.index = QuantizedIndex.from_embeddings(
+                self.corpus_embeddings, dtype=index_dtype
+            )
+        self.prediction_memo: Union[PredictionMemo, None] = None
+        if memo_size > 0 or memo_path is not None:
+            self.prediction_memo = PredictionMemo(
+                version=f"{self.corpus_cache_key()}-{index_dtype or 'float32'}",
+                path=memo_path,
+                max_size=memo_size or 100_000,
+            )
+        self.query_cache: Union[QueryEmbeddingCache, None] = None
+        if query_cache_size > 0 or query_cache_path is not None:
+            self.query_cache = QueryEmbeddingCache(
+                version=self.model_cache_key(),
+                path=query_cache_path,
+                max_size=query_cache_size or 100_000,
+            )
+        self.pool: Union[ProcessPoolExecutor, None] = None
+        self.n_workers = 0
+        # seconds spent in encoding and label search, summed over the workers
+        self.timings = {"encode": 0.0, "search": 0.0}
+        self._pool_dir: Union[str, None] = None
+        if n_workers > 0:
+            self.start_pool(n_workers, threads_per_worker=threads_per_worker)
+        if self.index is not None:
+            # the index replaces the float32 embeddings, keeping both would
+            # raise the memory instead of lowering it
+            self.corpus_embeddings = None
+
+    def __enter__(self) -> "BertSim":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
 
     def _load_corpus(self) -> None:
-        """loads the corpus and embeds it"""
-        self.corpus_embeddings = self.model.encode(self.corpus, convert_to_tensor=True)
-        self.corpus_embeddings = util.normalize_embeddings(self.corpus_embeddings)
+        """loads the corpus and embeds it. With an embedding cache folder the
+        normalized embeddings are stored as npy file and memory mapped on the
+        next start instead of encoding the corpus again"""
+        if self.corpus_embeddings_path is None and self.embedding_cache_dir is not None:
+            cache_path = os.path.join(
+                self.embedding_cache_dir, f"{self.corpus_cache_key()}.npy"
+            )
+            if not os.path.isfile(cache_path):
+                self.corpus_embeddings = self._encode_corpus()
+                self._save_corpus_embeddings(cache_path)
+            self.corpus_embeddings_path = cache_path
+        if self.corpus_embeddings_path is None:
+            self.corpus_embeddings = self._encode_corpus()
+            return
+        # copy-on-write mapping, torch shares the memory without a copy
+        self.corpus_embeddings = torch.from_numpy(
+            np.load(self.corpus_embeddings_path, mmap_mode="c")
+        )
+
+    def _save_corpus_embeddings(self, path: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, self.corpus_embeddings.cpu().numpy())
+        os.replace(tmp_path, path)
+
+    def _load_groups(self) -> None:
+        """group of every label and the normalized mean embedding of each
+        group, used by the hierarchical prediction"""
+        themen = [split_label(label)[0] for label in self.corpus]
+        self.groups: List = list(dict.fromkeys(themen))
+        group_ids = {group: idx for idx, group in enumerate(self.groups)}
+        self.label_groups = torch.tensor([group_ids[thema] for thema in themen])
+        self.group_embeddings = util.normalize_embeddings(
+            torch.stack(
+                [
+                    self.corpus_embeddings[self.label_groups == idx].float().mean(0)
+                    for idx in range(len(self.groups))
+                ]
+            )
+        )
+
+    def _encode_corpus(self) -> torch.Tensor:
+        if self.token_budget is not None:
+            corpus_embeddings = encode_bucketed(
+                self.model, self.corpus, max_tokens=self.token_budget
+            )
+        else:
+            corpus_embeddings = self.model.encode(self.corpus, convert_to_tensor=True)
+        return util.normalize_embeddings(corpus_embeddings)
+
+    def corpus_cache_key(self) -> str:
+        """key of the cached corpus embeddings, changes with the model name,
+        the model revision, the model weights and the corpus strings
+
+        Returns
+        -------
+        str
+            hex digest of the cache key
+        """
+        key = hashlib.sha1(
+            json.dumps([self.model_name, self.revision, self.corpus]).encode("utf-8")
+        )
+        key.update(self._fingerprint())
+        return key.hexdigest()
+
+    def model_cache_key(self) -> str:
+        """key of the cached query embeddings, changes with the model name,
+        the model revision, the backend and the model weights
 
-    def predict(self, queries: List) -> List[Dict]:
-        """predict for an input sentence based a label of the corpus
+        Returns
+        -------
+        str
+            hex digest of the cache key
+        """
+        key = hashlib.sha1(
+            json.dumps([self.model_name, self.revision, self.backend]).encode("utf-8")
+        )
+        key.update(self._fingerprint())
+        return key.hexdigest()
+
+    def _fingerprint(self) -> bytes:
+        return model_fingerprint(self.model)
+
+    def start_pool(
+        self, n_workers: int, threads_per_worker: Union[int, None] = None
+    ) -> None:
+        """starts encoder worker processes, predict then shards the queries
+        across them. Every worker loads the model and memory maps the corpus
+        embeddings from the same npy file
+
+        Parameters
+        ----------
+        n_workers : int
+            number of worker processes
+        threads_per_worker : Union[int, None], optional
+            torch threads of each worker, by default the cores divided by
+            the number of workers
+        """
+        if self.corpus_embeddings_path is None:
+            if self.corpus_embeddings is None:
+                raise ValueError(
+                    "the float32 embeddings of a quantized index are dropped, pass n_workers to the constructor or set corpus_embeddings_path"  # noqa: E501
+                )
+            self._pool_dir = tempfile.mkdtemp(prefix="bert_sim_")
+            self.corpus_embeddings_path = os.path.join(
+                self._pool_dir, "corpus_embeddings.npy"
+            )
+            self._save_corpus_embeddings(self.corpus_embeddings_path)
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+        worker_kwargs = {
+            "model": self.model_name,
+            "backend": self.backend,
+            "corpus": self.corpus,
+            "index_dtype": self.index_dtype,
+            "token_budget": self.token_budget,
+            "corpus_embeddings_path": self.corpus_embeddings_path,
+        }
+        self.n_workers = n_workers
+        # torch is not fork safe once its thread pools are running
+        self.pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(worker_kwargs, threads_per_worker),
+        )
+
+    def close(self) -> None:
+        """stops the worker processes and closes prediction memo and query
+        cache"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self._pool_dir is not None:
+            shutil.rmtree(self._pool_dir, ignore_errors=True)
+            self._pool_dir = None
+        if self.prediction_memo is not None:
+            self.prediction_memo.close()
+        if self.query_cache is not None:
+            self.query_cache.close()
+
+    def predict(self, queries: List, batch_size: int = 32) -> List[Dict]:
+        """predict for an input sentence based a label of the corpus. The
+        queries are normalized and every distinct query is encoded once,
+        queries found in the prediction memo are not encoded at all
 
         Parameters
         ----------
         queries : List
             input query or queries
+        batch_size : int, optional
+            number of queries encoded in one forward pass, by default 32
 
         Returns
         -------
         List[Dict]
-            results with the query text, the predicted label from the corpus
-            and the cosine similarity score
+            results with the query text, the predicted label from the corpus,
+            the cosine similarity score and the margin to the second best
+            label
         """
-        query_embeddings = self.model.encode(
-            sentences=queries, convert_to_tensor=True, show_progress_bar=False
+        normalized_queries = [normalize_query(query) for query in queries]
+        unique_queries = list(dict.fromkeys(normalized_queries))
+        predictions = {}
+        if self.prediction_memo is not None:
+            predictions = self.prediction_memo.get_many(unique_queries)
+        new_queries = [el for el in unique_queries if el not in predictions]
+        if new_queries:
+            new_predictions = self._search(new_queries, batch_size=batch_size)
+            if self.prediction_memo is not None:
+                self.prediction_memo.put_many(new_predictions)
+            predictions.update(new_predictions)
+
+        results = []
+        for query, normalized_query in zip(queries, normalized_queries):
+            label, score, margin = predictions[normalized_query]
+            thema, bezeichnung = split_label(label)
+            results.append(
+                {
+                    "text": query,
+                    "prediction": label,
+                    "thema": thema,
+                    "bezeichnung": bezeichnung,
+                    "score": score,
+                    "margin": margin,
+                }
+            )
+        return results
+
+    def predict_top_k(
+        self,
+        queries: List,
+        k: int = 5,
+        batch_size: int = 32,
+        hierarchical: bool = False,
+        n_groups: int = 2,
+    ) -> List[Dict]:
+        """predicts the k best labels of the corpus for each query. In the
+        hierarchical mode the queries are first compared with the mean
+        embedding of each Thema and then only with the labels of the
+        n_groups best Themen
+
+        Parameters
+        ----------
+        queries : List
+            input query or queries
+        k : int, optional
+            number of candidates per query, by default 5
+        batch_size : int, optional
+            number of queries encoded in one forward pass, by default 32
+        hierarchical : bool, optional
+            score Thema first and Bezeichnung only in the best Themen, by
+            default False
+        n_groups : int, optional
+            number of Themen searched in the hierarchical mode, by default 2
+
+        Returns
+        -------
+        List[Dict]
+            results with the query text, the candidates sorted by score with
+            label, thema, bezeichnung and cosine similarity, and the margin
+            between the two best candidates
+        """
+        normalized_queries = [normalize_query(query) for query in queries]
+        unique_queries = list(dict.fromkeys(normalized_queries))
+        candidates = {}
+        if unique_queries:
+            query_embeddings = self._encode(unique_queries, batch_size=batch_size)
+            if hierarchical:
+                scores = self._hierarchical_scores(query_embeddings, n_groups)
+            else:
+                scores = self._scores(query_embeddings)
+            top_scores, top_ids = torch.topk(scores, k=min(k, len(self.corpus)))
+            for query, query_scores, query_ids in zip(
+                unique_queries, top_scores.tolist(), top_ids.tolist()
+            ):
+                candidates[query] = [
+                    {
+                        "prediction": self.corpus[corpus_id],
+                        "thema": split_label(self.corpus[corpus_id])[0],
+                        "bezeichnung": split_label(self.corpus[corpus_id])[1],
+                        "score": score,
+                    }
+                    for score, corpus_id in zip(query_scores, query_ids)
+                    if score != float("-inf")
+                ]
+
+        results = []
+        for query, normalized_query in zip(queries, normalized_queries):
+            query_candidates = candidates[normalized_query]
+            margin = float("nan")
+            if len(query_candidates) > 1:
+                margin = query_candidates[0]["score"] - query_candidates[1]["score"]
+            results.append(
+                {"text": query, "candidates": query_candidates, "margin": margin}
+            )
+        return results
+
+    def _hierarchical_scores(
+        self, query_embeddings: torch.Tensor, n_groups: int
+    ) -> torch.Tensor:
+        """cosine similarities with the labels of the n_groups best Themen of
+        each query, all other labels get -inf"""
+        group_scores = query_embeddings @ self.group_embeddings.T.to(
+            query_embeddings.dtype
         )
-        query_embeddings = util.normalize_embeddings(query_embeddings)
-        semantic_search_results = util.semantic_search(
-            query_embeddings=query_embeddings,
-            corpus_embeddings=self.corpus_embeddings,
-            top_k=1,
+        best_groups = torch.topk(
+            group_scores, k=min(n_groups, len(self.groups))
+        ).indices
+        scores = torch.full(
+            (len(query_embeddings), len(self.corpus)),
+            float("-inf"),
+            dtype=query_embeddings.dtype,
         )
-        results = [
-            {
-                "text": queries[idx],
-                "prediction": self.corpus[el[0]["corpus_id"]],
-                "score": el[0]["score"],
-            }
-            for idx, el in enumerate(semantic_search_results)
-        ]
+        for group_id in range(len(self.groups)):
+            query_ids = (best_groups == group_id).any(dim=1).nonzero().flatten()
+            if len(query_ids) == 0:
+                continue
+            label_ids = (self.label_groups == group_id).nonzero().flatten()
+            scores[query_ids.unsqueeze(1), label_ids] = self._scores(
+                query_embeddings[query_ids], label_ids=label_ids
+            ).to(scores.dtype)
+        return scores
 
-        return results
+    def _encode(self, queries: List[str], batch_size: int) -> torch.Tensor:
+        """normalized query embeddings, queries in the query cache are neither
+        tokenized nor encoded"""
+        if self.query_cache is None or not queries:
+            return self._encode_queries(queries, batch_size=batch_size)
+        embeddings = self.query_cache.get_many(queries)
+        new_queries = [el for el in dict.fromkeys(queries) if el not in embeddings]
+        if new_queries:
+            new_embeddings = self._encode_queries(new_queries, batch_size=batch_size)
+            new_embeddings = dict(zip(new_queries, new_embeddings.cpu().numpy()))
+            self.query_cache.put_many(new_embeddings)
+            embeddings.update(new_embeddings)
+        return torch.from_numpy(np.stack([embeddings[el] for el in queries])).to(
+            self.device
+        )
+
+    def _encode_queries(self, queries: List[str], batch_size: int) -> torch.Tensor:
+        """encodes and normalizes queries. With a token budget the queries are
+        bucketed by token length and batch_size only caps the batches"""
+        if self.token_budget is not None:
+            return util.normalize_embeddings(
+                encode_bucketed(
+                    self.model,
+                    queries,
+                    max_tokens=self.token_budget,
+                    max_batch_size=batch_size,
+                )
+            )
+        query_embeddings = self.model.encode(
+            sentences=queries,
+            batch_size=batch_size,
+            convert_to_tensor=True,
+            show_progress_bar=False,
+        )
+        return util.normalize_embeddings(query_embeddings)
+
+    def _scores(
+        self, query_embeddings: torch.Tensor, label_ids: torch.Tensor = None
+    ) -> torch.Tensor:
+        """cosine similarities of normalized queries with all labels or the
+        given labels, computed on the quantized index if there is one"""
+        if self.index is not None:
+            return self.index.scores(query_embeddings, label_ids=label_ids)
+        corpus_embeddings = self.corpus_embeddings
+        if label_ids is not None:
+            corpus_embeddings = corpus_embeddings[label_ids]
+        return query_embeddings @ corpus_embeddings.T.to(query_embeddings.dtype)
+
+    def _search(self, queries: List[str], batch_size: int) -> Dict[str, Tuple]:
+        """encodes the queries and searches the closest label of the corpus,
+        in the worker processes if the pool is running. With the pool, queries
+        in the query cache are searched here and only the other queries are
+        sent to the workers, their embeddings are added to the cache"""
+        if self.pool is None:
+            start = time.perf_counter()
+            query_embeddings = self._encode(queries, batch_size=batch_size)
+            self.timings["encode"] += time.perf_counter() - start
+            return self._search_embeddings(queries, query_embeddings)
+
+        embeddings = {}
+        if self.query_cache is not None:
+            embeddings = self.query_cache.get_many(queries)
+        predictions = {}
+        if embeddings:
+            cached_queries = list(embeddings)
+            predictions.update(
+                self._search_embeddings(
+                    cached_queries,
+                    torch.from_numpy(
+                        np.stack([embeddings[el] for el in cached_queries])
+                    ).to(self.device),
+                )
+            )
+        new_queries = [el for el in dict.fromkeys(queries) if el not in embeddings]
+        # one shard per worker, batch_size stays the encode batch size in the
+        # worker, otherwise a call with batch_size queries busies one worker
+        shard_size = max(1, math.ceil(len(new_queries) / self.n_workers))
+        for batch_predictions, batch_embeddings, timings in self.pool.map(
+            _search_batch,
+            chunks(new_queries, shard_size),
+            repeat(batch_size),
+            repeat(self.query_cache is not None),
+        ):
+            predictions.update(batch_predictions)
+            if self.query_cache is not None:
+                self.query_cache.put_many(batch_embeddings)
+            for name, seconds in timings.items():
+                self.timings[name] += seconds
+        return predictions
+
+    def _search_embeddings(
+        self, queries: List[str], query_embeddings: torch.Tensor
+    ) -> Dict[str, Tuple]:
+        """closest label, score and margin to the second best label of
+        normalized query embeddings"""
+        start = time.perf_counter()
+        top_scores, top_ids = torch.topk(
+            self._scores(query_embeddings), k=min(2, len(self.corpus))
+        )
+        margins = torch.full((len(queries),), float("nan"))
+        if top_scores.shape[1] > 1:
+            margins = top_scores[:, 0] - top_scores[:, 1]
+        self.timings["search"] += time.perf_counter() - start
+        return {
+            query: (self.corpus[corpus_id], score, margin)
+            for query, score, corpus_id, margin in zip(
+                queries,
+                top_scores[:, 0].tolist(),
+                top_ids[:, 0].tolist(),
+                margins.tolist(),
+            )
+        }
 
     def classification_report_macro(
         self,
@@ -141,3 +646,34 @@ class BertSim:
             "recall_macro": recall,
             "f1_macro": f1,
         }
+
+
+_worker_bert_sim = None
+
+
+def _init_worker(bert_sim_kwargs, n_threads):
+    """loads the model once per worker process"""
+    global _worker_bert_sim
+    torch.set_num_threads(n_threads)
+    _worker_bert_sim = BertSim(**bert_sim_kwargs)
+
+
+def _search_batch(queries, batch_size, return_embeddings=False):
+    """predictions of a batch of queries in a worker, with the query
+    embeddings for the query cache of the main process if requested"""
+    before = dict(_worker_bert_sim.timings)
+    start = time.perf_counter()
+    query_embeddings = _worker_bert_sim._encode(queries, batch_size=batch_size)
+    _worker_bert_sim.timings["encode"] += time.perf_counter() - start
+    predictions = _worker_bert_sim._search_embeddings(queries, query_embeddings)
+    embeddings = {}
+    if return_embeddings:
+        embeddings = dict(zip(queries, query_embeddings.cpu().numpy()))
+    return (
+        predictions,
+        embeddings,
+        {
+            name: seconds - before[name]
+            for name, seconds in _worker_bert_sim.timings.items()
+        },
+    )
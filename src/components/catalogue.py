@@ -0,0 +1,276 @@
+"""Pipeline component: columnar output of the Musterdatenkatalog. The records
+are streamed once to Parquet in row groups, city, thema and bezeichnung are
+dictionary encoded. Excel and CSV are derived from the Parquet file on
+demand"""
+
+import hashlib
+import math
+import os
+from typing import Dict, Iterable, List, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CATALOGUE_FILE = "musterdatenkatalog.parquet"
+DICTIONARY_COLUMNS = ["city", "thema", "bezeichnung"]
+EXPORTS = ["xlsx", "csv"]
+ROW_GROUP_SIZE = 10_000
+# parquet metadata key of the model, corpus and thresholds of the predictions
+PREDICTION_VERSION = "prediction_version"
+
+
+def _to_string(value) -> Union[str, None]:
+    """the parser marks missing values with nan, they become null"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return str(value)
+
+
+def _to_array(name: str, values: List[Union[str, None]]) -> pa.Array:
+    array = pa.array(values, type=pa.string())
+    if name in DICTIONARY_COLUMNS:
+        return array.dictionary_encode()
+    return array
+
+
+class CatalogueWriter:
+    """writes records to Parquet in row groups, so memory is bounded by the
+    row group size and not by the number of records. The columns are taken
+    from the records of the first row group, all columns are strings. The
+    file is written under a temporary name and replaces an existing catalogue
+    only when it is complete"""
+
+    def __init__(
+        self,
+        path: str,
+        row_group_size: int = ROW_GROUP_SIZE,
+        metadata: Union[Dict[str, str], None] = None,
+    ) -> None:
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.row_group_size = row_group_size
+        self.metadata = metadata or {}
+        self.buffer: List[Dict] = []
+        self.columns: Union[List[str], None] = None
+        self.writer: Union[pq.ParquetWriter, None] = None
+        self.n_records = 0
+
+    def __enter__(self) -> "CatalogueWriter":
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        self.close(commit=exc_type is None)
+
+    def write(self, records: Iterable[Dict]) -> None:
+        for record in records:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.row_group_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self.buffer:
+            return
+        if self.columns is None:
+            self.columns = list(dict.fromkeys(k for el in self.buffer for k in el))
+        unknown = {k for el in self.buffer for k in el} - set(self.columns)
+        if unknown:
+            raise ValueError(f"columns {unknown} are not in the first row group")
+        table = pa.table(
+            {
+                name: _to_array(name, [_to_string(el.get(name)) for el in self.buffer])
+                for name in self.columns
+            }
+        )
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.tmp_path,
+                table.schema.with_metadata(
+                    {**(table.schema.metadata or {}), **self.metadata}
+                ),
+                use_dictionary=[
+                    name for name in DICTIONARY_COLUMNS if name in self.columns
+                ],
+            )
+        self.writer.write_table(table)
+        self.n_records += len(self.buffer)
+        self.buffer = []
+
+    def close(self, commit: bool = True) -> None:
+        if commit:
+            self._flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        elif commit:
+            pq.write_table(
+                pa.table({}).replace_schema_metadata(self.metadata), self.tmp_path
+            )
+        if commit:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_catalogue(
+    records: Iterable[Dict],
+    path: str,
+    row_group_size: int = ROW_GROUP_SIZE,
+    metadata: Union[Dict[str, str], None] = None,
+) -> int:
+    """writes the records as one Parquet file. Columns missing in some records
+    are null there
+
+    Parameters
+    ----------
+    records : Iterable[Dict]
+        enriched records
+    path : str
+        path of the Parquet file
+    row_group_size : int, optional
+        records per row group, by default ROW_GROUP_SIZE
+    metadata : Union[Dict[str, str], None], optional
+        key value metadata of the file, e.g. the prediction version,
+        by default None
+
+    Returns
+    -------
+    int
+        number of written records
+    """
+    with CatalogueWriter(
+        path, row_group_size=row_group_size, metadata=metadata
+    ) as writer:
+        writer.write(records)
+    return writer.n_records
+
+
+def title_hash(title) -> str:
+    """sha1 of the title, missing titles (nan from the parser, null in the
+    catalogue) hash to the same value"""
+    return hashlib.sha1((_to_string(title) or "").encode("utf-8")).hexdigest()
+
+
+def record_key(record: Dict) -> Tuple[Union[str, None], Union[str, None]]:
+    """identifier and url of a record, missing values are None"""
+    return _to_string(record.get("dct:identifier")), _to_string(record.get("url"))
+
+
+def _to_float(value: Union[str, None]) -> float:
+    """scores are stored as strings, missing ones become nan"""
+    return float(value) if value is not None else math.nan
+
+
+def load_previous_predictions(
+    path: str, prediction_version: str
+) -> Dict[Tuple, Tuple[str, str, str, str, str, float, float]]:
+    """predictions of a previous catalogue, if it was classified with the
+    same prediction version
+
+    Parameters
+    ----------
+    path : str
+        path of the previous Parquet file
+    prediction_version : str
+        version of model, corpus and thresholds of the current run
+
+    Returns
+    -------
+    Dict[Tuple, Tuple[str, str, str, str, str, float, float]]
+        title hash, thema, bezeichnung, added date, prediction, score and
+        margin by record key, empty if the catalogue does not exist. If the
+        version differs or the catalogue has no scores, only the added dates
+        are kept and the title hashes are None
+    """
+    if not os.path.exists(path):
+        return {}
+    schema = pq.read_schema(path)
+    columns = ["dct:identifier", "url", "dct:title", "thema", "bezeichnung", "added"]
+    if not set(columns) <= set(schema.names):
+        return {}
+    version = (schema.metadata or {}).get(PREDICTION_VERSION.encode("utf-8"))
+    same_version = version == prediction_version.encode("utf-8")
+    # catalogues older than the review queue have no scores to threshold
+    score_columns = ["prediction", "score", "margin"]
+    if same_version and set(score_columns) <= set(schema.names):
+        columns += score_columns
+    else:
+        same_version = False
+    previous = {}
+    for batch in pq.ParquetFile(path).iter_batches(columns=columns):
+        for identifier, url, title, thema, bezeichnung, added, *scores in zip(
+            *[batch.column(name).to_pylist() for name in columns]
+        ):
+            if identifier is None and url is None:
+                continue
+            prediction, score, margin = scores or [None, None, None]
+            previous[(identifier, url)] = (
+                title_hash(title) if same_version else None,
+                thema,
+                bezeichnung,
+                added,
+                prediction,
+                _to_float(score),
+                _to_float(margin),
+            )
+    return previous
+
+
+def read_catalogue(path: str, columns: Union[List[str], None] = None) -> pd.DataFrame:
+    """reads the Parquet file, the dictionary encoded columns become
+    categoricals
+
+    Parameters
+    ----------
+    path : str
+        path of the Parquet file
+    columns : Union[List[str], None], optional
+        columns to read, by default all columns
+
+    Returns
+    -------
+    pd.DataFrame
+        Musterdatenkatalog
+    """
+    return pd.read_parquet(path, columns=columns)
+
+
+def export_catalogue(path: str, output_dir: str, formats: Iterable[str]) -> List[str]:
+    """derives Excel and CSV files from the Parquet file
+
+    Parameters
+    ----------
+    path : str
+        path of the Parquet file
+    output_dir : str
+        folder of the exports
+    formats : Iterable[str]
+        "xlsx" and/or "csv"
+
+    Returns
+    -------
+    List[str]
+        paths of the exports
+    """
+    formats = list(formats)
+    unknown = set(formats) - set(EXPORTS)
+    if unknown:
+        raise ValueError(f"unknown export formats {unknown}, choose {EXPORTS}")
+    name = os.path.splitext(os.path.basename(path))[0]
+    exports = []
+    if "csv" in formats:
+        csv_path = os.path.join(output_dir, f"{name}.csv")
+        parquet_file = pq.ParquetFile(path)
+        # the header is written first, so an empty catalogue has one as well
+        pd.DataFrame(columns=parquet_file.schema_arrow.names).to_csv(
+            csv_path, index=False
+        )
+        for batch in parquet_file.iter_batches():
+            batch.to_pandas().to_csv(csv_path, mode="a", header=False, index=False)
+        exports.append(csv_path)
+    if "xlsx" in formats:
+        # openpyxl needs the whole sheet in memory
+        xlsx_path = os.path.join(output_dir, f"{name}.xlsx")
+        read_catalogue(path).to_excel(xlsx_path, index=False)
+        exports.append(xlsx_path)
+    return exports
@@ -0,0 +1,100 @@
+"""Pipeline component: compact store of the normalized corpus embeddings of
+bert_sim.py. float16 halves and int8 with one scale per vector quarters the
+memory of the float32 embeddings"""
+
+from typing import Union
+
+import torch
+
+INDEX_DTYPES = ["float16", "int8"]
+
+
+class QuantizedIndex:
+    """quantized corpus embeddings with a scoring kernel returning float32
+    cosine similarities"""
+
+    def __init__(
+        self, codes: torch.Tensor, scales: Union[torch.Tensor, None] = None
+    ) -> None:
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_embeddings(
+        cls, embeddings: torch.Tensor, dtype: str = "int8"
+    ) -> "QuantizedIndex":
+        """quantizes normalized embeddings
+
+        Parameters
+        ----------
+        embeddings : torch.Tensor
+            normalized float32 embeddings, one row per label
+        dtype : str, optional
+            float16 or int8, by default "int8"
+
+        Returns
+        -------
+        QuantizedIndex
+            index of the embeddings
+        """
+        embeddings = embeddings.float()
+        if dtype == "float16":
+            return cls(embeddings.half())
+        if dtype == "int8":
+            # symmetric per-vector scaling, the largest component maps to 127
+            scales = embeddings.abs().amax(dim=1).clamp(min=1e-12) / 127
+            codes = torch.round(embeddings / scales.unsqueeze(1)).to(torch.int8)
+            return cls(codes, scales)
+        raise ValueError(f"unknown index dtype {dtype}, expected one of {INDEX_DTYPES}")
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.codes.element_size() * self.codes.nelement()
+        if self.scales is not None:
+            nbytes += self.scales.element_size() * self.scales.nelement()
+        return nbytes
+
+    def scores(
+        self,
+        query_embeddings: torch.Tensor,
+        label_ids: Union[torch.Tensor, None] = None,
+        block_size: int = 4096,
+    ) -> torch.Tensor:
+        """cosine similarities of normalized queries with the indexed labels.
+        The codes are widened to float32 in blocks of labels, so the float32
+        copy never exceeds block_size rows
+
+        Parameters
+        ----------
+        query_embeddings : torch.Tensor
+            normalized query embeddings
+        label_ids : Union[torch.Tensor, None], optional
+            scores only these labels, by default all labels
+        block_size : int, optional
+            number of labels widened at once, by default 4096
+
+        Returns
+        -------
+        torch.Tensor
+            float32 scores with one row per query and one column per label
+        """
+        query_embeddings = query_embeddings.float()
+        codes = self.codes if label_ids is None else self.codes[label_ids]
+        scales = self.scales
+        if scales is not None and label_ids is not None:
+            scales = scales[label_ids]
+        blocks = []
+        for start in range(0, len(codes), block_size):
+            block = (
+                query_embeddings
+                @ codes[start : start + block_size].float().T  # noqa: E203
+            )
+            if scales is not None:
+                block *= scales[start : start + block_size]  # noqa: E203
+            blocks.append(block)
+        if not blocks:
+            return query_embeddings.new_zeros((len(query_embeddings), 0))
+        return torch.cat(blocks, dim=1)
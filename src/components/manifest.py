@@ -0,0 +1,247 @@
+"""Pipeline component: manifest of the downloaded GovData datasets. Keeps for
+each dataset the file path, content hash, download time and the upstream
+modification time, so changes are detected with indexed queries instead of
+scanning the response folder"""
+
+import datetime
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+from src.components.storage import ResponseStore, name_from_path, read_response
+
+
+def get_content_hash(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+class DatasetManifest:
+    """sqlite table with one row per downloaded dataset"""
+
+    def __init__(self, path: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS datasets (
+                name TEXT PRIMARY KEY,
+                file_path TEXT,
+                content_hash TEXT,
+                downloaded_at TEXT,
+                metadata_modified TEXT,
+                deleted INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+
+    def __enter__(self) -> "DatasetManifest":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM datasets").fetchone()[0]
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+    def _select_names(self, names: Iterable[str]) -> None:
+        """fills the temporary table used to join a list of names"""
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS selected (name TEXT PRIMARY KEY)"
+        )
+        self.connection.execute("DELETE FROM selected")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO selected VALUES (?)", ((name,) for name in names)
+        )
+
+    def record_download(
+        self,
+        name: str,
+        file_path: str,
+        content_hash: str,
+        metadata_modified: Union[str, None] = None,
+    ) -> None:
+        """adds or updates a downloaded dataset
+
+        Parameters
+        ----------
+        name : str
+            dataset name
+        file_path : str
+            path of the stored response
+        content_hash : str
+            sha1 of the response content
+        metadata_modified : Union[str, None], optional
+            upstream modification time, by default None
+        """
+        self.connection.execute(
+            """INSERT INTO datasets VALUES (?, ?, ?, ?, ?, 0)
+            ON CONFLICT(name) DO UPDATE SET
+                file_path = excluded.file_path,
+                content_hash = excluded.content_hash,
+                downloaded_at = excluded.downloaded_at,
+                metadata_modified = excluded.metadata_modified,
+                deleted = 0""",
+            (
+                name,
+                file_path,
+                content_hash,
+                datetime.datetime.utcnow().isoformat(),
+                metadata_modified,
+            ),
+        )
+
+    def set_modified(self, name: str, metadata_modified: str) -> None:
+        self.connection.execute(
+            "UPDATE datasets SET metadata_modified = ? WHERE name = ?",
+            (metadata_modified, name),
+        )
+
+    def get(self, names: Iterable[str]) -> Dict[str, Dict]:
+        """rows of the given datasets which are in the manifest
+
+        Parameters
+        ----------
+        names : Iterable[str]
+            dataset names
+
+        Returns
+        -------
+        Dict[str, Dict]
+            downloaded_at and metadata_modified by dataset name
+        """
+        self._select_names(names)
+        rows = self.connection.execute(
+            """SELECT d.name, d.downloaded_at, d.metadata_modified
+            FROM datasets d JOIN selected s ON d.name = s.name"""
+        )
+        return {
+            name: {"downloaded_at": downloaded_at, "metadata_modified": modified}
+            for name, downloaded_at, modified in rows
+        }
+
+    def missing(self, names: Iterable[str]) -> List[str]:
+        """names which are not in the manifest"""
+        self._select_names(names)
+        return [
+            row[0]
+            for row in self.connection.execute(
+                """SELECT s.name FROM selected s
+                LEFT JOIN datasets d ON d.name = s.name WHERE d.name IS NULL"""
+            )
+        ]
+
+    def lost(self, names: Iterable[str], store: ResponseStore) -> List[str]:
+        """names which are in the manifest but whose file is not in the
+        response store anymore, e.g. because it was deleted by hand"""
+        self._select_names(names)
+        return [
+            row[0]
+            for row in self.connection.execute(
+                """SELECT d.name FROM datasets d JOIN selected s ON d.name = s.name"""
+            )
+            if not store.exists(row[0])
+        ]
+
+    def extra(self, names: Iterable[str]) -> List[str]:
+        """datasets in the manifest which are not in names"""
+        self._select_names(names)
+        return [
+            row[0]
+            for row in self.connection.execute(
+                """SELECT d.name FROM datasets d
+                LEFT JOIN selected s ON d.name = s.name WHERE s.name IS NULL"""
+            )
+        ]
+
+    def file_paths(self, names: Iterable[str], store: ResponseStore) -> List[str]:
+        """file paths of the given datasets which are in the manifest. The
+        paths are resolved by name through the store, so they stay valid
+        after the folder was migrated to another layout"""
+        self._select_names(names)
+        return [
+            store.path(row[0])
+            for row in self.connection.execute(
+                "SELECT d.name FROM datasets d JOIN selected s ON d.name = s.name"
+            )
+        ]
+
+    def content_hashes(
+        self, names: Iterable[str], store: ResponseStore
+    ) -> Dict[str, str]:
+        """content hash by file path of the given datasets which are in the
+        manifest, the paths are resolved through the store"""
+        self._select_names(names)
+        return {
+            store.path(name): content_hash
+            for name, content_hash in self.connection.execute(
+                """SELECT d.name, d.content_hash FROM datasets d
+                JOIN selected s ON d.name = s.name"""
+            )
+        }
+
+    def mark_deleted(self, names: Iterable[str]) -> None:
+        """flags the given datasets as deleted on GovData, all other datasets
+        are flagged as existing"""
+        self._select_names(names)
+        self.connection.execute(
+            "UPDATE datasets SET deleted = name IN (SELECT name FROM selected)"
+        )
+
+    def deleted(self) -> List[str]:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT name FROM datasets WHERE deleted = 1 ORDER BY name"
+            )
+        ]
+
+    @property
+    def last_sync(self) -> Union[str, None]:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'last_sync'"
+        ).fetchone()
+        return row[0] if row else None
+
+    @last_sync.setter
+    def last_sync(self, value: str) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('last_sync', ?)", (value,)
+        )
+
+    def rebuild_from_store(self, store: ResponseStore) -> None:
+        """adds all files of a response store. The modification time of the
+        file is used as download time, known upstream modification times are
+        kept
+
+        Parameters
+        ----------
+        store : ResponseStore
+            store of the response folder
+        """
+        for file_path in store.paths():
+            downloaded_at = datetime.datetime.utcfromtimestamp(
+                os.path.getmtime(file_path)
+            ).isoformat()
+            self.connection.execute(
+                """INSERT INTO datasets VALUES (?, ?, ?, ?, NULL, 0)
+                ON CONFLICT(name) DO UPDATE SET
+                    file_path = excluded.file_path,
+                    content_hash = excluded.content_hash""",
+                (
+                    name_from_path(file_path),
+                    file_path,
+                    get_content_hash(read_response(file_path)),
+                    downloaded_at,
+                ),
+            )
+        self.connection.commit()
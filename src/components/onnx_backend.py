@@ -0,0 +1,230 @@
+"""Pipeline component: ONNX Runtime backend for the sentence transformer of
+bert_sim.py. The exported graph contains transformer, pooling and
+normalization, OnnxEncoder offers the parts of the SentenceTransformer
+interface used by BertSim.
+
+Export of the classifier:
+python -m src.components.onnx_backend --model and-effect/musterdatenkatalog_clf \
+    --output models/musterdatenkatalog_clf_onnx --quantize
+"""
+
+import argparse
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+
+ONNX_FILE = "model.onnx"
+ONNX_QUANTIZED_FILE = "model_int8.onnx"
+ONNX_CONFIG_FILE = "onnx_config.json"
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError(
+            "the onnx backend requires the onnx extra: poetry install --extras onnx"
+        ) from e
+    return onnxruntime
+
+
+class _EncoderGraph(torch.nn.Module):
+    """sentence transformer with normalization and positional inputs, as
+    required by the onnx export"""
+
+    def __init__(self, model: SentenceTransformer) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        features = self.model(
+            {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": token_type_ids,
+            }
+        )
+        return torch.nn.functional.normalize(features["sentence_embedding"], dim=1)
+
+
+def export_onnx(
+    model_name: str, output_dir: str, quantize: bool = False, opset: int = 14
+) -> str:
+    """exports a sentence transformer with pooling and normalization to onnx
+    and saves the tokenizer next to it
+
+    Parameters
+    ----------
+    model_name : str
+        name or path of the sentence transformer
+    output_dir : str
+        folder of the exported model
+    quantize : bool, optional
+        additionally writes a model with dynamic int8 quantization of the
+        weights, by default False
+    opset : int, optional
+        onnx opset version, by default 14
+
+    Returns
+    -------
+    str
+        path of the exported model
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    model.eval()
+    model.tokenizer.save_pretrained(output_dir)
+    features = model.tokenizer(
+        ["Musterdatenkatalog", "Standorte der öffentlichen Toiletten"],
+        padding=True,
+        return_tensors="pt",
+    )
+    onnx_path = os.path.join(output_dir, ONNX_FILE)
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # newer torch versions export with dynamo by default, which needs the
+        # onnxscript package and handles the dynamic axes differently
+        export_kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            _EncoderGraph(model),
+            (
+                features["input_ids"],
+                features["attention_mask"],
+                features.get("token_type_ids", torch.zeros_like(features["input_ids"])),
+            ),
+            onnx_path,
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["sentence_embedding"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_type_ids": {0: "batch", 1: "sequence"},
+                "sentence_embedding": {0: "batch"},
+            },
+            opset_version=opset,
+            **export_kwargs,
+        )
+    with open(os.path.join(output_dir, ONNX_CONFIG_FILE), "w") as fp:
+        json.dump(
+            {
+                "model_name": model_name,
+                "max_seq_length": model.max_seq_length,
+                "dimension": model.get_sentence_embedding_dimension(),
+            },
+            fp,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            onnx_path,
+            os.path.join(output_dir, ONNX_QUANTIZED_FILE),
+            weight_type=QuantType.QInt8,
+        )
+    return onnx_path
+
+
+class OnnxEncoder:
+    """runs an exported sentence transformer with ONNX Runtime on CPU, the
+    embeddings are already normalized"""
+
+    def __init__(
+        self,
+        model_dir: str,
+        file_name: str = ONNX_FILE,
+        n_threads: Union[int, None] = None,
+    ) -> None:
+        onnxruntime = _onnxruntime()
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILE)) as fp:
+            self.config: Dict = json.load(fp)
+        self.max_seq_length = self.config["max_seq_length"]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        session_options = onnxruntime.SessionOptions()
+        # same thread count as torch, so worker processes stay pinned
+        session_options.intra_op_num_threads = n_threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, file_name),
+            sess_options=session_options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = [el.name for el in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dimension"]
+
+    def _run(self, sentences: List[str]) -> np.ndarray:
+        features = self.tokenizer(
+            sentences,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        if "token_type_ids" not in features:
+            features["token_type_ids"] = np.zeros_like(features["input_ids"])
+        inputs = {name: features[name].astype(np.int64) for name in self.input_names}
+        return self.session.run(None, inputs)[0]
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_tensor: bool = False,
+        show_progress_bar: bool = False,
+    ) -> Union[np.ndarray, torch.Tensor]:
+        """encodes sentences like SentenceTransformer.encode, the sentences
+        are sorted by length so batches are padded as little as possible
+
+        Parameters
+        ----------
+        sentences : Union[str, List[str]]
+            sentence or sentences
+        batch_size : int, optional
+            sentences per session run, by default 32
+        convert_to_tensor : bool, optional
+            returns a torch tensor instead of a numpy array, by default False
+        show_progress_bar : bool, optional
+            ignored, for compatibility with SentenceTransformer.encode
+
+        Returns
+        -------
+        Union[np.ndarray, torch.Tensor]
+            one normalized embedding per sentence
+        """
+        single_sentence = isinstance(sentences, str)
+        if single_sentence:
+            sentences = [sentences]
+        order = np.argsort([-len(sentence) for sentence in sentences])
+        embeddings = np.empty(
+            (len(sentences), self.get_sentence_embedding_dimension()),
+            dtype=np.float32,
+        )
+        for start in range(0, len(sentences), batch_size):
+            batch_ids = order[start : start + batch_size]  # noqa: E203
+            embeddings[batch_ids] = self._run([sentences[idx] for idx in batch_ids])
+        if single_sentence:
+            embeddings = embeddings[0]
+        if convert_to_tensor:
+            return torch.from_numpy(embeddings)
+        return embeddings
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(
+        description="Exports a sentence transformer to ONNX for BertSim"
+    )
+    argument_parser.add_argument("--model", default="and-effect/musterdatenkatalog_clf")
+    argument_parser.add_argument("--output", required=True)
+    argument_parser.add_argument(
+        "--quantize", action="store_true", help="also write a dynamic int8 model"
+    )
+    args = argument_parser.parse_args()
+    export_onnx(model_name=args.model, output_dir=args.output, quantize=args.quantize)
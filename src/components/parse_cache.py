@@ -0,0 +1,145 @@
+"""Pipeline component: cache of parsed records, so files that did not
+change since the last run are not parsed again"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(file_path: str) -> str:
+    """sha1 of the file content, read in chunks so large files like the
+    catalogue are not loaded into memory
+
+    Parameters
+    ----------
+    file_path : str
+        path to file
+
+    Returns
+    -------
+    str
+        hex digest of the content
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Parsed records stored in sqlite by file path. A record is valid if the
+    cache version matches and either size and mtime of the file are unchanged
+    or the content hash is the same"""
+
+    def __init__(self, path: str, version: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS records (
+                file_path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                content_hash TEXT,
+                version TEXT,
+                record TEXT
+            )"""
+        )
+
+    def __enter__(self) -> "ParseCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def is_valid(self, file_path: str) -> bool:
+        """checks if the cached record of a file can be used
+
+        Parameters
+        ----------
+        file_path : str
+            path of the parsed file
+
+        Returns
+        -------
+        bool
+            True if the file is unchanged since it was parsed
+        """
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, content_hash FROM records "
+            "WHERE file_path = ? AND version = ?",
+            (file_path, self.version),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False
+        size, mtime_ns, content_hash = row
+        stat = os.stat(file_path)
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            if stat.st_size != size or file_hash(file_path) != content_hash:
+                self.misses += 1
+                return False
+            self.connection.execute(
+                "UPDATE records SET mtime_ns = ? WHERE file_path = ?",
+                (stat.st_mtime_ns, file_path),
+            )
+        self.hits += 1
+        return True
+
+    def load(self, file_path: str) -> Dict:
+        """loads the cached record of a file
+
+        Parameters
+        ----------
+        file_path : str
+            path of the parsed file
+
+        Returns
+        -------
+        Dict
+            cached record
+        """
+        (record,) = self.connection.execute(
+            "SELECT record FROM records WHERE file_path = ?", (file_path,)
+        ).fetchone()
+        return json.loads(record)
+
+    def put(self, file_path: str, record: Dict) -> None:
+        """stores the record of a parsed file
+
+        Parameters
+        ----------
+        file_path : str
+            path of the parsed file
+        record : Dict
+            parsed record
+        """
+        stat = os.stat(file_path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                file_path,
+                stat.st_size,
+                stat.st_mtime_ns,
+                file_hash(file_path),
+                self.version,
+                json.dumps(record),
+            ),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= 1000:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
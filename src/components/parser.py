@@ -1,22 +1,35 @@
 """Pipeline component: parse data scraped from scraper.py.
 Source: https://github.com/bertelsmannstift/Musterdatenkatalog (edited)"""
 
+import hashlib
+import json
 import logging
+import math
 import os
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import httpx
 import pandas as pd
 from bs4 import BeautifulSoup, Tag
 from dateutil.parser import parse
-from joblib import Parallel, delayed
 
+from src.components.parse_cache import ParseCache
+from src.components.storage import read_response
 from src.settings import Settings
-from src.utils.data import chunks
+from src.utils.data import chunks, load_json, save_json
 
 settings = Settings(_env_file="paths/.env.dev")
 
+THEMES_URL = "https://publications.europa.eu/resource/authority/data-theme"
+THEMES_CACHE = "extraction/data_themes_de.json"
+THEMES_CACHE_TTL = timedelta(days=30)
+MAX_BATCH_SIZE = 500
+# increase if the records returned by get_data change
+PARSER_SCHEMA_VERSION = 1
+
 
 if not os.path.exists("docs"):
     Path("docs").mkdir(parents=True, exist_ok=True)
@@ -55,37 +68,138 @@ class CustomisedTag(Tag):
         return None
 
 
+class CityIndex:
+    """Lookup of publisher names in the cities csv. Exact names are resolved
+    with a dict, partial names are detected with one substring search over
+    all names joined by line breaks. Only plain Python objects are stored,
+    so the index is cheap to pickle for worker processes"""
+
+    def __init__(self, names, kommunen):
+        self.kommune_by_name = {}
+        for name, kommune in zip(names, kommunen):
+            if isinstance(name, str):
+                self.kommune_by_name.setdefault(name, kommune)
+        self.names = "\n".join(self.kommune_by_name)
+
+    @classmethod
+    def from_csv(cls, path):
+        df = pd.read_csv(path)
+        return cls(names=df["name"], kommunen=df["Kommune"])
+
+    def get(self, name):
+        return self.kommune_by_name.get(name)
+
+    def contains(self, name):
+        """checks if the name is part of a name in the cities csv"""
+        return "\n" not in name and name in self.names
+
+
 class Parser:
-    def __init__(self, current_cities):
+    def __init__(
+        self,
+        current_cities,
+        themes_cache=THEMES_CACHE,
+        themes_cache_ttl=THEMES_CACHE_TTL,
+        offline=False,
+    ):
         self.categories = {}
-        self.df = pd.read_csv(current_cities)
+        if isinstance(current_cities, CityIndex):
+            self.city_index = current_cities
+        else:
+            self.city_index = CityIndex.from_csv(current_cities)
+        self.themes_cache = themes_cache
+        self.themes_cache_ttl = themes_cache_ttl
+        self.offline = offline
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # size of the files read by the last iter_parse_data, cache hits are
+        # not read
+        self.bytes_parsed = 0
 
     def _read_file(self, file_path):
-        with open(file_path) as f:
-            content = f.read()
-        return content
+        # bytes, BeautifulSoup detects the encoding of the document, so one
+        # response which is not utf-8 does not abort the whole run
+        return read_response(file_path)
 
-    def get_themes(self):
-        url = "https://publications.europa.eu/resource/authority/data-theme"
-        response = httpx.get(url)
+    def _load_themes_cache(self):
+        if self.themes_cache is None or not os.path.isfile(self.themes_cache):
+            return None
         try:
-            response.raise_for_status()
+            return load_json(path=self.themes_cache)
         except Exception as e:
-            logger.error(e)
-        response_soup = BeautifulSoup(response.text, "xml")
-        categories_ = response_soup.find_all("rdf:Description")
-        for c in categories_:
+            logger.info(f"The theme cache could not be read: {e}")
+            return None
+
+    def _download_themes(self):
+        """downloads the german theme labels, returns the labels and the urls
+        of the themes which could not be resolved"""
+        categories = {}
+        unresolved = []
+        with httpx.Client() as client:
+            response = client.get(THEMES_URL)
             try:
+                response.raise_for_status()
+            except Exception as e:
+                logger.error(e)
+                return categories, [THEMES_URL]
+            response_soup = BeautifulSoup(response.text, "xml")
+            categories_ = response_soup.find_all("rdf:Description")
+            for c in categories_:
                 url = c.get("rdf:about")
-                if url not in self.categories:
-                    category = BeautifulSoup(httpx.get(url).text, "xml").find(
-                        "skos:prefLabel", {"xml:lang": "de"}
+                try:
+                    if url not in categories:
+                        category = BeautifulSoup(client.get(url).text, "xml").find(
+                            "skos:prefLabel", {"xml:lang": "de"}
+                        )
+                        categories[url] = category.text
+                except Exception as e:
+                    logger.info(
+                        f"The theme could not be extracted. The following error occurred {e}"  # noqa: E501
                     )
-                    self.categories[url] = category
-            except Exception as e:
-                logger.info(
-                    f"The theme could not be extracted. The following error occurred {e}"
+                    unresolved.append(url)
+        return categories, unresolved
+
+    def get_themes(self):
+        """loads the german labels of the EU data themes. The labels are read
+        from the theme cache if it is younger than the ttl or in offline mode,
+        otherwise they are downloaded. The cache is only replaced if every
+        theme was resolved, otherwise the previous labels are kept"""
+        if self.categories:
+            return
+        cache = self._load_themes_cache()
+        if cache is not None:
+            fetched_at = datetime.fromisoformat(cache["fetched_at"])
+            if self.offline or datetime.now() - fetched_at < self.themes_cache_ttl:
+                self.categories = cache["labels"]
+                return
+        if self.offline:
+            logger.info("No theme cache available in offline mode.")
+            return
+        try:
+            categories, unresolved = self._download_themes()
+        except httpx.HTTPError as e:
+            logger.error(f"The themes could not be downloaded: {e}")
+            categories, unresolved = {}, [THEMES_URL]
+        if categories and not unresolved:
+            self.categories = categories
+            if self.themes_cache is not None:
+                Path(self.themes_cache).parent.mkdir(parents=True, exist_ok=True)
+                save_json(
+                    obj={
+                        "fetched_at": datetime.now().isoformat(),
+                        "labels": self.categories,
+                    },
+                    path=self.themes_cache,
                 )
+            return
+        if unresolved:
+            logger.warning(
+                f"{len(unresolved)} themes could not be resolved, the theme cache is not updated."  # noqa: E501
+            )
+        self.categories = categories
+        if cache is not None:
+            logger.info("Using the expired theme cache.")
+            self.categories = {**cache["labels"], **categories}
 
     def get_title(self):
         try:
@@ -196,8 +310,12 @@ class Parser:
             )
             return float("nan")
 
+    def _get_city_candidate(self, col_tree):
+        return self.soup.find("dcat:dataset").find_tree(col_tree).text
+
     def get_city(self):
         cities_csv_logger = []
+        cities_csv_partial_logger = []
         col_tree_logger = []
         col_tree_logger_error = []
         columns = [
@@ -209,14 +327,12 @@ class Parser:
         ]
         for col_tree in columns:
             try:
-                tag = self.soup.find("dcat:dataset").find_tree(col_tree)
-                stelle = tag.text
-                if (
-                    self.df["name"].str.contains(stelle).any()
-                    or self.df["name"].eq(stelle).any()
-                ):
-                    row = self.df.loc[self.df["name"] == stelle, "Kommune"]
-                    return row.array[0]
+                stelle = self._get_city_candidate(col_tree)
+                kommune = self.city_index.get(stelle)
+                if kommune is not None:
+                    return kommune
+                elif self.city_index.contains(stelle):
+                    cities_csv_partial_logger.append(stelle)
                 else:
                     cities_csv_logger.append(stelle)
             except Exception as e:
@@ -225,6 +341,10 @@ class Parser:
                 continue
         if len(cities_csv_logger) > 0:
             logger.info(f"No name in cities.csv matches the tags {cities_csv_logger}")
+        if len(cities_csv_partial_logger) > 0:
+            logger.info(
+                f"Names in cities.csv only partially match the tags {cities_csv_partial_logger}"  # noqa: E501
+            )
         if len(col_tree_logger) > 0:
             logger.info(
                 f"The {col_tree_logger} could not be extracted. The following error messages occurred {set(col_tree_logger_error)}"  # noqa: E501
@@ -248,43 +368,137 @@ class Parser:
             "file_path": file_path,
         }
 
-    def parse_data(self, file_path):
-        logger.info(msg=f"Parse {file_path}")
+    def _load_document(self, content):
+        self.soup = BeautifulSoup(content, "lxml", element_classes={Tag: CustomisedTag})
+
+    def _clear_document(self):
+        self.content = None
+        self.soup = None
+
+    def parse_file(self, file_path):
+        """parses one file, the document is only kept while it is parsed"""
         self.content = self._read_file(file_path)
-        self.soup = BeautifulSoup(
-            self.content, "lxml", element_classes={Tag: CustomisedTag}
-        )
-        self.get_themes()
-        data = self.get_data()
+        self._load_document(self.content)
+        data = self.get_data(file_path)
+        self._clear_document()
         for key, value in data.items():
             if value == "":
                 data[key] = float("nan")
         return data
 
+    def parse_data(self, file_path):
+        logger.info(msg=f"Parse {file_path}")
+        self.get_themes()
+        return self.parse_file(file_path)
+
     def _batch_process(self, batch):
-        result = []
-        for file_path in batch:
-            self.content = self._read_file(file_path)
-            self.soup = BeautifulSoup(
-                self.content, "lxml", element_classes={Tag: CustomisedTag}
+        return [self.parse_file(file_path) for file_path in batch]
+
+    def cache_version(self):
+        """version of the parsed records, changes with the parser engine, the
+        record schema, the cities csv and the theme labels"""
+        fingerprint = json.dumps(
+            [
+                type(self).__name__,
+                PARSER_SCHEMA_VERSION,
+                sorted(self.city_index.kommune_by_name.items()),
+                sorted(self.categories.items()),
+            ]
+        )
+        return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+    def iter_parse_data(
+        self, file_paths, batch_size=None, n_jobs=None, cache_path=None
+    ):
+        """parses the files in worker processes and yields the records in the
+        order of file_paths. Each worker gets the city index and the theme
+        labels once at start up. At most two batches per worker are in flight,
+        so memory does not grow with the number of files
+
+        Parameters
+        ----------
+        file_paths : List
+            paths of the files to parse
+        batch_size : int, optional
+            files per task, by default chosen from the number of files and
+            workers
+        n_jobs : int, optional
+            number of worker processes, by default number of cpus
+        cache_path : str, optional
+            path of the parse cache, if set only new or changed files are
+            parsed and the other records are read from the cache,
+            by default None
+
+        Yields
+        ------
+        Dict
+            parsed record of one file
+        """
+        self.get_themes()
+        file_paths = list(file_paths)
+        if cache_path is None:
+            self.bytes_parsed = sum(os.path.getsize(el) for el in file_paths)
+            yield from self._iter_parse_files(file_paths, batch_size, n_jobs)
+            return
+        with ParseCache(path=cache_path, version=self.cache_version()) as cache:
+            is_cached = [cache.is_valid(file_path) for file_path in file_paths]
+            self.cache_hits, self.cache_misses = cache.hits, cache.misses
+            logger.info(
+                f"Parse cache: {cache.hits} files unchanged, {cache.misses} files to parse"  # noqa: E501
             )
-            data = self.get_data(file_path)
-            for key, value in data.items():
-                if value == "":
-                    data[key] = float("nan")
-            result.append(data)
-        return result
+            new_file_paths = [
+                el for el, cached in zip(file_paths, is_cached) if not cached
+            ]
+            self.bytes_parsed = sum(os.path.getsize(el) for el in new_file_paths)
+            parsed = self._iter_parse_files(new_file_paths, batch_size, n_jobs)
+            for file_path, cached in zip(file_paths, is_cached):
+                if cached:
+                    yield cache.load(file_path)
+                else:
+                    data = next(parsed)
+                    cache.put(file_path, data)
+                    yield data
+
+    def _iter_parse_files(self, file_paths, batch_size, n_jobs):
+        if len(file_paths) == 0:
+            return
+        n_jobs = n_jobs or os.cpu_count() or 1
+        if batch_size is None:
+            batch_size = _batch_size(n_files=len(file_paths), n_jobs=n_jobs)
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_worker,
+            initargs=(type(self), self.city_index, self.categories),
+        ) as executor:
+            pending = deque()
+            for batch in chunks(file_paths, batch_size):
+                pending.append(executor.submit(_parse_batch, batch))
+                if len(pending) >= 2 * n_jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def parse_data_parallel(self, file_paths, batch_size=None, cache_path=None):
+        return list(
+            self.iter_parse_data(
+                file_paths, batch_size=batch_size, cache_path=cache_path
+            )
+        )
 
-    def parse_data_parallel(self, file_paths, batch_size=1000):
-        self.get_themes()
-        results = []
-        batches = [chunk for chunk in chunks(file_paths, batch_size)]
 
-        data_per_batch = Parallel(n_jobs=-1)(
-            delayed(self._batch_process)(batch) for batch in batches
-        )
+_worker_parser = None
+
+
+def _batch_size(n_files, n_jobs):
+    return max(1, min(MAX_BATCH_SIZE, math.ceil(n_files / (n_jobs * 4))))
+
+
+def _init_worker(engine, city_index, categories):
+    """builds the parser of a worker process once from the shared state"""
+    global _worker_parser
+    _worker_parser = engine(current_cities=city_index, themes_cache=None)
+    _worker_parser.categories = categories
+
 
-        for batch in data_per_batch:
-            for data in batch:
-                results.append(data)
-        return results
+def _parse_batch(batch):
+    return [_worker_parser.parse_file(file_path) for file_path in batch]
@@ -0,0 +1,181 @@
+"""Pipeline component: parse data scraped from scraper.py with lxml.
+Same output as parser.py, but the fields are extracted with precompiled
+namespace-aware XPath expressions instead of BeautifulSoup tree scans"""
+
+from datetime import datetime
+
+from dateutil.parser import parse
+from lxml import etree
+
+from src.components.parser import Parser, logger
+from src.components.storage import read_response
+
+NAMESPACES = {
+    "dcat": "http://www.w3.org/ns/dcat#",
+    "dcatde": "http://dcat-ap.de/def/dcatde/",
+    "dct": "http://purl.org/dc/terms/",
+    "foaf": "http://xmlns.com/foaf/0.1/",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "vcard": "http://www.w3.org/2006/vcard/ns#",
+}
+
+RDF_ABOUT = f"{{{NAMESPACES['rdf']}}}about"
+RDF_RESOURCE = f"{{{NAMESPACES['rdf']}}}resource"
+
+XML_PARSER = etree.XMLParser(recover=True, huge_tree=True, resolve_entities=False)
+
+
+def _xpath(expression):
+    return etree.XPath(expression, namespaces=NAMESPACES)
+
+
+# BeautifulSoup matches the lowercased tag names, therefore both spellings
+DATASET = _xpath("(//dcat:Dataset | //dcat:dataset)[1]")
+TITLE = _xpath("dct:title[1]")
+DESCRIPTION = _xpath("dct:description[1]")
+DISTRIBUTION_DESCRIPTIONS = _xpath(
+    ".//dcat:Distribution/dct:description | .//dcat:distribution/dct:description"
+)
+LICENSE = _xpath("(//dct:license)[1]")
+THEMES = _xpath("//dcat:theme")
+KEYWORDS = _xpath("//dcat:keyword")
+IDENTIFIER = _xpath("(//dct:identifier)[1]")
+MODIFIED = _xpath("(//dct:modified)[1]")
+CITY_CANDIDATES = {
+    ("vcard:fn",): _xpath("(.//vcard:fn)[1]"),
+    ("dct:publisher", "foaf:name"): _xpath("((.//dct:publisher)[1]//foaf:name)[1]"),
+    ("dcatde:maintainer", "foaf:name"): _xpath(
+        "((.//dcatde:maintainer)[1]//foaf:name)[1]"
+    ),
+    ("dct:maintainer", "foaf:name"): _xpath("((.//dct:maintainer)[1]//foaf:name)[1]"),
+    ("dct:creator", "foaf:name"): _xpath("((.//dct:creator)[1]//foaf:name)[1]"),
+}
+STRING = etree.XPath("string()")
+
+
+def _first(xpath, element):
+    results = xpath(element)
+    if len(results) == 0:
+        raise ValueError(f"No match for {xpath.path}")
+    return results[0]
+
+
+def _text(element):
+    return str(STRING(element))
+
+
+class LxmlParser(Parser):
+    """Parser engine based on lxml, returns the same schema as Parser.get_data"""
+
+    def _read_file(self, file_path):
+        return read_response(file_path)
+
+    def _load_document(self, content):
+        root = etree.fromstring(content, parser=XML_PARSER)
+        self.tree = root if root is not None else etree.Element("empty")
+        datasets = DATASET(self.tree)
+        self.dataset = datasets[0] if len(datasets) > 0 else None
+
+    def _clear_document(self):
+        self.content = None
+        self.tree = None
+        self.dataset = None
+
+    def _get_dataset(self):
+        if self.dataset is None:
+            raise ValueError("No dcat:Dataset in document")
+        return self.dataset
+
+    def get_title(self):
+        try:
+            return _text(_first(TITLE, self._get_dataset()))
+        except Exception as e:
+            logger.info(
+                f"The title could not be extracted. The following error occurred {e}"
+            )
+            return float("nan")
+
+    def get_license(self):
+        try:
+            return _first(LICENSE, self.tree).get(RDF_RESOURCE)
+        except Exception as e:
+            logger.info(
+                f"The License could not be extracted. The following error occurred {e}"
+            )
+            return float("nan")
+
+    def get_categories(self):
+        try:
+            return ", ".join(
+                [self.get_category(c.get(RDF_RESOURCE)) for c in THEMES(self.tree)]
+            )
+        except Exception as e:
+            logger.info(
+                f"The category could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def get_tags(self):
+        try:
+            return ", ".join([_text(t) for t in KEYWORDS(self.tree)])
+        except Exception as e:
+            logger.info(
+                f"The tag could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def get_url(self):
+        try:
+            return self._get_dataset().get(RDF_ABOUT)
+        except Exception as e:
+            logger.info(
+                f"The url could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def get_id(self):
+        try:
+            identifiers = IDENTIFIER(self.tree)
+            if len(identifiers) == 0:
+                return float("nan")
+            if identifiers[0].get(RDF_RESOURCE) is not None:
+                return identifiers[0].get(RDF_RESOURCE)
+            return _text(identifiers[0])
+        except Exception as e:
+            logger.info(
+                f"The id could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def get_description(self):
+        try:
+            return _text(_first(DESCRIPTION, self._get_dataset()))
+        except Exception as e:
+            logger.info(
+                f"The description could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def get_distribution_description(self):
+        try:
+            return ", ".join(
+                [_text(t) for t in DISTRIBUTION_DESCRIPTIONS(self._get_dataset())]
+            )
+        except Exception as e:
+            logger.info(
+                f"The url could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def get_updated_at(self):
+        try:
+            text = _text(_first(MODIFIED, self.tree))
+            return datetime.strftime(parse(text), "%Y-%m-%d")
+        except Exception as e:
+            logger.info(
+                f"The url could not be extracted. The following error occurred: {e}"
+            )
+            return float("nan")
+
+    def _get_city_candidate(self, col_tree):
+        return _text(_first(CITY_CANDIDATES[tuple(col_tree)], self._get_dataset()))
@@ -1,30 +1,110 @@
 """This file extracts the "Musterdatenkatalog"
 with the current data from GovData"""
 
-import glob
+import argparse
+import json
 import logging
 import os
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from src.components.bert_sim import BertSim
+from src.components.bert_sim import (
+    CORPUS_EMBEDDINGS_CACHE,
+    BertSim,
+    load_encoder,
+    model_fingerprint,
+)
+from src.components.catalogue import (
+    CATALOGUE_FILE,
+    EXPORTS,
+    PREDICTION_VERSION,
+    export_catalogue,
+    load_previous_predictions,
+    record_key,
+    title_hash,
+    write_catalogue,
+)
+from src.components.manifest import DatasetManifest
 from src.components.parser import Parser
+from src.components.parser_lxml import LxmlParser
+from src.components.run_report import RunReport, hit_rate
 from src.components.scraper import Scraper
+from src.components.stages import (
+    OUTPUTS,
+    STAGES,
+    StageStore,
+    describe_outputs,
+    select_stages,
+    stage_key,
+)
+from src.components.storage import create_store, get_store
 from src.settings import Settings
-from src.utils.data import load_json
+from src.utils.data import iter_chunks, load_json
 
 settings = Settings(_env_file="paths/.env.dev")
 
 
 GOV_DATA_RESPONSES = "extraction/gov_data_responses"
+GOV_DATA_MANIFEST = "extraction/gov_data_manifest.sqlite"
+PARSE_CACHE = "extraction/parse_cache.sqlite"
+RESPONSE_STORE_LAYOUT = "sharded"
+RESPONSE_STORE_COMPRESSION = "gzip"
 CURRENT_CITIES_PATH = settings.CITIES_V5
 MODEL_PATH = "and-effect/musterdatenkatalog_clf"
+MODEL_REVISION = None
+# torch, onnx or onnx-int8, the onnx models are exported with
+# python -m src.components.onnx_backend --output models/musterdatenkatalog_clf_onnx
+ENCODER_BACKEND = "torch"
+ONNX_MODEL_PATH = "models/musterdatenkatalog_clf_onnx"
+PREDICTION_MEMO = "extraction/prediction_memo.sqlite"
+# float16 or int8 for a compact corpus index, None keeps float32
+INDEX_DTYPE = None
+# maximum number of padded tokens per encoding batch
+TOKEN_BUDGET = 8192
+# encoder processes for hosts without GPU, 0 encodes in the main process
+ENCODER_WORKERS = 0
 CORPUS_PATH = settings.TAXONOMY_PROCESSED_V3
 OUTPUT_PATH = "extraction/musterdatenkatalog"
+# the catalogue is written as parquet, "xlsx" and "csv" are derived on demand
+EXPORT_FORMATS: List[str] = []
+# records below this cosine score get "Sonstiges", None keeps every prediction.
+# choose it on the test split of the evaluation, it depends on model and corpus
+SONSTIGES_THRESHOLD = None
+SONSTIGES = "Sonstiges"
+# records below this score or top-1/top-2 margin go to the review queue
+LOW_CONFIDENCE_SCORE = 0.5
+LOW_CONFIDENCE_MARGIN = 0.02
+LOW_CONFIDENCE_FILE = "low_confidence.csv"
+LOW_CONFIDENCE_COLUMNS = [
+    "dct:title",
+    "url",
+    "dct:identifier",
+    "city",
+    "thema",
+    "bezeichnung",
+    "prediction",
+    "score",
+    "margin",
+    "fallback",
+]
+# JSONL artifacts of the pipeline stages, see src/components/stages.py
+STAGE_DIR = "extraction/stages"
+# timings, throughput, memory and cache hit rates of the last run and of all runs
+RUN_REPORT_FILE = "run_report.json"
+RUN_REPORT_HISTORY = "run_reports.jsonl"
 
 SAMPLE_SIZE = -1
+ENRICHMENT_BATCH_SIZE = 256
+MAX_CONCURRENT_REQUESTS = 32
+INCREMENTAL_SYNC = True
+# reuse thema, bezeichnung and added of unchanged records of the last catalogue
+INCREMENTAL_UPDATE = True
+PARSER_ENGINE = "lxml"
+PARSER_ENGINES = {"bs4": Parser, "lxml": LxmlParser}
 
 if not os.path.exists("docs"):
     Path("docs").mkdir(parents=True, exist_ok=True)
@@ -43,24 +123,47 @@ logging.basicConfig(
 logger = logging.getLogger(name=__name__)
 
 
-def _download_current_gov_data(sample_size):
+def _download_current_gov_data(sample_size, metrics=None):
     scraper = Scraper()
-    if not os.path.exists(GOV_DATA_RESPONSES):
-        logger.info("The GovData responses folder does not exist. Downloading...")
-        Path("extraction/gov_data_responses").mkdir(parents=True, exist_ok=True)
-        scraper.scrape_parallel(
-            file_directory=GOV_DATA_RESPONSES, sample_size=sample_size, batch_size=1000
-        )
-        file_paths = glob.glob(pathname=os.path.join(GOV_DATA_RESPONSES, "*.xml"))
-        return file_paths
-    else:
-        logger.info("The GovData responses folder already exists.")
-        scraper.get_current_dataset_list()
-        file_paths = glob.glob(pathname=os.path.join(GOV_DATA_RESPONSES, "*.xml"))
-        file_paths_updated = check_if_all_files_are_downloaded(
-            file_paths=file_paths, current_dataset_list=scraper.current_dataset_list
-        )
-        return file_paths_updated
+    with DatasetManifest(GOV_DATA_MANIFEST) as manifest:
+        if not os.path.exists(GOV_DATA_RESPONSES):
+            logger.info("The GovData responses folder does not exist. Downloading...")
+            create_store(
+                GOV_DATA_RESPONSES,
+                layout=RESPONSE_STORE_LAYOUT,
+                compression=RESPONSE_STORE_COMPRESSION,
+            )
+            scraper.scrape_async(
+                file_directory=GOV_DATA_RESPONSES,
+                sample_size=sample_size,
+                max_concurrency=MAX_CONCURRENT_REQUESTS,
+                manifest=manifest,
+            )
+            content_hashes = manifest.content_hashes(
+                scraper.current_dataset_list, get_store(GOV_DATA_RESPONSES)
+            )
+        else:
+            logger.info("The GovData responses folder already exists.")
+            if len(manifest) == 0:
+                logger.info("Building the manifest from the GovData responses folder.")
+                manifest.rebuild_from_store(get_store(GOV_DATA_RESPONSES))
+            if INCREMENTAL_SYNC:
+                logger.info("Sync changed datasets since the last run.")
+                scraper.sync_incremental(
+                    file_directory=GOV_DATA_RESPONSES,
+                    manifest=manifest,
+                    max_concurrency=MAX_CONCURRENT_REQUESTS,
+                )
+            else:
+                scraper.get_current_dataset_list()
+            content_hashes = check_if_all_files_are_downloaded(
+                current_dataset_list=scraper.current_dataset_list,
+                manifest=manifest,
+                scraper=scraper,
+            )
+    if metrics is not None:
+        metrics.counters["bytes_downloaded"] = scraper.bytes_downloaded
+    return content_hashes
 
 
 def _create_corpus():
@@ -73,88 +176,439 @@ def _create_corpus():
 
 def _load_corpus():
     corpus_raw = load_json(path="data/processed/taxonomy_processed_v3.json")
-    corpus = list(set([f"{el['group']} - {el['label']}" for el in corpus_raw]))
+    # sorted, the order of a set changes between runs and with it the key of
+    # the corpus embedding cache
+    corpus = sorted(set([f"{el['group']} - {el['label']}" for el in corpus_raw]))
     corpus.remove("Sonstiges - Sonstiges")
     return corpus
 
 
-def check_if_all_files_are_downloaded(current_dataset_list, file_paths):
-    file_paths_datasets = [el.split("/")[-1].split(".")[0] for el in file_paths]
-    if set(current_dataset_list) == set(file_paths_datasets):
-        return file_paths
-    if len(set(current_dataset_list).difference(set(file_paths_datasets))) > 0:
+def check_if_all_files_are_downloaded(current_dataset_list, manifest, scraper=None):
+    store = get_store(GOV_DATA_RESPONSES)
+    missing_datasets = manifest.missing(current_dataset_list) + manifest.lost(
+        current_dataset_list, store
+    )
+    if len(missing_datasets) > 0:
         logger.info(
             "Some files are missing in the GovData responses folder. Downloading..."
         )
-        scraper = Scraper()
-        missing_datasets = list(
-            set(current_dataset_list).difference(set(file_paths_datasets))
+        scraper = scraper or Scraper()
+        scraper.scrape_async(
+            file_directory=GOV_DATA_RESPONSES,
+            current_dataset_list=missing_datasets,
+            max_concurrency=MAX_CONCURRENT_REQUESTS,
+            manifest=manifest,
         )
-        scraper.scrape_parallel(
-            file_directory=GOV_DATA_RESPONSES, current_dataset_list=missing_datasets
-        )
-    if len(set(file_paths_datasets).difference(set(current_dataset_list))) > 0:
+    extra_datasets = manifest.extra(current_dataset_list)
+    if len(extra_datasets) > 0:
         logger.info(
             "In the GovData responses folder are files that are not in the current dataset list. Files will not be parsed, but will not be deleted."  # noqa: E501
         )
-        logger.info(
-            f"{len(set(file_paths_datasets).difference(set(current_dataset_list)))} files are not in the current dataset list."  # noqa: E501
+        logger.info(f"{len(extra_datasets)} files are not in the current dataset list.")
+    content_hashes = manifest.content_hashes(current_dataset_list, store)
+    # files whose download failed again are left out of the parse stage
+    file_paths = {k: v for k, v in content_hashes.items() if os.path.isfile(k)}
+    if len(file_paths) < len(content_hashes):
+        logger.warning(
+            f"{len(content_hashes) - len(file_paths)} files could not be downloaded."
         )
-        file_paths_updated = [
-            file_paths[idx]
-            for idx, el in enumerate(file_paths_datasets)
-            if el in current_dataset_list
-        ]
-        print(len(file_paths_updated))
-        print(len(current_dataset_list))
-        return file_paths_updated
-    else:
-        return glob.glob(pathname=os.path.join(GOV_DATA_RESPONSES, "*.xml"))
+    return file_paths
 
 
-def main():
-    logger.info(msg="***START PIPELINE***")
-    logger.info(msg="CREATE CORPUS")
+def _enrich_data(
+    data: Iterable[Dict],
+    bert_sim: BertSim,
+    batch_size: int,
+    sonstiges_threshold: Union[float, None] = SONSTIGES_THRESHOLD,
+    low_confidence_score: float = LOW_CONFIDENCE_SCORE,
+    low_confidence_margin: float = LOW_CONFIDENCE_MARGIN,
+    previous: Union[Dict[Tuple, Tuple], None] = None,
+) -> Iterator[Tuple[List[Dict], List[Dict]]]:
+    """predicts thema and bezeichnung of a stream of records batch by batch.
+    Scores and top-1/top-2 margins of a batch are thresholded in one
+    vectorized pass, only one batch is held in memory
+
+    Parameters
+    ----------
+    data : Iterable[Dict]
+        parsed records
+    bert_sim : BertSim
+        classifier
+    batch_size : int
+        records per prediction batch
+    sonstiges_threshold : Union[float, None], optional
+        records below this score get "Sonstiges" as thema and bezeichnung,
+        None keeps every prediction, by default SONSTIGES_THRESHOLD
+    low_confidence_score : float, optional
+        records below this score are low confidence, by default
+        LOW_CONFIDENCE_SCORE
+    low_confidence_margin : float, optional
+        records below this margin are low confidence, by default
+        LOW_CONFIDENCE_MARGIN
+    previous : Union[Dict[Tuple, Tuple], None], optional
+        predictions of the previous catalogue from load_previous_predictions.
+        Known records keep their added date, known records with the same
+        title also keep thema, bezeichnung and scores and are not classified
+        again, by default None
+
+    Yields
+    ------
+    Tuple[List[Dict], List[Dict]]
+        enriched records of a batch with prediction, score and margin and its
+        low confidence records for review, reused records included
+    """
+    previous = previous or {}
+    n_records = 0
+    n_reused = 0
+    n_fallback = 0
+    n_queued = 0
+    with tqdm(desc="Enrichment") as progress_bar:
+        for batch in iter_chunks(data, batch_size):
+            new_records = []
+            is_new = np.ones(len(batch), dtype=bool)
+            for i, el in enumerate(batch):
+                known = previous.get(record_key(el))
+                if known is None:
+                    new_records.append(el)
+                    continue
+                known_title_hash, thema, bezeichnung, added, *scores = known
+                if added is not None:
+                    el["added"] = added
+                if known_title_hash == title_hash(el["dct:title"]):
+                    el["thema"] = thema
+                    el["bezeichnung"] = bezeichnung
+                    el["prediction"], el["score"], el["margin"] = scores
+                    is_new[i] = False
+                    n_reused += 1
+                else:
+                    new_records.append(el)
+
+            predictions = (
+                bert_sim.predict(
+                    queries=[str(el["dct:title"]) for el in new_records],
+                    batch_size=batch_size,
+                )
+                if new_records
+                else []
+            )
+            for el, prediction in zip(new_records, predictions):
+                el["thema"] = prediction["thema"]
+                el["bezeichnung"] = prediction["bezeichnung"]
+                el["prediction"] = prediction["prediction"]
+                el["score"] = prediction["score"]
+                el["margin"] = prediction["margin"]
+
+            # reused records are thresholded again with their stored scores,
+            # so they stay in the review queue
+            scores = np.array([el["score"] for el in batch], dtype=float)
+            margins = np.array([el["margin"] for el in batch], dtype=float)
+            fallback = np.zeros(len(batch), dtype=bool)
+            if sonstiges_threshold is not None:
+                fallback = scores < sonstiges_threshold
+            # a corpus with a single label has no margin, nan compares as False
+            low_confidence = (scores < low_confidence_score) | (
+                margins < low_confidence_margin
+            )
+
+            queue = []
+            for el, new, is_fallback, is_low_confidence in zip(
+                batch, is_new, fallback, low_confidence
+            ):
+                if new and is_fallback:
+                    el["thema"] = SONSTIGES
+                    el["bezeichnung"] = SONSTIGES
+                if is_low_confidence or is_fallback:
+                    queue.append(
+                        {
+                            "dct:title": el["dct:title"],
+                            "url": el.get("url"),
+                            "dct:identifier": el.get("dct:identifier"),
+                            "city": el.get("city"),
+                            "thema": el["thema"],
+                            "bezeichnung": el["bezeichnung"],
+                            "prediction": el["prediction"],
+                            "score": el["score"],
+                            "margin": el["margin"],
+                            "fallback": bool(is_fallback),
+                        }
+                    )
+            n_records += len(batch)
+            n_fallback += int(fallback.sum())
+            n_queued += len(queue)
+            progress_bar.update(len(batch))
+            yield batch, queue
+
+    logger.info(msg=f"ENRICHED {n_records} ENTRIES IN BATCHES OF {batch_size}")
+    logger.info(msg=f"REUSED {n_reused} PREDICTIONS OF THE PREVIOUS CATALOGUE")
+    logger.info(
+        msg=f"{n_fallback} ENTRIES FELL BACK TO {SONSTIGES}, "
+        f"{n_queued} ENTRIES NEED REVIEW"
+    )
+
+
+def _stage_corpus(store: StageStore, report: RunReport) -> str:
     _create_corpus()
     corpus = _load_corpus()
+    report.get("corpus").count(records=len(corpus))
+    key = stage_key(corpus)
+    if not store.has("corpus", key):
+        store.write("corpus", key, {"records": ({"label": el} for el in corpus)})
+    return key
 
-    file_paths = _download_current_gov_data(sample_size=SAMPLE_SIZE)
 
-    parser = Parser(current_cities=CURRENT_CITIES_PATH)
+def _stage_download(store: StageStore, report: RunReport) -> str:
+    content_hashes = _download_current_gov_data(
+        sample_size=SAMPLE_SIZE, metrics=report.get("download")
+    )
+    report.get("download").count(records=len(content_hashes))
+    key = stage_key(sorted(content_hashes.items()))
+    if not store.has("download", key):
+        store.write(
+            "download",
+            key,
+            {
+                "records": (
+                    {"file_path": file_path, "content_hash": content_hash}
+                    for file_path, content_hash in content_hashes.items()
+                )
+            },
+        )
+    return key
+
+
+def _stage_parse(store: StageStore, download_key: str, report: RunReport) -> str:
+    parser = PARSER_ENGINES[PARSER_ENGINE](current_cities=CURRENT_CITIES_PATH)
+    parser.get_themes()
+    key = stage_key(download_key, parser.cache_version())
+    if store.has("parse", key):
+        logger.info(msg="SKIP PARSING, THE FILES DID NOT CHANGE")
+        return key
 
+    file_paths = [el["file_path"] for el in store.read("download", download_key)]
     logger.info(msg=f"PARSING {len(file_paths)} FILES")
 
-    all_data = parser.parse_data_parallel(file_paths=file_paths, batch_size=5)
+    n_parsed = 0
+    with store.writer("parse", key) as writer:
+        for x in parser.iter_parse_data(file_paths=file_paths, cache_path=PARSE_CACHE):
+            n_parsed += 1
+            if str(x["city"]) != "nan":
+                writer.write([x])
+    n_filtered = n_parsed - writer.counts["records"]
 
-    logger.info(msg=f"PARSED {len(all_data)} files.")
-    data = [x for x in all_data if str(x["city"]) != "nan"]
-    logger.info(
-        msg=f"FILTERED OUT {len(all_data) - len(data)} ENTRIES DUE TO MISSING CITIES"
+    logger.info(msg=f"PARSED {n_parsed} files.")
+    logger.info(msg=f"FILTERED OUT {n_filtered} ENTRIES DUE TO MISSING CITIES")
+    report.get("parse").count(
+        records=n_parsed,
+        bytes_read=parser.bytes_parsed,
+    )
+    report.get("parse").counters["parse_cache_hit_rate"] = hit_rate(
+        parser.cache_hits, parser.cache_misses
     )
+    report.get("parse").counters["filtered_out_without_city"] = n_filtered
+    return key
 
-    logger.info(msg="ENRICH DATA")
-    bert_sim = BertSim(model=MODEL_PATH, corpus=corpus)
-    for el in tqdm(data):
-        prediction = bert_sim.predict([el["dct:title"]])
-        el["thema"] = prediction[0]["prediction"].split("-")[0].rstrip()
-        el["bezeichnung"] = prediction[0]["prediction"].split("-", 1)[1].lstrip()
+
+def _stage_enrich(
+    store: StageStore, corpus_key: str, parse_key: str, report: RunReport
+) -> str:
+    model = MODEL_PATH if ENCODER_BACKEND == "torch" else ONNX_MODEL_PATH
+    previous_path = os.path.join(OUTPUT_PATH, CATALOGUE_FILE)
+    incremental = INCREMENTAL_UPDATE and os.path.exists(previous_path)
+    # only the encoder is loaded for the key, a skipped stage neither encodes
+    # the corpus nor starts the encoder workers. The fingerprint of the
+    # weights reruns the stage if the model changed without new revision. The
+    # previous catalogue is only a lookup cache of predictions and is not part
+    # of the key, otherwise every save would invalidate the next enrichment
+    encoder = load_encoder(model, ENCODER_BACKEND)
+    key = stage_key(
+        parse_key,
+        corpus_key,
+        model,
+        MODEL_REVISION,
+        model_fingerprint(encoder).hex(),
+        ENCODER_BACKEND,
+        INDEX_DTYPE,
+        SONSTIGES_THRESHOLD,
+        LOW_CONFIDENCE_SCORE,
+        LOW_CONFIDENCE_MARGIN,
+        INCREMENTAL_UPDATE,
+    )
+    if store.has("enrich", key):
+        logger.info(msg="SKIP ENRICHMENT, RECORDS AND MODEL DID NOT CHANGE")
+        return key
+
+    bert_sim = BertSim(
+        model=model,
+        corpus=[el["label"] for el in store.read("corpus", corpus_key)],
+        revision=MODEL_REVISION,
+        embedding_cache_dir=CORPUS_EMBEDDINGS_CACHE,
+        memo_path=PREDICTION_MEMO,
+        index_dtype=INDEX_DTYPE,
+        token_budget=TOKEN_BUDGET,
+        n_workers=ENCODER_WORKERS,
+        backend=ENCODER_BACKEND,
+        encoder=encoder,
+    )
+    prediction_version = stage_key(
+        bert_sim.corpus_cache_key(), INDEX_DTYPE, SONSTIGES_THRESHOLD
+    )
+    previous = {}
+    if incremental:
+        previous = load_previous_predictions(previous_path, prediction_version)
+        logger.info(msg=f"LOADED {len(previous)} ENTRIES OF {previous_path}")
+    with store.writer("enrich", key) as writer:
+        for batch, queue in _enrich_data(
+            data=store.read("parse", parse_key),
+            bert_sim=bert_sim,
+            batch_size=ENRICHMENT_BATCH_SIZE,
+            previous=previous,
+        ):
+            writer.write(batch)
+            writer.write(queue, "low_confidence")
+        writer.write([{"prediction_version": prediction_version}], "meta")
+    memo = bert_sim.prediction_memo
+    logger.info(msg=f"REUSED {memo.hits} PREDICTIONS FROM {PREDICTION_MEMO}")
+    bert_sim.close()
+
+    enrich = report.get("enrich")
+    enrich.count(
+        records=writer.counts["records"],
+        bytes_read=os.path.getsize(store.path("parse", parse_key)),
+    )
+    enrich.counters["prediction_memo_hit_rate"] = hit_rate(memo.hits, memo.misses)
+    if bert_sim.query_cache is not None:
+        enrich.counters["query_cache_hit_rate"] = hit_rate(
+            bert_sim.query_cache.hits, bert_sim.query_cache.misses
+        )
+    for name in ["encode", "search"]:
+        report.get(name).seconds += bert_sim.timings[name]
+        report.get(name).count(records=memo.misses)
+    return key
+
+
+def _stage_save(store: StageStore, enrich_key: str, report: RunReport) -> str:
+    key = stage_key(enrich_key, OUTPUT_PATH, EXPORT_FORMATS)
+    if store.has("save", key):
+        logger.info(msg=f"SKIP SAVING, {OUTPUT_PATH} IS UP TO DATE")
+        return key
 
     logger.info(msg=f"SAVE DATA IN {OUTPUT_PATH}")
-    if not os.path.exists(OUTPUT_PATH):
-        Path("extraction/musterdatenkatalog").mkdir(parents=True, exist_ok=True)
+    Path(OUTPUT_PATH).mkdir(parents=True, exist_ok=True)
 
-    pd.DataFrame(data).to_excel(
-        os.path.join(OUTPUT_PATH, "musterdatenkatalog.xlsx"), index=False
+    catalogue_path = os.path.join(OUTPUT_PATH, CATALOGUE_FILE)
+    (meta,) = store.read("enrich", enrich_key, "meta")
+    n_records = write_catalogue(
+        store.read("enrich", enrich_key),
+        catalogue_path,
+        metadata={PREDICTION_VERSION: meta["prediction_version"]},
     )
-    pd.DataFrame(data).to_csv(
-        os.path.join(OUTPUT_PATH, "musterdatenkatalog.csv"), index=False
+    logger.info(msg=f"WROTE {n_records} ENTRIES TO {catalogue_path}")
+    exports = export_catalogue(
+        catalogue_path, output_dir=OUTPUT_PATH, formats=EXPORT_FORMATS
+    )
+    queue_path = os.path.join(OUTPUT_PATH, LOW_CONFIDENCE_FILE)
+    # the header is written first, so an empty queue has one as well
+    pd.DataFrame(columns=LOW_CONFIDENCE_COLUMNS).to_csv(queue_path, index=False)
+    for batch in iter_chunks(
+        store.read("enrich", enrich_key, "low_confidence"), ENRICHMENT_BATCH_SIZE
+    ):
+        pd.DataFrame(batch, columns=LOW_CONFIDENCE_COLUMNS).to_csv(
+            queue_path, mode="a", header=False, index=False
+        )
+    store.write(
+        "save",
+        key,
+        {
+            "records": [{"output_path": OUTPUT_PATH}],
+            OUTPUTS: describe_outputs([catalogue_path, queue_path, *exports]),
+        },
     )
-    return data
+
+    save = report.get("save")
+    save.count(
+        records=n_records,
+        bytes_read=os.path.getsize(store.path("enrich", enrich_key)),
+    )
+    save.counters["bytes_written"] = os.path.getsize(catalogue_path)
+    return key
+
+
+def _write_run_report(report: RunReport) -> None:
+    """writes the report of this run next to the output and appends it to the
+    history of all runs"""
+    Path(OUTPUT_PATH).mkdir(parents=True, exist_ok=True)
+    report.write(os.path.join(OUTPUT_PATH, RUN_REPORT_FILE))
+    with open(os.path.join(OUTPUT_PATH, RUN_REPORT_HISTORY), "a") as fp:
+        fp.write(json.dumps(report.to_dict()) + "\n")
+    logger.info(msg=f"RUN REPORT IN {os.path.join(OUTPUT_PATH, RUN_REPORT_FILE)}")
+
+
+def _resume(store: StageStore, stage: str) -> str:
+    key = store.latest(stage)
+    if key is None:
+        raise ValueError(f"stage {stage} never finished, run the pipeline from it")
+    logger.info(msg=f"REUSE THE LAST RUN OF STAGE {stage.upper()}")
+    return key
+
+
+def main(from_stage: Union[str, None] = None, until_stage: Union[str, None] = None):
+    """runs the stages of the pipeline. Stages before from_stage reuse their
+    last artifacts, stages after until_stage are not run and stages whose
+    inputs did not change are skipped
+
+    Parameters
+    ----------
+    from_stage : Union[str, None], optional
+        first stage to run, by default the first stage
+    until_stage : Union[str, None], optional
+        last stage to run, by default the last stage
+
+    Returns
+    -------
+    Dict[str, str]
+        keys of the stages that were run or reused
+    """
+    logger.info(msg="***START PIPELINE***")
+    stages = select_stages(from_stage=from_stage, until_stage=until_stage)
+    store = StageStore(STAGE_DIR)
+    report = RunReport()
+    run = {
+        "corpus": lambda keys: _stage_corpus(store, report=report),
+        "download": lambda keys: _stage_download(store, report=report),
+        "parse": lambda keys: _stage_parse(store, keys["download"], report=report),
+        "enrich": lambda keys: _stage_enrich(
+            store, keys["corpus"], keys["parse"], report=report
+        ),
+        "save": lambda keys: _stage_save(store, keys["enrich"], report=report),
+    }
+    keys: Dict[str, str] = {}
+    try:
+        for stage in STAGES:
+            if stage in stages:
+                logger.info(msg=f"STAGE {stage.upper()}")
+                with report.stage(stage):
+                    keys[stage] = run[stage](keys)
+            elif STAGES.index(stage) < STAGES.index(stages[0]):
+                keys[stage] = _resume(store, stage)
+    finally:
+        _write_run_report(report)
+    logger.info(msg="***END PIPELINE***")
+    return keys
 
 
 if __name__ == "__main__":
-    main()
-if __name__ == "__main__":
-    main()
-if __name__ == "__main__":
-    main()
+    argument_parser = argparse.ArgumentParser(
+        description="Extracts the Musterdatenkatalog from GovData"
+    )
+    argument_parser.add_argument("--from-stage", choices=STAGES, default=None)
+    argument_parser.add_argument("--until-stage", choices=STAGES, default=None)
+    argument_parser.add_argument(
+        "--export",
+        nargs="*",
+        choices=EXPORTS,
+        default=EXPORT_FORMATS,
+        help="derived exports of the parquet catalogue",
+    )
+    args = argument_parser.parse_args()
+    EXPORT_FORMATS = args.export
+    main(from_stage=args.from_stage, until_stage=args.until_stage)
@@ -0,0 +1,24 @@
+"""Pipeline component: memo of the predictions of bert_sim.py by normalized
+title. Recently used titles are kept in a bounded LRU, optionally backed by
+sqlite so the predictions are reused in the next run"""
+
+from typing import Tuple
+
+from src.components.sqlite_lru import SqliteLRU
+
+
+class PredictionMemo(SqliteLRU):
+    """title -> (label, score, margin) memo. Entries of other versions are removed
+    when the sqlite file is opened, the version changes with model and corpus.
+    Memo files without margins are older than the thresholding and are
+    dropped"""
+
+    table = "predictions"
+    key_column = "title"
+    value_columns = [("label", "TEXT"), ("score", "REAL"), ("margin", "REAL")]
+
+    def _to_row(self, value: Tuple[str, float, float]) -> Tuple:
+        return tuple(value)
+
+    def _from_row(self, row: Tuple) -> Tuple[str, float, float]:
+        return tuple(row)
@@ -0,0 +1,34 @@
+"""Pipeline component: cache of the query embeddings of bert_sim.py by
+normalized text. Recently used embeddings are kept in a bounded LRU,
+optionally backed by sqlite so reruns and repeated evaluations do not
+tokenize and encode the same titles again"""
+
+from typing import Dict, Tuple
+
+import numpy as np
+
+from src.components.sqlite_lru import SqliteLRU
+
+
+class QueryEmbeddingCache(SqliteLRU):
+    """text -> normalized float32 embedding. The version changes with model,
+    revision and backend, entries of other versions are removed when the
+    sqlite file is opened"""
+
+    table = "embeddings"
+    key_column = "text"
+    value_columns = [("embedding", "BLOB")]
+
+    def _to_row(self, value: np.ndarray) -> Tuple:
+        return (value.tobytes(),)
+
+    def _from_row(self, row: Tuple) -> np.ndarray:
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put_many(self, values: Dict[str, np.ndarray]) -> None:
+        super().put_many(
+            {
+                text: np.asarray(embedding, dtype=np.float32)
+                for text, embedding in values.items()
+            }
+        )
@@ -0,0 +1,115 @@
+"""Pipeline component: timers, counters and memory of the pipeline stages.
+The metrics of a run are written as a JSON run report next to the output,
+so runs can be compared with each other"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Union
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def max_rss_mb() -> Dict[str, Union[float, None]]:
+    """highest resident memory so far of the process and of its largest
+    finished child process in MB. Both are high-water marks of the whole run,
+    a stage only shows a higher value than the stages before if it raised
+    the maximum. None where the resource module is missing"""
+    if resource is None:
+        return {"process_max_rss_mb_so_far": None, "children_max_rss_mb_so_far": None}
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    unit = 1024**2 if sys.platform == "darwin" else 1024
+    return {
+        "process_max_rss_mb_so_far": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, 1
+        ),
+        "children_max_rss_mb_so_far": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit, 1
+        ),
+    }
+
+
+def hit_rate(hits: int, misses: int) -> Union[float, None]:
+    return round(hits / (hits + misses), 4) if hits + misses else None
+
+
+class StageMetrics:
+    """duration, processed records, read bytes and counters of one stage"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.records = 0
+        self.bytes_read = 0
+        self.counters: Dict[str, Union[int, float, None]] = {}
+        self.max_rss_mb: Dict[str, Union[float, None]] = {}
+
+    def count(self, records: int = 0, bytes_read: int = 0) -> None:
+        self.records += records
+        self.bytes_read += bytes_read
+
+    def to_dict(self) -> Dict:
+        return {
+            "seconds": round(self.seconds, 3),
+            "records": self.records,
+            "records_per_second": round(self.records / self.seconds, 1)
+            if self.seconds
+            else None,
+            "bytes_read": self.bytes_read,
+            **self.max_rss_mb,
+            **self.counters,
+        }
+
+
+class RunReport:
+    """metrics of the stages of one pipeline run in the order they were
+    recorded"""
+
+    def __init__(self) -> None:
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.start = time.perf_counter()
+        self.stages: Dict[str, StageMetrics] = {}
+
+    def get(self, name: str) -> StageMetrics:
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """times the block and records the maximum memory so far after it
+
+        Parameters
+        ----------
+        name : str
+            name of the stage, blocks with the same name are added up
+
+        Yields
+        ------
+        StageMetrics
+            metrics to count records, bytes and cache hits on
+        """
+        metrics = self.get(name)
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics.seconds += time.perf_counter() - start
+            metrics.max_rss_mb = max_rss_mb()
+
+    def to_dict(self) -> Dict:
+        return {
+            "started_at": self.started_at,
+            "seconds": round(time.perf_counter() - self.start, 3),
+            **max_rss_mb(),
+            "stages": {name: el.to_dict() for name, el in self.stages.items()},
+        }
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2)
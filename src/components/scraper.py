@@ -1,21 +1,29 @@
 """Pipeline component: scrapes data from gov data"""
 
+import asyncio
 import datetime
+import importlib.util
 import logging
 import os
 import random
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Union
+from urllib.parse import urlencode
 
 import httpx
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from src.components.manifest import DatasetManifest, get_content_hash
+from src.components.storage import ResponseStore, get_store
 from src.settings import Settings
 from src.utils.data import chunks
 
 settings = Settings(_env_file="paths/.env.dev")
 
+if not os.path.exists("docs"):
+    Path("docs").mkdir(parents=True, exist_ok=True)
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -31,10 +39,17 @@ logger = logging.getLogger(name=__name__)
 
 
 class Scraper:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        current_dataset_url: str = "https://ckan.govdata.de/api/3/action",
+        dataset_url: str = "https://www.govdata.de/ckan/dataset",
+    ) -> None:
         self.current_dataset_list: List = []
-        self.current_dataset_url = "https://ckan.govdata.de/api/3/action"
-        self.dataset_url = "https://www.govdata.de/ckan/dataset"
+        self.current_dataset_url = current_dataset_url
+        self.dataset_url = dataset_url
+        # content bytes of the responses saved by this scraper, responses saved
+        # in the worker processes of scrape_parallel are not counted
+        self.bytes_downloaded = 0
 
     def _request(self, url: str) -> httpx.Response:
         """get result of response
@@ -84,6 +99,7 @@ class Scraper:
         for el in dataset_response:
             self.current_dataset_list.append(el)
         now = datetime.datetime.now()
+        Path("extraction/musterdatenkatalog").mkdir(parents=True, exist_ok=True)
         output_file_path = os.path.join(
             "extraction",
             "musterdatenkatalog",
@@ -94,24 +110,166 @@ class Scraper:
             for item in self.current_dataset_list:
                 file.write(f"{item}\n")
 
-    def save_response(self, resp: httpx.Response, file_directory: str) -> None:
-        """save responses as json in a new folder
+    def get_modified_datasets(
+        self, since: Union[str, None] = None, rows: int = 1000
+    ) -> Dict[str, str]:
+        """pages through package_search sorted by modification date and
+        collects the datasets modified since the given timestamp
 
         Parameters
         ----------
-        path : str
-            path to save response
+        since : Union[str, None], optional
+            metadata_modified timestamp of the last sync, if None all datasets
+            are returned, by default None
+        rows : int, optional
+            page size of package_search, by default 1000
+
+        Returns
+        -------
+        Dict[str, str]
+            dataset names with their metadata_modified timestamp
         """
-        file_name = resp.url.path.split("/")[-1].split(".")[0] + ".xml"
-        Path(file_directory).mkdir(parents=True, exist_ok=True)
-        file_path = os.path.join(file_directory, file_name)
+        modified_datasets: Dict[str, str] = {}
+        start = 0
+        while True:
+            params = {
+                "q": "*:*",
+                "sort": "metadata_modified desc",
+                "rows": rows,
+                "start": start,
+                "fl": "name,metadata_modified",
+            }
+            if since:
+                params["fq"] = f"metadata_modified:[{since.rstrip('Z')}Z TO *]"
+            result = self._request(
+                url=f"{self.current_dataset_url}/package_search?{urlencode(params)}"
+            ).json()["result"]
+            for dataset in result["results"]:
+                modified_datasets[dataset["name"]] = dataset["metadata_modified"]
+            start += rows
+            if len(result["results"]) < rows or start >= result["count"]:
+                break
+        return modified_datasets
+
+    def sync_incremental(
+        self,
+        file_directory: str,
+        manifest: DatasetManifest,
+        max_concurrency: int = 32,
+    ) -> Dict[str, List]:
+        """downloads only new and changed datasets. The metadata_modified
+        timestamp of each downloaded dataset is recorded in the manifest and
+        compared with GovData on the next sync. Datasets without known
+        timestamp count as current if they were downloaded after their last
+        modification
+
+        Parameters
+        ----------
+        file_directory : str
+            directory for saving files
+        manifest : DatasetManifest
+            manifest of the downloaded datasets, an empty manifest is filled
+            with the files of the response folder
+        max_concurrency : int, optional
+            maximum number of requests in flight, by default 32
+
+        Returns
+        -------
+        Dict[str, List]
+            names of the downloaded datasets and of the datasets which are
+            in the manifest but not on GovData anymore
+        """
+        if len(manifest) == 0:
+            manifest.rebuild_from_store(get_store(file_directory))
+
+        modified_datasets = self.get_modified_datasets(since=manifest.last_sync)
+        logger.info(f"{len(modified_datasets)} datasets modified since last sync")
+
+        known_datasets = manifest.get(modified_datasets)
+        changed_datasets = []
+        for dataset_name, metadata_modified in modified_datasets.items():
+            known_dataset = known_datasets.get(dataset_name)
+            if known_dataset is not None:
+                if known_dataset["metadata_modified"] == metadata_modified:
+                    continue
+                if known_dataset["metadata_modified"] is None and known_dataset[
+                    "downloaded_at"
+                ] >= metadata_modified.rstrip("Z"):
+                    manifest.set_modified(dataset_name, metadata_modified)
+                    continue
+            changed_datasets.append(dataset_name)
+
+        self.current_dataset_list = []
+        self.get_current_dataset_list()
+        current_dataset_list = self.current_dataset_list
+        downloaded = []
+        if changed_datasets:
+            downloaded = self.scrape_async(
+                file_directory=file_directory,
+                current_dataset_list=changed_datasets,
+                max_concurrency=max_concurrency,
+                overwrite=True,
+                manifest=manifest,
+            )
+            self.current_dataset_list = current_dataset_list
+        for dataset_name in downloaded:
+            manifest.set_modified(dataset_name, modified_datasets[dataset_name])
+
+        deleted = sorted(manifest.extra(current_dataset_list))
+        if deleted:
+            logger.info(
+                f"{len(deleted)} datasets of the manifest were deleted on GovData: {deleted}"  # noqa: E501
+            )
+        manifest.mark_deleted(deleted)
+        failed = set(changed_datasets).difference(downloaded)
+        if failed:
+            # failed datasets are requested again on the next sync
+            manifest.last_sync = min([modified_datasets[el] for el in failed])
+        elif modified_datasets:
+            manifest.last_sync = max(
+                [manifest.last_sync or ""] + list(modified_datasets.values())
+            )
+        manifest.commit()
+        return {"downloaded": downloaded, "deleted": deleted}
+
+    def save_response(
+        self,
+        resp: httpx.Response,
+        file_directory: str,
+        overwrite: bool = False,
+        store: Union[ResponseStore, None] = None,
+    ) -> Union[str, None]:
+        """save responses in the response store of the folder
+
+        Parameters
+        ----------
+        resp : httpx.Response
+            response of the dataset request
+        file_directory : str
+            folder of the response store
+        overwrite : bool, optional
+            replace an existing file, by default False
+        store : Union[ResponseStore, None], optional
+            response store of the folder, resolve it once per scrape and pass
+            it in to not read the layout of the folder for every response,
+            by default resolved from file_directory
+
+        Returns
+        -------
+        Union[str, None]
+            path of the saved file, None if the file already existed
+        """
+        dataset_name = resp.url.path.split("/")[-1].split(".")[0]
+        store = store or get_store(file_directory)
+        self.bytes_downloaded += len(resp.content)
 
-        if not os.path.isfile(file_path):
-            with open(file=file_path, mode="w") as fp:
-                fp.write(resp.text)
-            logger.info(f"Dataset {file_name} is successfully downloaded")
+        if overwrite or not store.exists(dataset_name):
+            file_path = store.write(dataset_name, resp.content)
+            logger.info(f"Dataset {dataset_name} is successfully downloaded")
+            return file_path
         else:
-            logger.info(msg=f"Dataset {file_name} already exists.")
+            logger.info(msg=f"Dataset {dataset_name} already exists.")
+            return None
 
     def scrape(
         self,
@@ -130,22 +288,29 @@ class Scraper:
             sample size of current dataset, by default -1
         """
         self.get_current_dataset_list(sample_size=sample_size)
+        store = get_store(file_directory)
         for dataset_name in self.current_dataset_list:
             self.save_response(
                 resp=self._request(url=f"{self.dataset_url}/{dataset_name}.rdf"),
                 file_directory=file_directory,
+                store=store,
             )
 
     def _batch_process(
         self,
         batch: List,
         file_directory: str,
-    ) -> None:
+    ) -> List:
+        saved = []
+        store = get_store(file_directory)
         for dataset_name in batch:
-            self.save_response(
-                resp=self._request(url=f"{self.dataset_url}/{dataset_name}.rdf"),
-                file_directory=file_directory,
+            resp = self._request(url=f"{self.dataset_url}/{dataset_name}.rdf")
+            file_path = self.save_response(
+                resp=resp, file_directory=file_directory, store=store
             )
+            if file_path is not None:
+                saved.append((dataset_name, file_path, get_content_hash(resp.content)))
+        return saved
 
     def scrape_parallel(
         self,
@@ -153,19 +318,200 @@ class Scraper:
         sample_size: int = -1,
         batch_size=1000,
         current_dataset_list: List = None,
+        manifest: Union[DatasetManifest, None] = None,
     ) -> None:
         if current_dataset_list:
             self.current_dataset_list = current_dataset_list
         else:
             self.get_current_dataset_list(sample_size=sample_size)
-        self.current_dataset_list = [
-            el
-            for el in self.current_dataset_list
-            if not os.path.isfile(os.path.join(file_directory, f"{el}.xml"))
-        ]
+        self.current_dataset_list = self._filter_downloaded(
+            self.current_dataset_list, file_directory, manifest
+        )
         batches = [chunk for chunk in chunks(self.current_dataset_list, batch_size)]
 
-        Parallel(n_jobs=-1)(
+        saved_per_batch = Parallel(n_jobs=-1)(
             delayed(self._batch_process)(batch, file_directory)
             for batch in tqdm(batches)
         )
+        if manifest is not None:
+            for saved in saved_per_batch:
+                for dataset_name, file_path, content_hash in saved:
+                    manifest.record_download(dataset_name, file_path, content_hash)
+            manifest.commit()
+
+    def _filter_downloaded(
+        self,
+        dataset_names: List,
+        file_directory: str,
+        manifest: Union[DatasetManifest, None],
+    ) -> List:
+        """removes datasets which are already downloaded, looked up in the
+        manifest if given and otherwise in the response folder. Datasets of the
+        manifest whose file is missing in the folder are downloaded again"""
+        store = get_store(file_directory)
+        if manifest is not None:
+            return manifest.missing(dataset_names) + manifest.lost(dataset_names, store)
+        return [el for el in dataset_names if not store.exists(el)]
+
+    async def _download_async(
+        self,
+        client: httpx.AsyncClient,
+        queue: asyncio.Queue,
+        file_directory: str,
+        progress_bar: tqdm,
+        overwrite: bool,
+        downloaded: List,
+        manifest: Union[DatasetManifest, None],
+        store: Union[ResponseStore, None] = None,
+    ) -> None:
+        """worker coroutine, downloads datasets from the queue until it is empty.
+        Each worker holds at most one request in flight
+
+        Parameters
+        ----------
+        client : httpx.AsyncClient
+            shared client with the connection pool
+        queue : asyncio.Queue
+            dataset names to be downloaded
+        file_directory : str
+            directory for saving files
+        progress_bar : tqdm
+            progress bar updated after each dataset
+        overwrite : bool
+            replace existing files
+        downloaded : List
+            names of successfully downloaded datasets are appended
+        manifest : Union[DatasetManifest, None]
+            manifest in which the downloads are recorded
+        store : Union[ResponseStore, None], optional
+            response store of the folder, by default resolved from
+            file_directory
+        """
+        while not queue.empty():
+            dataset_name = queue.get_nowait()
+            try:
+                resp = await client.get(url=f"{self.dataset_url}/{dataset_name}.rdf")
+                resp.raise_for_status()
+                file_path = self.save_response(
+                    resp=resp,
+                    file_directory=file_directory,
+                    overwrite=overwrite,
+                    store=store,
+                )
+                if file_path is not None and manifest is not None:
+                    manifest.record_download(
+                        dataset_name, file_path, get_content_hash(resp.content)
+                    )
+                downloaded.append(dataset_name)
+            except httpx.HTTPError as e:
+                logger.error(f"Dataset {dataset_name} could not be downloaded: {e}")
+            finally:
+                progress_bar.update(1)
+
+    async def _scrape_async(
+        self,
+        dataset_names: List,
+        file_directory: str,
+        max_concurrency: int,
+        http2: bool,
+        timeout: float,
+        overwrite: bool,
+        manifest: Union[DatasetManifest, None],
+    ) -> List:
+        downloaded: List = []
+        store = get_store(file_directory)
+        queue: asyncio.Queue = asyncio.Queue()
+        for dataset_name in dataset_names:
+            queue.put_nowait(dataset_name)
+        limits = httpx.Limits(
+            max_connections=max_concurrency, max_keepalive_connections=max_concurrency
+        )
+        async with httpx.AsyncClient(
+            http2=http2, limits=limits, timeout=timeout
+        ) as client:
+            with tqdm(total=len(dataset_names)) as progress_bar:
+                await asyncio.gather(
+                    *[
+                        self._download_async(
+                            client=client,
+                            queue=queue,
+                            file_directory=file_directory,
+                            progress_bar=progress_bar,
+                            overwrite=overwrite,
+                            downloaded=downloaded,
+                            manifest=manifest,
+                            store=store,
+                        )
+                        for _ in range(min(max_concurrency, len(dataset_names)))
+                    ]
+                )
+        if manifest is not None:
+            manifest.commit()
+        return downloaded
+
+    def scrape_async(
+        self,
+        file_directory: str,
+        sample_size: int = -1,
+        max_concurrency: int = 32,
+        current_dataset_list: Union[List, None] = None,
+        http2: bool = True,
+        timeout: float = 30.0,
+        overwrite: bool = False,
+        manifest: Union[DatasetManifest, None] = None,
+    ) -> List:
+        """scrapes the data with asyncio over one shared connection pool. The
+        number of requests in flight is bounded by max_concurrency, so the
+        crawl is limited by bandwidth and not by the number of processes
+
+        Parameters
+        ----------
+        file_directory : str
+            directory for saving files
+        sample_size : int, optional
+            sample size of current dataset, by default -1
+        max_concurrency : int, optional
+            maximum number of requests in flight, by default 32
+        current_dataset_list : Union[List, None], optional
+            dataset names to download, if not set the current dataset list is
+            requested from GovData, by default None
+        http2 : bool, optional
+            use HTTP/2 if the h2 package is installed, by default True
+        timeout : float, optional
+            timeout per request in seconds, by default 30.0
+        overwrite : bool, optional
+            download datasets even if the file already exists, by default False
+        manifest : Union[DatasetManifest, None], optional
+            manifest in which the downloads are recorded and which is used to
+            skip downloaded datasets, by default None
+
+        Returns
+        -------
+        List
+            names of the successfully downloaded datasets
+        """
+        if current_dataset_list:
+            self.current_dataset_list = current_dataset_list
+        else:
+            self.get_current_dataset_list(sample_size=sample_size)
+        if overwrite:
+            dataset_names = list(self.current_dataset_list)
+        else:
+            dataset_names = self._filter_downloaded(
+                self.current_dataset_list, file_directory, manifest
+            )
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.info("The h2 package is not installed. Falling back to HTTP/1.1")
+            http2 = False
+        Path(file_directory).mkdir(parents=True, exist_ok=True)
+        return asyncio.run(
+            self._scrape_async(
+                dataset_names=dataset_names,
+                file_directory=file_directory,
+                max_concurrency=max_concurrency,
+                http2=http2,
+                timeout=timeout,
+                overwrite=overwrite,
+                manifest=manifest,
+            )
+        )
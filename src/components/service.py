@@ -0,0 +1,337 @@
+"""Pipeline component: local HTTP service which classifies titles with a warm
+BertSim. Concurrent requests are collected for a few milliseconds and
+predicted in one batch.
+
+Start of the service:
+python -m src.components.service --port 8080
+
+Endpoints:
+POST /predict        {"titles": [...]}
+POST /predict_top_k  {"titles": [...], "k": 5, "hierarchical": false}
+GET  /health
+GET  /metrics
+"""
+
+import argparse
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.components.bert_sim import BertSim
+
+logger = logging.getLogger(name=__name__)
+
+MAX_WAIT_MS = 5
+MAX_BATCH_SIZE = 256
+
+
+class Metrics:
+    """request counters and latencies of the last requests"""
+
+    def __init__(self, window: int = 10_000) -> None:
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.titles = 0
+        self.batches = 0
+        self.batched_titles = 0
+        self.latencies: deque = deque(maxlen=window)
+
+    def record_request(self, n_titles: int, latency: float, error: bool) -> None:
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.titles += n_titles
+            self.latencies.append(latency)
+
+    def record_batch(self, n_titles: int) -> None:
+        with self.lock:
+            self.batches += 1
+            self.batched_titles += n_titles
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            percentiles = {
+                f"latency_p{p}_ms": round(float(np.percentile(latencies, p)), 2)
+                if len(latencies)
+                else None
+                for p in [50, 95, 99]
+            }
+            return {
+                "uptime_s": round(time.time() - self.started_at, 1),
+                "requests": self.requests,
+                "errors": self.errors,
+                "titles": self.titles,
+                "batches": self.batches,
+                "mean_batch_size": round(self.batched_titles / self.batches, 2)
+                if self.batches
+                else None,
+                **percentiles,
+            }
+
+
+class MicroBatcher:
+    """collects the titles of concurrent requests for at most max_wait_ms and
+    predicts them with one BertSim call per prediction mode"""
+
+    def __init__(
+        self,
+        bert_sim: BertSim,
+        max_wait_ms: float = MAX_WAIT_MS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        metrics: Metrics = None,
+    ) -> None:
+        self.bert_sim = bert_sim
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics or Metrics()
+        self.requests: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, titles: List[str], mode: Tuple = ("predict",)) -> Future:
+        """queues the titles of one request
+
+        Parameters
+        ----------
+        titles : List[str]
+            titles to classify
+        mode : Tuple, optional
+            ("predict",) or ("top_k", k, hierarchical), by default
+            ("predict",)
+
+        Returns
+        -------
+        Future
+            resolves to one result per title
+        """
+        future: Future = Future()
+        self.requests.put((titles, mode, future))
+        return future
+
+    def close(self) -> None:
+        self.requests.put(None)
+        self.thread.join()
+
+    def _collect(self, first) -> List:
+        batch = [first]
+        n_titles = len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+        while n_titles < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            batch.append(request)
+            n_titles += len(request[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+            by_mode: Dict[Tuple, List] = {}
+            for request in self._collect(first):
+                by_mode.setdefault(request[1], []).append(request)
+            for mode, requests in by_mode.items():
+                self._predict(mode, requests)
+
+    def _predict(self, mode: Tuple, requests: List) -> None:
+        titles = [title for request in requests for title in request[0]]
+        try:
+            if mode[0] == "top_k":
+                results = self.bert_sim.predict_top_k(
+                    titles,
+                    k=mode[1],
+                    batch_size=self.max_batch_size,
+                    hierarchical=mode[2],
+                )
+            else:
+                results = self.bert_sim.predict(titles, batch_size=self.max_batch_size)
+        except Exception as e:
+            logger.exception("prediction of a batch failed")
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+        self.metrics.record_batch(len(titles))
+        start = 0
+        for request_titles, _, future in requests:
+            end = start + len(request_titles)
+            future.set_result(results[start:end])
+            start = end
+
+
+def _json_safe(value):
+    """NaN margins become null, json has no NaN"""
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {key: _json_safe(el) for key, el in value.items()}
+    if isinstance(value, list):
+        return [_json_safe(el) for el in value]
+    return value
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """json endpoints of the classification service"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        logger.debug(format % args)
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            bert_sim = self.server.batcher.bert_sim
+            self._send(
+                200,
+                {
+                    "status": "ok",
+                    "model": bert_sim.model_name,
+                    "backend": bert_sim.backend,
+                    "corpus_size": len(bert_sim.corpus),
+                },
+            )
+        elif self.path == "/metrics":
+            self._send(200, self.server.metrics.to_dict())
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        start = time.perf_counter()
+        titles: List = []
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            titles = body["titles"]
+            if not isinstance(titles, list):
+                raise ValueError("titles must be a list")
+            if self.path == "/predict":
+                mode: Tuple = ("predict",)
+            elif self.path == "/predict_top_k":
+                mode = ("top_k", int(body.get("k", 5)), bool(body.get("hierarchical")))
+            else:
+                self._send(404, {"error": f"unknown path {self.path}"})
+                return
+        except (KeyError, TypeError, ValueError) as e:
+            self.server.metrics.record_request(0, time.perf_counter() - start, True)
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            results = self.server.batcher.submit(titles, mode).result()
+        except Exception as e:
+            self.server.metrics.record_request(
+                len(titles), time.perf_counter() - start, True
+            )
+            self._send(500, {"error": str(e)})
+            return
+        self.server.metrics.record_request(
+            len(titles), time.perf_counter() - start, False
+        )
+        self._send(200, {"predictions": results})
+
+    def _send(self, status: int, payload: Dict) -> None:
+        body = json.dumps(_json_safe(payload)).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(
+    bert_sim: BertSim,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    max_wait_ms: float = MAX_WAIT_MS,
+    max_batch_size: int = MAX_BATCH_SIZE,
+) -> ThreadingHTTPServer:
+    """creates the http server with a micro batcher around the BertSim
+
+    Parameters
+    ----------
+    bert_sim : BertSim
+        warm classifier
+    host : str, optional
+        host to bind, by default "127.0.0.1"
+    port : int, optional
+        port to bind, 0 picks a free port, by default 8080
+    max_wait_ms : float, optional
+        time a batch waits for further requests, by default 5
+    max_batch_size : int, optional
+        titles after which a batch is predicted without waiting, by default 256
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        server, start it with serve_forever
+    """
+    server = ThreadingHTTPServer((host, port), ClassificationHandler)
+    server.daemon_threads = True
+    server.metrics = Metrics()
+    server.batcher = MicroBatcher(
+        bert_sim,
+        max_wait_ms=max_wait_ms,
+        max_batch_size=max_batch_size,
+        metrics=server.metrics,
+    )
+    return server
+
+
+if __name__ == "__main__":
+    from src.components import pipeline
+
+    argument_parser = argparse.ArgumentParser(
+        description="Serves the Musterdatenkatalog classifier over http"
+    )
+    argument_parser.add_argument("--host", default="127.0.0.1")
+    argument_parser.add_argument("--port", type=int, default=8080)
+    argument_parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    argument_parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    args = argument_parser.parse_args()
+
+    bert_sim = BertSim(
+        model=pipeline.MODEL_PATH
+        if pipeline.ENCODER_BACKEND == "torch"
+        else pipeline.ONNX_MODEL_PATH,
+        corpus=pipeline._load_corpus(),
+        revision=pipeline.MODEL_REVISION,
+        embedding_cache_dir=pipeline.CORPUS_EMBEDDINGS_CACHE,
+        memo_size=100_000,
+        index_dtype=pipeline.INDEX_DTYPE,
+        token_budget=pipeline.TOKEN_BUDGET,
+        backend=pipeline.ENCODER_BACKEND,
+    )
+    server = create_server(
+        bert_sim,
+        host=args.host,
+        port=args.port,
+        max_wait_ms=args.max_wait_ms,
+        max_batch_size=args.max_batch_size,
+    )
+    logger.info(f"Classification service listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        bert_sim.close()
@@ -0,0 +1,144 @@
+"""Pipeline component: bounded LRU of values by normalized text, optionally
+backed by sqlite so the values are reused in the next run. Base of the
+prediction memo and the query embedding cache of bert_sim.py"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+
+class SqliteLRU:
+    """text -> value LRU. Entries of other versions are removed when the
+    sqlite file is opened. The cache may be used from another thread than the
+    one which created it, e.g. the batching thread of service.py, a lock
+    serializes the access to entries and connection. Subclasses set the table
+    and its value columns and convert values to and from rows"""
+
+    table: str
+    key_column: str
+    # name and sqlite type of the value columns
+    value_columns: List[Tuple[str, str]]
+
+    def __init__(
+        self, version: str, path: Union[str, None] = None, max_size: int = 100_000
+    ) -> None:
+        self.version = version
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self._create_table()
+
+    def _create_table(self) -> None:
+        columns = [
+            row[1]
+            for row in self.connection.execute(f"PRAGMA table_info({self.table})")
+        ]
+        expected = [self.key_column, *[el[0] for el in self.value_columns], "version"]
+        if columns and columns != expected:
+            # files of older versions with other columns
+            self.connection.execute(f"DROP TABLE {self.table}")
+        value_columns = ", ".join(
+            f"{name} {type_}" for name, type_ in self.value_columns
+        )
+        self.connection.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                {self.key_column} TEXT PRIMARY KEY,
+                {value_columns},
+                version TEXT
+            )"""
+        )
+        self.connection.execute(
+            f"DELETE FROM {self.table} WHERE version != ?", (self.version,)
+        )
+        self.connection.commit()
+
+    def _to_row(self, value: Any) -> Tuple:
+        raise NotImplementedError
+
+    def _from_row(self, row: Tuple) -> Any:
+        raise NotImplementedError
+
+    def __enter__(self) -> "SqliteLRU":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _remember(self, text: str, value: Any) -> None:
+        self.entries[text] = value
+        self.entries.move_to_end(text)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, Any]:
+        """looks up the values of the given texts
+
+        Parameters
+        ----------
+        texts : Iterable[str]
+            normalized texts
+
+        Returns
+        -------
+        Dict[str, Any]
+            values of the texts which are in the cache
+        """
+        names = ", ".join(el[0] for el in self.value_columns)
+        found = {}
+        with self.lock:
+            for text in texts:
+                value = self.entries.get(text)
+                if value is None and self.connection is not None:
+                    row = self.connection.execute(
+                        f"SELECT {names} FROM {self.table} "
+                        f"WHERE {self.key_column} = ?",
+                        (text,),
+                    ).fetchone()
+                    value = self._from_row(row) if row is not None else None
+                if value is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._remember(text, value)
+                found[text] = value
+        return found
+
+    def put_many(self, values: Dict[str, Any]) -> None:
+        """stores the values of new texts
+
+        Parameters
+        ----------
+        values : Dict[str, Any]
+            value by normalized text
+        """
+        placeholders = ", ".join("?" * (len(self.value_columns) + 2))
+        with self.lock:
+            for text, value in values.items():
+                self._remember(text, value)
+            if self.connection is not None:
+                self.connection.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})",
+                    (
+                        (text, *self._to_row(value), self.version)
+                        for text, value in values.items()
+                    ),
+                )
+                self.connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.commit()
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,194 @@
+"""Pipeline component: checkpoints of the stages of pipeline.py. Each stage
+stores its artifacts as JSONL under a key derived from the content of its
+inputs, so a rerun skips stages whose inputs did not change and a failed run
+resumes from the last finished stage"""
+
+import glob
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Union
+
+from src.components.parse_cache import file_hash
+
+STAGES = ["corpus", "download", "parse", "enrich", "save"]
+STATE_FILE = "state.json"
+# artifact with the files a stage writes outside of the stage folder
+OUTPUTS = "outputs"
+
+
+def stage_key(*inputs) -> str:
+    """content address of a stage
+
+    Parameters
+    ----------
+    *inputs
+        json serializable inputs of the stage, e.g. keys of the previous
+        stages and settings
+
+    Returns
+    -------
+    str
+        sha1 hex digest of the inputs
+    """
+    content = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def describe_outputs(paths: Iterable[str]) -> List[Dict]:
+    """records of the OUTPUTS artifact, path and content hash of each file"""
+    return [{"path": path, "content_hash": file_hash(path)} for path in paths]
+
+
+def select_stages(
+    from_stage: Union[str, None] = None, until_stage: Union[str, None] = None
+) -> List[str]:
+    """stages between from_stage and until_stage, both included
+
+    Parameters
+    ----------
+    from_stage : Union[str, None], optional
+        first stage to run, by default the first stage
+    until_stage : Union[str, None], optional
+        last stage to run, by default the last stage
+
+    Returns
+    -------
+    List[str]
+        stages to run in order
+    """
+    for stage in [from_stage, until_stage]:
+        if stage is not None and stage not in STAGES:
+            raise ValueError(f"unknown stage {stage}, choose one of {STAGES}")
+    start = STAGES.index(from_stage) if from_stage else 0
+    end = STAGES.index(until_stage) if until_stage else len(STAGES) - 1
+    if start > end:
+        raise ValueError(f"stage {from_stage} comes after stage {until_stage}")
+    return STAGES[start : end + 1]  # noqa: E203
+
+
+class StageStore:
+    """folder with the JSONL artifacts of the stages and a state file with
+    the key of the last finished run of each stage. Only the artifacts of the
+    last run of a stage are kept"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.state_path = os.path.join(directory, STATE_FILE)
+
+    def path(self, stage: str, key: str, artifact: str = "records") -> str:
+        return os.path.join(self.directory, f"{stage}-{key}.{artifact}.jsonl")
+
+    def _state(self) -> Dict[str, str]:
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r") as fp:
+            return json.load(fp)
+
+    def latest(self, stage: str) -> Union[str, None]:
+        """key of the last finished run of the stage"""
+        return self._state().get(stage)
+
+    def has(self, stage: str, key: str) -> bool:
+        """checks if the stage finished with the given key and if the files
+        in its OUTPUTS artifact still exist unchanged"""
+        if self.latest(stage) != key or not os.path.exists(self.path(stage, key)):
+            return False
+        if not os.path.exists(self.path(stage, key, OUTPUTS)):
+            return True
+        return all(
+            os.path.exists(el["path"]) and file_hash(el["path"]) == el["content_hash"]
+            for el in self.read(stage, key, OUTPUTS)
+        )
+
+    @contextmanager
+    def writer(self, stage: str, key: str) -> Iterator["StageWriter"]:
+        """streams records into the artifacts of a stage. The files are
+        written under a temporary name and only become the artifacts of the
+        stage if the block finishes, so an interrupted stage leaves no
+        artifact behind
+
+        Parameters
+        ----------
+        stage : str
+            name of the stage
+        key : str
+            content address of the stage
+
+        Yields
+        ------
+        StageWriter
+            writer with one JSONL file per artifact
+        """
+        writer = StageWriter(lambda artifact: self.path(stage, key, artifact))
+        try:
+            yield writer
+        except BaseException:
+            writer.close(commit=False)
+            raise
+        writer.close(commit=True)
+
+        for path in glob.glob(os.path.join(self.directory, f"{stage}-*.jsonl")):
+            if not os.path.basename(path).startswith(f"{stage}-{key}."):
+                os.remove(path)
+
+        state = self._state()
+        state[stage] = key
+        with open(f"{self.state_path}.tmp", "w") as fp:
+            json.dump(state, fp, indent=2)
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    def write(self, stage: str, key: str, artifacts: Dict[str, Iterable[Dict]]) -> None:
+        """stores the artifacts of a finished stage
+
+        Parameters
+        ----------
+        stage : str
+            name of the stage
+        key : str
+            content address of the stage
+        artifacts : Dict[str, Iterable[Dict]]
+            records by artifact name, "records" is the main artifact
+        """
+        with self.writer(stage, key) as writer:
+            for artifact, records in artifacts.items():
+                writer.write(records, artifact)
+
+    def read(self, stage: str, key: str, artifact: str = "records") -> Iterator[Dict]:
+        """yields the records of an artifact of a finished stage"""
+        with open(self.path(stage, key, artifact), "r", encoding="utf-8") as fp:
+            for line in fp:
+                yield json.loads(line)
+
+
+class StageWriter:
+    """JSONL files of the artifacts of one stage run, opened on first use"""
+
+    def __init__(self, path: Callable[[str], str]) -> None:
+        self.path = path
+        self.files: Dict[str, IO] = {}
+        self.counts: Dict[str, int] = {}
+        self.write([], "records")
+
+    def write(self, records: Iterable[Dict], artifact: str = "records") -> None:
+        if artifact not in self.files:
+            self.files[artifact] = open(
+                f"{self.path(artifact)}.tmp", "w", encoding="utf-8"
+            )
+            self.counts[artifact] = 0
+        fp = self.files[artifact]
+        for record in records:
+            fp.write(json.dumps(record, ensure_ascii=False, default=str))
+            fp.write("\n")
+            self.counts[artifact] += 1
+
+    def close(self, commit: bool) -> None:
+        for artifact, fp in self.files.items():
+            fp.close()
+            if commit:
+                os.replace(f"{self.path(artifact)}.tmp", self.path(artifact))
+            else:
+                os.remove(f"{self.path(artifact)}.tmp")
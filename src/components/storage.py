@@ -0,0 +1,264 @@
+"""Pipeline component: storage of the GovData responses downloaded by
+scraper.py. The layout of a response folder is stored in a marker file in
+the folder, so scraper and parser only need the folder path.
+
+Migration of an existing folder:
+python -m src.components.storage --source extraction/gov_data_responses
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterator, List, Union
+
+from tqdm import tqdm
+
+LAYOUT_FILE = ".layout.json"
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstd compression requires the zstandard package: pip install zstandard"
+        ) from e
+    return zstandard
+
+
+def compress(content: bytes, compression: Union[str, None]) -> bytes:
+    if compression is None:
+        return content
+    if compression == "gzip":
+        # fixed mtime, so the same content always gives the same file
+        return gzip.compress(content, mtime=0)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor().compress(content)
+    raise ValueError(f"unknown compression {compression}")
+
+
+def read_response(file_path: str) -> bytes:
+    """reads a stored response, the compression is derived from the suffix
+
+    Parameters
+    ----------
+    file_path : str
+        path of the stored response
+
+    Returns
+    -------
+    bytes
+        uncompressed response
+    """
+    with open(file_path, "rb") as f:
+        content = f.read()
+    if file_path.endswith(".gz"):
+        return gzip.decompress(content)
+    if file_path.endswith(".zst"):
+        return _zstandard().ZstdDecompressor().decompress(content)
+    return content
+
+
+def name_from_path(file_path: str) -> str:
+    """dataset name of a stored response"""
+    return os.path.basename(file_path).split(".")[0]
+
+
+class ResponseStore:
+    """one uncompressed xml file per dataset in a flat folder"""
+
+    layout = "flat"
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.xml")
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(self.path(name))
+
+    def write(self, name: str, content: bytes) -> str:
+        """writes the response of a dataset
+
+        Parameters
+        ----------
+        name : str
+            dataset name
+        content : bytes
+            response content
+
+        Returns
+        -------
+        str
+            path of the written file
+        """
+        file_path = self.path(name)
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(content)
+        return file_path
+
+    def read(self, name: str) -> bytes:
+        return read_response(self.path(name))
+
+    def delete(self, name: str) -> None:
+        os.remove(self.path(name))
+
+    def paths(self) -> Iterator[str]:
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".xml"):
+                    yield entry.path
+
+    def names(self) -> List[str]:
+        return [name_from_path(file_path) for file_path in self.paths()]
+
+
+class ShardedResponseStore(ResponseStore):
+    """responses in sub folders named after the first characters of the
+    sha1 of the dataset name, optionally compressed with gzip or zstd"""
+
+    layout = "sharded"
+
+    def __init__(
+        self, root: str, compression: Union[str, None] = "gzip", prefix_length: int = 2
+    ) -> None:
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"unknown compression {compression}")
+        super().__init__(root)
+        self.compression = compression
+        self.prefix_length = prefix_length
+        self.suffix = ".xml" + COMPRESSION_SUFFIXES[compression]
+
+    def path(self, name: str) -> str:
+        shard = hashlib.sha1(name.encode("utf-8")).hexdigest()[: self.prefix_length]
+        return os.path.join(self.root, shard, f"{name}{self.suffix}")
+
+    def write(self, name: str, content: bytes) -> str:
+        return super().write(name, compress(content, self.compression))
+
+    def paths(self) -> Iterator[str]:
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(self.suffix):
+                            yield entry.path
+
+    def save_layout(self) -> None:
+        Path(self.root).mkdir(parents=True, exist_ok=True)
+        with open(os.path.join(self.root, LAYOUT_FILE), "w") as fp:
+            json.dump(
+                {
+                    "layout": self.layout,
+                    "compression": self.compression,
+                    "prefix_length": self.prefix_length,
+                },
+                fp,
+            )
+
+
+def get_store(root: str) -> ResponseStore:
+    """returns the store of a response folder, folders without layout file
+    are flat folders
+
+    Parameters
+    ----------
+    root : str
+        response folder
+
+    Returns
+    -------
+    ResponseStore
+        store matching the layout of the folder
+    """
+    layout_path = os.path.join(root, LAYOUT_FILE)
+    if not os.path.isfile(layout_path):
+        return ResponseStore(root)
+    with open(layout_path) as fp:
+        layout = json.load(fp)
+    return ShardedResponseStore(
+        root, compression=layout["compression"], prefix_length=layout["prefix_length"]
+    )
+
+
+def create_store(
+    root: str, layout: str = "sharded", compression: Union[str, None] = "gzip"
+) -> ResponseStore:
+    """creates a new response folder with the given layout
+
+    Parameters
+    ----------
+    root : str
+        response folder
+    layout : str, optional
+        either flat or sharded, by default "sharded"
+    compression : Union[str, None], optional
+        compression of a sharded store, gzip, zstd or None, by default "gzip"
+
+    Returns
+    -------
+    ResponseStore
+        store of the new folder
+    """
+    Path(root).mkdir(parents=True, exist_ok=True)
+    if layout == "flat":
+        return ResponseStore(root)
+    if layout == "sharded":
+        store = ShardedResponseStore(root, compression=compression)
+        store.save_layout()
+        return store
+    raise ValueError(f"unknown layout {layout}")
+
+
+def migrate(source: str, target: str, compression: Union[str, None] = "gzip") -> None:
+    """moves all responses of a flat folder into a sharded store. Source and
+    target can be the same folder. The layout file is written at the end, so
+    an interrupted migration can be started again
+
+    Parameters
+    ----------
+    source : str
+        flat response folder
+    target : str
+        folder of the sharded store
+    compression : Union[str, None], optional
+        compression of the sharded store, by default "gzip"
+    """
+    source_store = ResponseStore(source)
+    target_store = ShardedResponseStore(target, compression=compression)
+    for file_path in tqdm(list(source_store.paths())):
+        name = name_from_path(file_path)
+        target_store.write(name, read_response(file_path))
+        source_store.delete(name)
+    target_store.save_layout()
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(
+        description="Migrates a flat GovData response folder into a sharded store"
+    )
+    argument_parser.add_argument("--source", required=True)
+    argument_parser.add_argument(
+        "--target", help="by default the source folder is migrated in place"
+    )
+    argument_parser.add_argument(
+        "--compression", choices=["gzip", "zstd", "none"], default="gzip"
+    )
+    args = argument_parser.parse_args()
+    migrate(
+        source=args.source,
+        target=args.target or args.source,
+        compression=None if args.compression == "none" else args.compression,
+    )
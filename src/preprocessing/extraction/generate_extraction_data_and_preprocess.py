@@ -1,8 +1,21 @@
+import argparse
 from datetime import date
 
-import pandas as pd
+from src.components.catalogue import EXPORTS, read_catalogue
 
-df = pd.read_excel("extraction/musterdatenkatalog/musterdatenkatalog.xlsx")
+argument_parser = argparse.ArgumentParser(
+    description="Prepares the Musterdatenkatalog for the publication as parquet"
+)
+argument_parser.add_argument(
+    "--export",
+    nargs="*",
+    choices=EXPORTS,
+    default=[],
+    help="additional exports of both catalogues",
+)
+args = argument_parser.parse_args()
+
+df = read_catalogue("extraction/musterdatenkatalog/musterdatenkatalog.parquet")
 
 df = df.rename(
     columns={
@@ -15,7 +28,10 @@ df = df.rename(
     }
 )
 
-df["MUSTERDATENSATZ"] = df["THEMA"] + " - " + df["BEZEICHNUNG"]
+# string dtype keeps missing values null instead of joining them as "nan"
+df["MUSTERDATENSATZ"] = (
+    df["THEMA"].astype("string") + " - " + df["BEZEICHNUNG"].astype("string")
+).astype("category")
 
 df_small = df[
     [
@@ -34,10 +50,24 @@ df_small = df[
     ]
 ]
 
-df.to_excel(f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog_all.xlsx")
-df.to_csv(f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog_all.csv")
-
-df_small.to_excel(
-    f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog.xlsx"
+df.to_parquet(
+    f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog_all.parquet"
+)
+df_small.to_parquet(
+    f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog.parquet"
 )
-df_small.to_csv(f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog.csv")
+
+if "xlsx" in args.export:
+    df.to_excel(
+        f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog_all.xlsx"
+    )
+    df_small.to_excel(
+        f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog.xlsx"
+    )
+if "csv" in args.export:
+    df.to_csv(
+        f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog_all.csv"
+    )
+    df_small.to_csv(
+        f"extraction/musterdatenkatalog/{date.today()}_musterdatenkatalog.csv"
+    )
@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from sentence_transformers import SentenceTransformer, models
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+VOCAB = (
+    ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "-", ":"]
+    + list("abcdefghijklmnopqrstuvwxyzäöüß")
+    + [f"##{char}" for char in "abcdefghijklmnopqrstuvwxyzäöüß"]
+)
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory) -> str:
+    """small randomly initialised sentence transformer saved to disk, so that
+    BertSim can be tested without downloading a model"""
+    base_path = tmp_path_factory.mktemp("tiny_bert")
+    bert_path = os.path.join(base_path, "bert")
+    model_path = os.path.join(base_path, "sentence_transformer")
+    os.makedirs(bert_path)
+    with open(os.path.join(bert_path, "vocab.txt"), "w") as fp:
+        fp.write("\n".join(VOCAB))
+    BertTokenizerFast.from_pretrained(bert_path, do_lower_case=True).save_pretrained(
+        bert_path
+    )
+    config = BertConfig(
+        vocab_size=len(VOCAB),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=64,
+    )
+    BertModel(config).save_pretrained(bert_path)
+    transformer = models.Transformer(bert_path, max_seq_length=32)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension())
+    SentenceTransformer(modules=[transformer, pooling], device="cpu").save(model_path)
+    return model_path
+
+
+@pytest.fixture(scope="session")
+def tiny_corpus() -> List[str]:
+    return [
+        "Bildung - Schule",
+        "Bildung - Kindertagesstätte",
+        "Freizeit - Grillplatz",
+        "Freizeit - Bad und Freibad",
+        "Gesundheit - Öffentliche Toilette",
+        "Verkehr - Parkplatz",
+        "Verkehr - Haltestelle",
+        "Wahl - Wahlergebnis",
+    ]
+
+
+class StubCkanHandler(BaseHTTPRequestHandler):
+    """answers the CKAN API calls and RDF downloads used by the scraper"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.request_count += 1
+        try:
+            time.sleep(server.delay)
+            url = urlparse(self.path)
+            path = url.path
+            if path == "/api/3/action/package_list":
+                self._send(json.dumps({"result": sorted(server.datasets)}))
+            elif path == "/api/3/action/package_search":
+                self._send(json.dumps({"result": self._package_search(url.query)}))
+            elif path.startswith("/dataset/") and path.endswith(".rdf"):
+                dataset_name = path[len("/dataset/") : -len(".rdf")]  # noqa: E203
+                if dataset_name in server.datasets:
+                    self._send(server.datasets[dataset_name]["rdf"])
+                else:
+                    self._send("not found", status=404)
+            else:
+                self._send("not found", status=404)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _package_search(self, query: str) -> dict:
+        params = {key: value[0] for key, value in parse_qs(query).items()}
+        datasets = [
+            {"name": name, "metadata_modified": dataset["metadata_modified"]}
+            for name, dataset in self.server.datasets.items()
+        ]
+        if "fq" in params:
+            since = params["fq"].split("[")[1].split(" TO ")[0].rstrip("Z")
+            datasets = [el for el in datasets if el["metadata_modified"] >= since]
+        datasets.sort(key=lambda el: el["metadata_modified"], reverse=True)
+        start, rows = int(params.get("start", 0)), int(params.get("rows", 10))
+        return {"count": len(datasets), "results": datasets[start : start + rows]}
+
+    def _send(self, body: str, status: int = 200) -> None:
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def ckan_server():
+    """local stub of the GovData CKAN API, datasets can be set on
+    server.datasets as {name: {"rdf": str, "metadata_modified": str}}"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubCkanHandler)
+    server.datasets = {}
+    server.delay = 0.0
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.request_count = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
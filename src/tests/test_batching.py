@@ -0,0 +1,38 @@
+import torch
+from sentence_transformers import SentenceTransformer
+
+from src.components.batching import encode_bucketed, token_budget_batches
+from src.components.bert_sim import BertSim
+
+
+def test_token_budget_batches() -> None:
+    """every text is in one batch, batches are sorted by length and stay
+    within the token budget unless a single text is longer"""
+    lengths = [5, 30, 7, 12, 5, 64, 9, 3]
+
+    batches = token_budget_batches(lengths, max_tokens=40, max_batch_size=3)
+
+    assert sorted(idx for batch in batches for idx in batch) == list(range(8))
+    assert batches[0] == [5]
+    for batch in batches:
+        assert len(batch) <= 3
+        assert lengths[batch[0]] == max(lengths[idx] for idx in batch)
+        assert len(batch) == 1 or len(batch) * lengths[batch[0]] <= 40
+
+
+def test_encode_bucketed(tiny_model, tiny_corpus) -> None:
+    """bucketed encoding returns the embeddings in the input order"""
+    model = SentenceTransformer(tiny_model)
+    texts = tiny_corpus + ["Haltestellen", "Wahlergebnisse der Kommunalwahl 2020"]
+
+    embeddings = encode_bucketed(model, texts, max_tokens=64, max_batch_size=4)
+
+    expected = model.encode(texts, convert_to_tensor=True)
+    assert torch.allclose(embeddings, expected, atol=1e-5)
+
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus, token_budget=64)
+    assert torch.allclose(
+        bert_sim.corpus_embeddings,
+        BertSim(model=tiny_model, corpus=tiny_corpus).corpus_embeddings,
+        atol=1e-5,
+    )
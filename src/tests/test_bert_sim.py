@@ -1,9 +1,16 @@
+import os
+import sqlite3
+import threading
 from typing import Dict, List, Union
 
+import numpy as np
 import pytest
+import torch
 from sklearn.metrics.pairwise import cosine_similarity
 
-from src.components.bert_sim import BertSim
+from src.components.bert_sim import BertSim, split_label
+from src.components.embedding_index import QuantizedIndex
+from src.components.prediction_memo import PredictionMemo
 from src.settings import Settings
 from src.utils.data import load_json
 
@@ -30,6 +37,261 @@ def test_bert_sim(model, taxonomy: Union[List, Dict]) -> None:
     ) == pytest.approx(1.0)
 
 
+def test_corpus_embedding_cache(tiny_model, tiny_corpus, tmp_path, monkeypatch) -> None:
+    """the second BertSim loads the cached corpus embeddings instead of
+    encoding the corpus, a changed corpus gets a new cache file"""
+    cache_dir = str(tmp_path / "corpus_embeddings")
+    bert_sim = BertSim(
+        model=tiny_model, corpus=tiny_corpus, embedding_cache_dir=cache_dir
+    )
+    assert len(os.listdir(cache_dir)) == 1
+
+    with monkeypatch.context() as m:
+        m.setattr(BertSim, "_encode_corpus", lambda self: pytest.fail("encoded"))
+        cached = BertSim(
+            model=tiny_model, corpus=tiny_corpus, embedding_cache_dir=cache_dir
+        )
+    assert np.allclose(cached.corpus_embeddings, bert_sim.corpus_embeddings)
+    assert cached.predict(["Schulen"]) == bert_sim.predict(["Schulen"])
+
+    BertSim(model=tiny_model, corpus=tiny_corpus[:-1], embedding_cache_dir=cache_dir)
+    BertSim(
+        model=tiny_model,
+        corpus=tiny_corpus,
+        revision="v2",
+        embedding_cache_dir=cache_dir,
+    )
+    assert len(os.listdir(cache_dir)) == 3
+
+
+def test_predict_deduplicates_and_memoizes(
+    tiny_model, tiny_corpus, tmp_path, monkeypatch
+) -> None:
+    """repeated titles are encoded once and memoized predictions are reused
+    by a new BertSim as long as model and corpus are unchanged"""
+    memo_path = str(tmp_path / "memo.sqlite")
+    queries = ["Haushaltsplan", "Haushaltsplan ", "Schulen", "Haushaltsplan", "Schulen"]
+    encoded = []
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus, memo_path=memo_path)
+    search = bert_sim._search
+    monkeypatch.setattr(
+        bert_sim, "_search", lambda q, batch_size: encoded.extend(q) or search(q, 32)
+    )
+
+    predictions = bert_sim.predict(queries)
+
+    assert encoded == ["Haushaltsplan", "Schulen"]
+    assert [el["text"] for el in predictions] == queries
+    assert predictions[0]["prediction"] == predictions[1]["prediction"]
+    assert predictions == [
+        {**el, "text": query}
+        for query, el in zip(queries, BertSim(tiny_model, tiny_corpus).predict(queries))
+    ]
+    bert_sim.prediction_memo.close()
+
+    reloaded = BertSim(model=tiny_model, corpus=tiny_corpus, memo_path=memo_path)
+    monkeypatch.setattr(
+        reloaded, "_search", lambda q, batch_size: pytest.fail("encoded")
+    )
+    assert reloaded.predict(queries) == predictions
+    reloaded.prediction_memo.close()
+
+    changed = BertSim(model=tiny_model, corpus=tiny_corpus[:-1], memo_path=memo_path)
+    assert len(changed.prediction_memo.get_many(["Schulen"])) == 0
+    changed.prediction_memo.close()
+
+
+def test_prediction_memo_across_threads(tmp_path) -> None:
+    """the memo file is usable from another thread, like the batching thread
+    of the service, and memo files without margins are dropped"""
+    path = str(tmp_path / "predictions.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE predictions (title TEXT, label TEXT, score REAL, version TEXT)"
+    )
+    connection.execute("INSERT INTO predictions VALUES ('schulen', 'a', 0.5, 'v1')")
+    connection.commit()
+    connection.close()
+
+    memo = PredictionMemo(version="v1", path=path)
+    thread = threading.Thread(
+        target=memo.put_many, args=({"haltestellen": ("b", 0.7, 0.1)},)
+    )
+    thread.start()
+    thread.join()
+    memo.close()
+
+    with PredictionMemo(version="v1", path=path) as memo:
+        assert memo.get_many(["schulen", "haltestellen"]) == {
+            "haltestellen": ("b", 0.7, 0.1)
+        }
+
+
+def test_predict_top_k(tiny_model, tiny_corpus) -> None:
+    """the best candidate equals predict, the hierarchical mode searches only
+    the best Themen and equals the flat search if all Themen are searched"""
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus)
+    queries = ["Schulen", "Haltestellen", "Wahlergebnisse"]
+
+    results = bert_sim.predict_top_k(queries, k=3)
+    for result, prediction in zip(results, bert_sim.predict(queries)):
+        candidates = result["candidates"]
+        assert len(candidates) == 3
+        assert candidates[0]["prediction"] == prediction["prediction"]
+        assert candidates[0]["score"] == pytest.approx(prediction["score"], abs=1e-5)
+        assert [el["score"] for el in candidates] == sorted(
+            [el["score"] for el in candidates], reverse=True
+        )
+        assert result["margin"] == pytest.approx(
+            candidates[0]["score"] - candidates[1]["score"]
+        )
+
+    all_groups = bert_sim.predict_top_k(
+        queries, k=3, hierarchical=True, n_groups=len(bert_sim.groups)
+    )
+    assert [[el["prediction"] for el in r["candidates"]] for r in all_groups] == [
+        [el["prediction"] for el in r["candidates"]] for r in results
+    ]
+    for result in bert_sim.predict_top_k(queries, k=3, hierarchical=True, n_groups=1):
+        themen = {el["thema"] for el in result["candidates"]}
+        assert len(themen) == 1
+        assert len(result["candidates"]) <= 3
+
+
+def test_split_label() -> None:
+    assert split_label("Gesundheit - Öffentliche Toilette") == (
+        "Gesundheit",
+        "Öffentliche Toilette",
+    )
+    assert split_label("Abfall - Wertstoff-Sammelstelle") == (
+        "Abfall",
+        "Wertstoff-Sammelstelle",
+    )
+
+
+@pytest.mark.parametrize("dtype,tolerance", [("float16", 1e-3), ("int8", 2e-2)])
+def test_quantized_index(dtype, tolerance) -> None:
+    """quantized scores stay close to float32 cosine similarities"""
+    generator = torch.Generator().manual_seed(0)
+    corpus_embeddings = torch.nn.functional.normalize(
+        torch.randn(300, 64, generator=generator), dim=1
+    )
+    query_embeddings = torch.nn.functional.normalize(
+        torch.randn(50, 64, generator=generator), dim=1
+    )
+    index = QuantizedIndex.from_embeddings(corpus_embeddings, dtype=dtype)
+
+    scores = index.scores(query_embeddings, block_size=128)
+
+    expected = query_embeddings @ corpus_embeddings.T
+    assert scores.dtype == torch.float32
+    assert torch.allclose(scores, expected, atol=tolerance)
+    assert index.nbytes < corpus_embeddings.nelement() * 4
+    label_ids = torch.tensor([3, 7, 250])
+    assert torch.equal(
+        index.scores(query_embeddings, label_ids=label_ids), scores[:, label_ids]
+    )
+
+
+def test_bert_sim_int8_index(tiny_model, tiny_corpus) -> None:
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus)
+    quantized = BertSim(model=tiny_model, corpus=tiny_corpus, index_dtype="int8")
+    queries = ["Schulen", "Haltestellen"]
+    for prediction, expected in zip(
+        quantized.predict(queries), bert_sim.predict(queries)
+    ):
+        assert prediction["score"] == pytest.approx(expected["score"], abs=2e-2)
+    # the index replaces the float32 embeddings
+    assert quantized.corpus_embeddings is None
+    assert len(quantized.predict_top_k(queries, k=2, hierarchical=True)) == 2
+
+
+def test_predict_with_worker_pool(tiny_model, tiny_corpus) -> None:
+    """predictions of the worker processes are gathered in input order"""
+    queries = [f"Haltestelle {idx}" for idx in range(20)] + ["Schulen"]
+    expected = BertSim(model=tiny_model, corpus=tiny_corpus).predict(queries)
+
+    with BertSim(model=tiny_model, corpus=tiny_corpus, n_workers=2) as bert_sim:
+        predictions = bert_sim.predict(queries, batch_size=4)
+        pool_dir = bert_sim._pool_dir
+        assert os.path.isfile(bert_sim.corpus_embeddings_path)
+
+    assert [el["text"] for el in predictions] == queries
+    for prediction, el in zip(predictions, expected):
+        assert prediction["score"] == pytest.approx(el["score"], abs=1e-5)
+    assert not os.path.exists(pool_dir)
+
+
+def test_worker_pool_shards_one_batch(tiny_model, tiny_corpus) -> None:
+    """one call with batch_size titles, like a batch of the pipeline, is
+    split across all workers, also with a quantized index"""
+    queries = [f"Haltestelle {idx}" for idx in range(256)]
+    with BertSim(
+        model=tiny_model, corpus=tiny_corpus, n_workers=2, index_dtype="int8"
+    ) as bert_sim:
+        shards = []
+        pool_map = bert_sim.pool.map
+
+        def spy(function, shard_iter, *args):
+            shard_list = list(shard_iter)
+            shards.extend(len(el) for el in shard_list)
+            return pool_map(function, shard_list, *args)
+
+        bert_sim.pool.map = spy
+        predictions = bert_sim.predict(queries, batch_size=256)
+
+    assert shards == [128, 128]
+    assert [el["text"] for el in predictions] == queries
+
+
+def test_worker_pool_uses_query_cache(tiny_model, tiny_corpus, tmp_path) -> None:
+    """the embeddings encoded by the workers are added to the query cache,
+    cached queries are not sent to the workers again"""
+    queries = ["Schulen", "Haltestellen", "Parkplätze"]
+    with BertSim(
+        model=tiny_model,
+        corpus=tiny_corpus,
+        n_workers=1,
+        query_cache_path=str(tmp_path / "query_embeddings.sqlite"),
+    ) as bert_sim:
+        expected = bert_sim.predict(queries)
+        assert len(bert_sim.query_cache) == len(queries)
+        encode_seconds = bert_sim.timings["encode"]
+
+        predictions = bert_sim.predict(queries)
+
+        assert bert_sim.query_cache.hits == len(queries)
+        assert bert_sim.timings["encode"] == encode_seconds
+    for prediction, el in zip(predictions, expected):
+        assert prediction["score"] == pytest.approx(el["score"], abs=1e-5)
+
+
+def test_query_embedding_cache(tiny_model, tiny_corpus, tmp_path, monkeypatch) -> None:
+    """query embeddings are reused across predictions, corpora and runs of
+    the same model"""
+    cache_path = str(tmp_path / "query_embeddings.sqlite")
+    queries = ["Schulen", "Haltestellen", "Schulen "]
+    bert_sim = BertSim(
+        model=tiny_model, corpus=tiny_corpus, query_cache_path=cache_path
+    )
+    expected = bert_sim.predict(queries)
+    bert_sim.close()
+
+    reloaded = BertSim(
+        model=tiny_model, corpus=tiny_corpus[::-1], query_cache_path=cache_path
+    )
+    monkeypatch.setattr(
+        reloaded, "_encode_queries", lambda *args, **kwargs: pytest.fail("encoded")
+    )
+    top_k = reloaded.predict_top_k(queries, k=1)
+    assert reloaded.query_cache.hits == 2
+    for result, prediction in zip(top_k, expected):
+        assert result["candidates"][0]["score"] == pytest.approx(
+            prediction["score"], abs=1e-5
+        )
+    reloaded.close()
+
+
 if __name__ == "__main__":
     settings = Settings(_env_file="paths/.env.dev")
     model = "bert-base-german-cased"
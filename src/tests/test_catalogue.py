@@ -0,0 +1,70 @@
+import pandas as pd
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.components.catalogue import (
+    export_catalogue,
+    read_catalogue,
+    title_hash,
+    write_catalogue,
+)
+
+
+def test_write_catalogue(tmp_path) -> None:
+    """records with missing values are written to parquet, city, thema and
+    bezeichnung are dictionary encoded"""
+    records = [
+        {"dct:title": "Schulen", "city": "Bonn", "thema": "Bildung", "tags": None},
+        {"dct:title": "Kitas", "city": float("nan"), "thema": "Bildung"},
+        {"dct:title": "Wahlen", "city": "Bonn", "thema": "Wahl", "tags": "a, b"},
+    ]
+    path = str(tmp_path / "musterdatenkatalog.parquet")
+
+    assert write_catalogue(iter(records), path, row_group_size=2) == 3
+    assert pq.ParquetFile(path).num_row_groups == 2
+
+    schema = pq.read_schema(path)
+    assert pa.types.is_dictionary(schema.field("city").type)
+    assert pa.types.is_dictionary(schema.field("thema").type)
+    assert schema.field("dct:title").type == pa.string()
+
+    df = read_catalogue(path)
+    assert isinstance(df["city"].dtype, pd.CategoricalDtype)
+    assert df["dct:title"].tolist() == ["Schulen", "Kitas", "Wahlen"]
+    assert df["city"].isna().tolist() == [False, True, False]
+    assert df["tags"].isna().tolist() == [True, True, False]
+
+    export_catalogue(path, output_dir=str(tmp_path), formats=["csv"])
+    csv = pd.read_csv(tmp_path / "musterdatenkatalog.csv")
+    assert csv["dct:title"].tolist() == ["Schulen", "Kitas", "Wahlen"]
+
+
+def test_write_catalogue_unknown_column(tmp_path) -> None:
+    """the columns are fixed by the first row group"""
+    records = [{"dct:title": "Schulen"}, {"dct:title": "Kitas", "city": "Bonn"}]
+    with pytest.raises(ValueError):
+        write_catalogue(records, str(tmp_path / "catalogue.parquet"), row_group_size=1)
+
+
+def test_write_catalogue_keeps_previous_on_error(tmp_path) -> None:
+    """a failed write does not replace the previous catalogue"""
+    path = str(tmp_path / "musterdatenkatalog.parquet")
+    write_catalogue([{"dct:title": "Schulen"}], path)
+
+    def records():
+        yield {"dct:title": "Kitas"}
+        raise RuntimeError("enrichment crashed")
+
+    with pytest.raises(RuntimeError):
+        write_catalogue(records(), path, row_group_size=1)
+    assert read_catalogue(path)["dct:title"].tolist() == ["Schulen"]
+    assert sorted(el.name for el in tmp_path.iterdir()) == [
+        "musterdatenkatalog.parquet"
+    ]
+
+
+def test_title_hash_missing_titles() -> None:
+    """a nan title of the parser matches a null title of the catalogue"""
+    assert title_hash(float("nan")) == title_hash(None)
+    assert title_hash("Schulen") != title_hash(None)
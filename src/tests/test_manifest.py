@@ -0,0 +1,75 @@
+import os
+
+from src.components import pipeline
+from src.components.manifest import DatasetManifest, get_content_hash
+from src.components.storage import create_store, get_store, migrate
+
+
+def test_rebuild_from_store(tmp_path) -> None:
+    """an empty manifest is filled from an existing response folder and
+    answers set queries without touching the files"""
+    store = create_store(str(tmp_path / "responses"))
+    for name in ["dataset-a", "dataset-b", "dataset-c"]:
+        store.write(name, name.encode("utf-8"))
+
+    with DatasetManifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        manifest.rebuild_from_store(store)
+        assert len(manifest) == 3
+
+        current = ["dataset-a", "dataset-b", "dataset-d"]
+        assert manifest.missing(current) == ["dataset-d"]
+        assert manifest.extra(current) == ["dataset-c"]
+        assert sorted(manifest.file_paths(current, store)) == sorted(
+            [store.path("dataset-a"), store.path("dataset-b")]
+        )
+
+        manifest.record_download(
+            "dataset-d", store.path("dataset-d"), get_content_hash(b"dataset-d")
+        )
+        assert manifest.missing(current) == []
+        assert manifest.content_hashes(["dataset-d"], store) == {
+            store.path("dataset-d"): get_content_hash(b"dataset-d")
+        }
+
+    with DatasetManifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        assert len(manifest) == 4
+    assert os.path.isfile(tmp_path / "manifest.sqlite")
+
+
+def test_lost_files(tmp_path) -> None:
+    """datasets whose file was deleted from the response folder are
+    reported, so they are downloaded again"""
+    store = create_store(str(tmp_path / "responses"))
+    for name in ["dataset-a", "dataset-b"]:
+        store.write(name, name.encode("utf-8"))
+
+    with DatasetManifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        manifest.rebuild_from_store(store)
+        store.delete("dataset-b")
+
+        assert manifest.missing(["dataset-a", "dataset-b"]) == []
+        assert manifest.lost(["dataset-a", "dataset-b"], store) == ["dataset-b"]
+
+
+def test_manifest_after_migration(tmp_path, monkeypatch) -> None:
+    """a manifest built from a flat folder still finds every file after the
+    folder was migrated into a sharded store"""
+    root = str(tmp_path / "responses")
+    store = create_store(root, layout="flat")
+    for name in ["dataset-a", "dataset-b"]:
+        store.write(name, name.encode("utf-8"))
+    monkeypatch.setattr(pipeline, "GOV_DATA_RESPONSES", root)
+
+    with DatasetManifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        manifest.rebuild_from_store(store)
+        migrate(source=root, target=root)
+
+        content_hashes = pipeline.check_if_all_files_are_downloaded(
+            current_dataset_list=["dataset-a", "dataset-b"], manifest=manifest
+        )
+
+    sharded = get_store(root)
+    assert content_hashes == {
+        sharded.path(name): get_content_hash(name.encode("utf-8"))
+        for name in ["dataset-a", "dataset-b"]
+    }
@@ -0,0 +1,34 @@
+import pytest
+import torch
+from sentence_transformers import SentenceTransformer
+
+from src.components.bert_sim import BertSim
+from src.components.onnx_backend import OnnxEncoder, export_onnx
+
+pytest.importorskip("onnxruntime")
+
+
+def test_onnx_backend_equivalence(tiny_model, tiny_corpus, tmp_path) -> None:
+    """the exported model gives the same normalized embeddings and the same
+    cosine scores as the torch model"""
+    model_dir = str(tmp_path / "onnx")
+    export_onnx(tiny_model, model_dir, quantize=True)
+    texts = tiny_corpus + ["Haltestellen", "Wahlergebnisse der Kommunalwahl 2020"]
+
+    embeddings = OnnxEncoder(model_dir).encode(texts, convert_to_tensor=True)
+
+    expected = torch.nn.functional.normalize(
+        SentenceTransformer(tiny_model).encode(texts, convert_to_tensor=True), dim=1
+    )
+    assert torch.allclose(embeddings, expected, atol=1e-4)
+
+    queries = ["Schulen", "Haltestellen"]
+    predictions = BertSim(model=tiny_model, corpus=tiny_corpus).predict(queries)
+    for backend, tolerance in [("onnx", 1e-4), ("onnx-int8", 5e-2)]:
+        bert_sim = BertSim(model=model_dir, corpus=tiny_corpus, backend=backend)
+        for prediction, expected_prediction in zip(
+            bert_sim.predict(queries), predictions
+        ):
+            assert prediction["score"] == pytest.approx(
+                expected_prediction["score"], abs=tolerance
+            )
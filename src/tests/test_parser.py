@@ -0,0 +1,187 @@
+import glob
+import math
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from src.components.parse_cache import ParseCache
+from src.components.parser import CityIndex, Parser
+from src.components.parser_lxml import LxmlParser
+from src.settings import Settings
+from src.utils.data import load_json, save_json
+
+settings = Settings(_env_file="paths/.env.dev")
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "gov_data_responses")
+THEME_URI = "http://publications.europa.eu/resource/authority/data-theme"
+FILE_PATHS = sorted(glob.glob(os.path.join(FIXTURES, "*.xml")))
+
+
+def _normalise(record):
+    return {
+        key: None if isinstance(value, float) and math.isnan(value) else value
+        for key, value in record.items()
+    }
+
+
+@pytest.mark.parametrize("file_path", FILE_PATHS, ids=os.path.basename)
+def test_lxml_parser_parity(file_path) -> None:
+    """the lxml engine returns the same record as the BeautifulSoup parser"""
+    parser = Parser(current_cities=settings.CITIES_V5)
+    lxml_parser = LxmlParser(current_cities=settings.CITIES_V5)
+
+    expected = parser._batch_process([file_path])[0]
+    result = lxml_parser._batch_process([file_path])[0]
+
+    assert _normalise(result) == _normalise(expected)
+
+
+def test_lxml_parser_fields() -> None:
+    lxml_parser = LxmlParser(current_cities=settings.CITIES_V5)
+
+    result = lxml_parser._batch_process(
+        [os.path.join(FIXTURES, "oeffentliche-toiletten-bonn.xml")]
+    )[0]
+
+    assert result["dct:title"] == "Standorte öffentlicher Toiletten"
+    assert result["city"] == "Bonn"
+    assert result["tags"] == "Toiletten, Barrierefreiheit"
+    assert result["updated_at"] == "2023-03-14"
+    assert (
+        result["distribution_description"] == "Standorte als CSV, Standorte als GeoJSON"
+    )
+
+
+def test_parser_reads_non_utf8_responses(tmp_path) -> None:
+    """a response which is not utf-8 is parsed and does not abort the run"""
+    with open(os.path.join(FIXTURES, "oeffentliche-toiletten-bonn.xml")) as fp:
+        content = fp.read().replace('encoding="utf-8"', 'encoding="iso-8859-1"')
+    file_path = tmp_path / "oeffentliche-toiletten-bonn.xml"
+    file_path.write_bytes(content.encode("iso-8859-1"))
+    parser = Parser(current_cities=settings.CITIES_V5)
+
+    result = parser._batch_process([str(file_path)])[0]
+
+    assert result["dct:title"] == "Standorte öffentlicher Toiletten"
+    assert result["city"] == "Bonn"
+
+
+def test_city_index_matches_dataframe_lookup() -> None:
+    """the city index resolves the same Kommune as the exact name lookup in
+    the cities csv and detects partial names"""
+    df = pd.read_csv(settings.CITIES_V5)
+    city_index = CityIndex.from_csv(settings.CITIES_V5)
+
+    for name in df["name"]:
+        expected = df.loc[df["name"] == name, "Kommune"].array[0]
+        assert city_index.get(name) == expected
+
+    assert city_index.get("Bonn") == "Bonn"
+    assert city_index.get("Stadt") is None
+    assert city_index.contains("Stadt")
+    assert not city_index.contains("Planungsbüro Müller")
+
+
+@pytest.mark.parametrize("engine", [Parser, LxmlParser])
+def test_categories_from_theme_cache(engine, tmp_path) -> None:
+    """theme labels are read from the cache without network in offline mode"""
+    themes_cache = str(tmp_path / "data_themes_de.json")
+    save_json(
+        obj={
+            "fetched_at": "2023-01-01T00:00:00",
+            "labels": {
+                f"{THEME_URI}/HEAL": "Gesundheit",
+                f"{THEME_URI}/GOVE": "Regierung und öffentlicher Sektor",
+            },
+        },
+        path=themes_cache,
+    )
+    parser = engine(
+        current_cities=settings.CITIES_V5, themes_cache=themes_cache, offline=True
+    )
+
+    parser.get_themes()
+    result = parser._batch_process(
+        [os.path.join(FIXTURES, "oeffentliche-toiletten-bonn.xml")]
+    )[0]
+
+    assert result["categories"] == "Gesundheit, Regierung und öffentlicher Sektor"
+
+
+def test_theme_cache_kept_if_themes_unresolved(tmp_path, monkeypatch) -> None:
+    """an expired theme cache is only replaced if every theme was resolved"""
+    themes_cache = str(tmp_path / "data_themes_de.json")
+    cache = {
+        "fetched_at": "2023-01-01T00:00:00",
+        "labels": {
+            f"{THEME_URI}/HEAL": "Gesundheit",
+            f"{THEME_URI}/GOVE": "Regierung und öffentlicher Sektor",
+        },
+    }
+    save_json(obj=cache, path=themes_cache)
+    parser = Parser(current_cities=settings.CITIES_V5, themes_cache=themes_cache)
+    monkeypatch.setattr(
+        parser,
+        "_download_themes",
+        lambda: ({f"{THEME_URI}/HEAL": "Gesundheit"}, [f"{THEME_URI}/GOVE"]),
+    )
+
+    parser.get_themes()
+
+    assert parser.categories == cache["labels"]
+    assert load_json(path=themes_cache) == cache
+
+    parser.categories = {}
+    monkeypatch.setattr(
+        parser, "_download_themes", lambda: ({f"{THEME_URI}/HEAL": "Gesundheit"}, [])
+    )
+    parser.get_themes()
+
+    assert load_json(path=themes_cache)["labels"] == {f"{THEME_URI}/HEAL": "Gesundheit"}
+
+
+@pytest.mark.parametrize("engine", [Parser, LxmlParser])
+def test_iter_parse_data(engine) -> None:
+    """worker processes yield the same records in the order of the files"""
+    parser = engine(current_cities=settings.CITIES_V5, offline=True)
+    file_paths = FILE_PATHS * 3
+
+    records = parser.iter_parse_data(file_paths=file_paths, batch_size=2, n_jobs=2)
+
+    assert not isinstance(records, list)
+    assert [_normalise(record) for record in records] == [
+        _normalise(record) for record in parser._batch_process(file_paths)
+    ]
+
+
+def test_parse_cache(tmp_path) -> None:
+    """only new or changed files are parsed again, the other records are read
+    from the cache"""
+    file_paths = []
+    for file_path in FILE_PATHS:
+        file_paths.append(str(tmp_path / os.path.basename(file_path)))
+        shutil.copy(file_path, file_paths[-1])
+    cache_path = str(tmp_path / "parse_cache.sqlite")
+    parser = LxmlParser(current_cities=settings.CITIES_V5, offline=True)
+
+    first_run = list(
+        parser.iter_parse_data(file_paths=file_paths, n_jobs=1, cache_path=cache_path)
+    )
+    with open(file_paths[0], "a") as fp:
+        fp.write("\n")
+    os.utime(file_paths[1], ns=(0, 0))
+    with ParseCache(path=cache_path, version=parser.cache_version()) as cache:
+        assert [cache.is_valid(file_path) for file_path in file_paths] == [False] + [
+            True
+        ] * (len(file_paths) - 1)
+    second_run = list(
+        parser.iter_parse_data(file_paths=file_paths, n_jobs=1, cache_path=cache_path)
+    )
+
+    assert [_normalise(el) for el in second_run] == [_normalise(el) for el in first_run]
+    # only the changed file is read again
+    assert parser.bytes_parsed == os.path.getsize(file_paths[0])
+    with ParseCache(path=cache_path, version="other parser") as cache:
+        assert not cache.is_valid(file_paths[1])
@@ -0,0 +1,234 @@
+import functools
+import glob
+import os
+import shutil
+
+import pandas as pd
+
+from src.components import pipeline
+from src.components.bert_sim import BertSim
+from src.components.catalogue import (
+    PREDICTION_VERSION,
+    load_previous_predictions,
+    read_catalogue,
+    write_catalogue,
+)
+from src.components.parse_cache import file_hash
+from src.components.parser_lxml import LxmlParser
+from src.components.pipeline import _enrich_data
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "gov_data_responses")
+
+
+def test_enrich_data_batched(tiny_model, tiny_corpus) -> None:
+    """batched enrichment assigns the same labels as one prediction per record"""
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus)
+    titles = [
+        "Standorte öffentlicher Toiletten",
+        "Wahlergebnisse Kommunalwahl",
+        "Haltestellen",
+        "Schulen",
+        "Grillplätze im Stadtgebiet",
+    ]
+    data = [{"dct:title": title} for title in titles]
+
+    batches = list(_enrich_data(data=iter(data), bert_sim=bert_sim, batch_size=2))
+
+    assert [len(batch) for batch, _ in batches] == [2, 2, 1]
+    enriched = [el for batch, _ in batches for el in batch]
+
+    assert len(enriched) == len(titles)
+    for el in enriched:
+        prediction = bert_sim.predict([el["dct:title"]])[0]["prediction"]
+        assert f"{el['thema']} - {el['bezeichnung']}" == prediction
+
+
+def test_enrich_data_sonstiges_threshold(tiny_model, tiny_corpus) -> None:
+    """records below the threshold fall back to Sonstiges and are queued"""
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus)
+    titles = ["Standorte öffentlicher Toiletten", "Haltestellen", "Schulen"]
+    predictions = bert_sim.predict(titles)
+    scores = sorted(prediction["score"] for prediction in predictions)
+    threshold = (scores[0] + scores[1]) / 2
+    data = [{"dct:title": title} for title in titles]
+
+    batches = _enrich_data(
+        data=data,
+        bert_sim=bert_sim,
+        batch_size=2,
+        sonstiges_threshold=threshold,
+        low_confidence_score=-1.0,
+        low_confidence_margin=-1.0,
+    )
+    enriched, queue = [], []
+    for batch, batch_queue in batches:
+        enriched.extend(batch)
+        queue.extend(batch_queue)
+
+    fallbacks = [el for el in enriched if el["thema"] == "Sonstiges"]
+    assert bert_sim.timings["encode"] > 0 and bert_sim.timings["search"] > 0
+    assert len(fallbacks) == 1
+    assert fallbacks[0]["bezeichnung"] == "Sonstiges"
+    assert [el["dct:title"] for el in queue] == [fallbacks[0]["dct:title"]]
+    assert queue[0]["fallback"] and queue[0]["score"] < threshold
+    assert all(prediction["margin"] >= 0 for prediction in predictions)
+
+
+def test_enrich_data_incremental(tiny_model, tiny_corpus, tmp_path) -> None:
+    """unchanged records keep prediction and added date of the previous
+    catalogue and stay in the review queue, changed and new records are
+    classified"""
+    path = str(tmp_path / "musterdatenkatalog.parquet")
+    write_catalogue(
+        [
+            {
+                "dct:title": "Schulen",
+                "dct:identifier": "a",
+                "url": "https://a",
+                "thema": "Bildung",
+                "bezeichnung": "Schulen (alt)",
+                "added": "2023-01-01",
+                "prediction": "Bildung - Schulen (alt)",
+                "score": 0.1,
+                "margin": 0.5,
+            },
+            {
+                "dct:title": "Kitas",
+                "dct:identifier": "b",
+                "url": "https://b",
+                "thema": "Bildung",
+                "bezeichnung": "Kitas (alt)",
+                "added": "2023-02-01",
+                "prediction": "Bildung - Kitas (alt)",
+                "score": 0.9,
+                "margin": 0.5,
+            },
+        ],
+        path,
+        metadata={PREDICTION_VERSION: "v1"},
+    )
+    data = [
+        {"dct:title": "Schulen", "dct:identifier": "a", "url": "https://a"},
+        {"dct:title": "Haltestellen", "dct:identifier": "b", "url": "https://b"},
+        {"dct:title": "Grillplätze", "dct:identifier": "c", "url": "https://c"},
+    ]
+    for el in data:
+        el["added"] = "2024-01-01"
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus)
+
+    previous = load_previous_predictions(path, prediction_version="v1")
+    batches = _enrich_data(
+        data=data,
+        bert_sim=bert_sim,
+        batch_size=2,
+        sonstiges_threshold=None,
+        low_confidence_score=0.2,
+        low_confidence_margin=-1.0,
+        previous=previous,
+    )
+    enriched, queue = [], []
+    for batch, batch_queue in batches:
+        enriched.extend(batch)
+        queue.extend(batch_queue)
+
+    assert enriched[0]["bezeichnung"] == "Schulen (alt)"
+    assert enriched[0]["score"] == 0.1
+    assert queue[0]["dct:identifier"] == "a" and queue[0]["score"] == 0.1
+    assert enriched[1]["bezeichnung"] != "Kitas (alt)"
+    assert [el["added"] for el in enriched] == [
+        "2023-01-01",
+        "2023-02-01",
+        "2024-01-01",
+    ]
+
+    previous = load_previous_predictions(path, prediction_version="v2")
+    assert all(known[0] is None for known in previous.values())
+
+    # catalogues without scores are classified again
+    write_catalogue(enriched, path, metadata={PREDICTION_VERSION: "v1"})
+    assert all(
+        known[0] is not None for known in load_previous_predictions(path, "v1").values()
+    )
+    write_catalogue(
+        [{k: v for k, v in el.items() if k != "score"} for el in enriched],
+        path,
+        metadata={PREDICTION_VERSION: "v1"},
+    )
+    assert all(
+        known[0] is None for known in load_previous_predictions(path, "v1").values()
+    )
+
+
+def test_main_skips_unchanged_stages(
+    tiny_model, tiny_corpus, tmp_path, monkeypatch
+) -> None:
+    """a second run with the same inputs skips parse, enrich and save, a
+    deleted catalogue is written again without enriching again, changed model
+    weights enrich again"""
+    content_hashes = {}
+    for file_path in glob.glob(os.path.join(FIXTURES, "*.xml")):
+        copy = str(tmp_path / os.path.basename(file_path))
+        shutil.copy(file_path, copy)
+        content_hashes[copy] = file_hash(copy)
+    output_path = tmp_path / "musterdatenkatalog"
+    monkeypatch.setattr(pipeline, "_create_corpus", lambda: None)
+    monkeypatch.setattr(pipeline, "_load_corpus", lambda: list(tiny_corpus))
+    monkeypatch.setattr(
+        pipeline,
+        "_download_current_gov_data",
+        lambda sample_size, metrics=None: content_hashes,
+    )
+    monkeypatch.setattr(
+        pipeline,
+        "PARSER_ENGINES",
+        {"lxml": functools.partial(LxmlParser, offline=True)},
+    )
+    monkeypatch.setattr(pipeline, "PARSER_ENGINE", "lxml")
+    monkeypatch.setattr(pipeline, "MODEL_PATH", tiny_model)
+    monkeypatch.setattr(pipeline, "ENCODER_BACKEND", "torch")
+    monkeypatch.setattr(pipeline, "ENCODER_WORKERS", 0)
+    monkeypatch.setattr(pipeline, "CORPUS_EMBEDDINGS_CACHE", None)
+    monkeypatch.setattr(pipeline, "PREDICTION_MEMO", str(tmp_path / "memo.sqlite"))
+    monkeypatch.setattr(pipeline, "PARSE_CACHE", str(tmp_path / "parse.sqlite"))
+    monkeypatch.setattr(pipeline, "STAGE_DIR", str(tmp_path / "stages"))
+    monkeypatch.setattr(pipeline, "OUTPUT_PATH", str(output_path))
+    monkeypatch.setattr(pipeline, "EXPORT_FORMATS", [])
+
+    calls = {"bert_sim": 0, "write_catalogue": 0}
+
+    def counted(name, function):
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(pipeline, "BertSim", counted("bert_sim", BertSim))
+    monkeypatch.setattr(
+        pipeline,
+        "write_catalogue",
+        counted("write_catalogue", pipeline.write_catalogue),
+    )
+
+    pipeline.main()
+    catalogue = read_catalogue(str(output_path / "musterdatenkatalog.parquet"))
+    assert catalogue["city"].notna().all() and len(catalogue) > 0
+    assert set(catalogue["thema"]) <= {el.split(" - ")[0] for el in tiny_corpus}
+    queue = pd.read_csv(output_path / "low_confidence.csv")
+    assert "margin" in queue.columns
+    assert calls == {"bert_sim": 1, "write_catalogue": 1}
+
+    pipeline.main()
+    assert calls == {"bert_sim": 1, "write_catalogue": 1}
+
+    os.remove(output_path / "musterdatenkatalog.parquet")
+    pipeline.main()
+    assert calls == {"bert_sim": 1, "write_catalogue": 2}
+    assert len(read_catalogue(str(output_path / "musterdatenkatalog.parquet"))) == len(
+        catalogue
+    )
+
+    # new weights under the same model name and revision
+    monkeypatch.setattr(pipeline, "model_fingerprint", lambda encoder: b"new weights")
+    pipeline.main()
+    assert calls == {"bert_sim": 2, "write_catalogue": 3}
@@ -0,0 +1,27 @@
+import json
+import time
+
+from src.components.run_report import RunReport, hit_rate
+
+
+def test_run_report(tmp_path) -> None:
+    """blocks of the same stage add up, the report is written as json"""
+    report = RunReport()
+    for _ in range(2):
+        with report.stage("parse") as metrics:
+            time.sleep(0.01)
+            metrics.count(records=10, bytes_read=100)
+    report.get("parse").counters["parse_cache_hit_rate"] = hit_rate(3, 1)
+
+    path = tmp_path / "run_report.json"
+    report.write(str(path))
+    parse = json.loads(path.read_text())["stages"]["parse"]
+
+    assert parse["records"] == 20
+    assert parse["bytes_read"] == 200
+    assert parse["seconds"] >= 0.02
+    assert parse["records_per_second"] > 0
+    assert parse["parse_cache_hit_rate"] == 0.75
+    assert "process_max_rss_mb_so_far" in parse
+    assert "children_max_rss_mb_so_far" in parse
+    assert hit_rate(0, 0) is None
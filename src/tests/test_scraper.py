@@ -0,0 +1,80 @@
+import os
+
+from src.components.manifest import DatasetManifest
+from src.components.scraper import Scraper
+
+RDF_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:dcat="http://www.w3.org/ns/dcat#"
+         xmlns:dct="http://purl.org/dc/terms/">
+  <dcat:Dataset rdf:about="https://www.govdata.de/ckan/dataset/{name}">
+    <dct:title>{name}</dct:title>
+  </dcat:Dataset>
+</rdf:RDF>
+"""
+
+
+def test_scrape_async(ckan_server, tmp_path) -> None:
+    """async scraping downloads every dataset once and never exceeds the
+    in-flight request limit"""
+    dataset_names = [f"dataset-{idx}" for idx in range(40)]
+    ckan_server.datasets = {
+        name: {"rdf": RDF_TEMPLATE.format(name=name)} for name in dataset_names
+    }
+    ckan_server.delay = 0.01
+    scraper = Scraper(
+        current_dataset_url=f"{ckan_server.url}/api/3/action",
+        dataset_url=f"{ckan_server.url}/dataset",
+    )
+
+    scraper.scrape_async(
+        file_directory=str(tmp_path),
+        current_dataset_list=dataset_names + ["missing-dataset"],
+        max_concurrency=4,
+    )
+
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{n}.xml" for n in dataset_names)
+    with open(tmp_path / "dataset-7.xml") as fp:
+        assert fp.read() == RDF_TEMPLATE.format(name="dataset-7")
+    assert 1 < ckan_server.max_in_flight <= 4
+    assert ckan_server.request_count == len(dataset_names) + 1
+    assert scraper.bytes_downloaded == sum(
+        len(RDF_TEMPLATE.format(name=name).encode("utf-8")) for name in dataset_names
+    )
+
+
+def test_sync_incremental(ckan_server, tmp_path, monkeypatch) -> None:
+    """a second sync only downloads changed datasets and flags deleted ones"""
+    monkeypatch.chdir(tmp_path)
+    file_directory = str(tmp_path / "responses")
+    manifest = DatasetManifest(str(tmp_path / "manifest.sqlite"))
+    ckan_server.datasets = {
+        f"dataset-{idx}": {
+            "rdf": RDF_TEMPLATE.format(name=f"dataset-{idx}"),
+            "metadata_modified": f"2023-04-{10 + idx}T10:00:00.000000",
+        }
+        for idx in range(5)
+    }
+    scraper = Scraper(
+        current_dataset_url=f"{ckan_server.url}/api/3/action",
+        dataset_url=f"{ckan_server.url}/dataset",
+    )
+
+    result = scraper.sync_incremental(file_directory=file_directory, manifest=manifest)
+    assert sorted(result["downloaded"]) == sorted(ckan_server.datasets)
+    assert result["deleted"] == []
+
+    ckan_server.datasets["dataset-1"] = {
+        "rdf": "changed",
+        "metadata_modified": "2023-05-01T10:00:00.000000",
+    }
+    del ckan_server.datasets["dataset-4"]
+    result = scraper.sync_incremental(file_directory=file_directory, manifest=manifest)
+
+    assert result["downloaded"] == ["dataset-1"]
+    assert result["deleted"] == ["dataset-4"]
+    with open(os.path.join(file_directory, "dataset-1.xml")) as fp:
+        assert fp.read() == "changed"
+    assert manifest.deleted() == ["dataset-4"]
+    assert manifest.missing(["dataset-1", "dataset-5"]) == ["dataset-5"]
+    manifest.close()
@@ -0,0 +1,61 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+from src.components.bert_sim import BertSim
+from src.components.service import create_server
+
+
+@pytest.fixture
+def service(tiny_model, tiny_corpus):
+    bert_sim = BertSim(model=tiny_model, corpus=tiny_corpus)
+    server = create_server(bert_sim, port=0, max_wait_ms=50)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    server.batcher.close()
+
+
+def test_service_micro_batching(service, tiny_model, tiny_corpus) -> None:
+    """concurrent requests are answered with the predictions of BertSim and
+    predicted in fewer batches than requests"""
+    server, url = service
+    titles = [[f"Haltestellen {idx}", "Schulen"] for idx in range(16)]
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(
+            executor.map(
+                lambda el: httpx.post(f"{url}/predict", json={"titles": el}), titles
+            )
+        )
+
+    expected = BertSim(model=tiny_model, corpus=tiny_corpus)
+    for request_titles, response in zip(titles, responses):
+        assert response.status_code == 200
+        predictions = response.json()["predictions"]
+        assert [el["text"] for el in predictions] == request_titles
+        for prediction, el in zip(predictions, expected.predict(request_titles)):
+            assert prediction["prediction"] == el["prediction"]
+
+    top_k = httpx.post(
+        f"{url}/predict_top_k", json={"titles": ["Schulen"], "k": 3}
+    ).json()["predictions"]
+    assert len(top_k[0]["candidates"]) == 3
+
+    metrics = httpx.get(f"{url}/metrics").json()
+    assert metrics["requests"] == 17
+    assert metrics["batches"] < metrics["requests"]
+    assert metrics["latency_p95_ms"] is not None
+    health = httpx.get(f"{url}/health").json()
+    assert health == {
+        "status": "ok",
+        "model": tiny_model,
+        "backend": "torch",
+        "corpus_size": len(tiny_corpus),
+    }
+    assert httpx.post(f"{url}/predict", content=json.dumps({})).status_code == 400
@@ -0,0 +1,124 @@
+import hashlib
+import json
+
+import pytest
+
+from src.components import pipeline
+from src.components.parse_cache import HASH_CHUNK_SIZE
+from src.components.stages import (
+    OUTPUTS,
+    StageStore,
+    describe_outputs,
+    select_stages,
+    stage_key,
+)
+
+
+def test_describe_outputs_hashes_in_chunks(tmp_path) -> None:
+    """files larger than one chunk hash to the sha1 of their whole content"""
+    content = b"0123456789" * (HASH_CHUNK_SIZE // 4)
+    path = tmp_path / "musterdatenkatalog.parquet"
+    path.write_bytes(content)
+
+    assert describe_outputs([str(path)]) == [
+        {"path": str(path), "content_hash": hashlib.sha1(content).hexdigest()}
+    ]
+
+
+def test_select_stages() -> None:
+    assert select_stages() == ["corpus", "download", "parse", "enrich", "save"]
+    assert select_stages(from_stage="parse", until_stage="enrich") == [
+        "parse",
+        "enrich",
+    ]
+    with pytest.raises(ValueError):
+        select_stages(from_stage="save", until_stage="parse")
+    with pytest.raises(ValueError):
+        select_stages(from_stage="filter")
+
+
+def test_stage_store(tmp_path) -> None:
+    """artifacts are addressed by key and only the last run is kept"""
+    store = StageStore(str(tmp_path))
+    first, second = stage_key("a", 1), stage_key("a", 2)
+    assert first != second and first == stage_key("a", 1)
+
+    store.write("parse", first, {"records": [{"title": "Schulen", "score": 0.5}]})
+    assert store.has("parse", first)
+    assert list(store.read("parse", first)) == [{"title": "Schulen", "score": 0.5}]
+
+    store.write("parse", second, {"records": [], "queue": [{"title": "Kitas"}]})
+    assert store.latest("parse") == second
+    assert not store.has("parse", first)
+    assert list(store.read("parse", second)) == []
+    assert list(store.read("parse", second, "queue")) == [{"title": "Kitas"}]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"parse-{second}.queue.jsonl",
+        f"parse-{second}.records.jsonl",
+        "state.json",
+    ]
+
+
+def test_stage_store_outputs(tmp_path) -> None:
+    """a stage whose output files are deleted or changed has to run again"""
+    store = StageStore(str(tmp_path / "stages"))
+    output = tmp_path / "musterdatenkatalog.parquet"
+    output.write_bytes(b"catalogue")
+    key = stage_key("save")
+    store.write("save", key, {"records": [], OUTPUTS: describe_outputs([str(output)])})
+    assert store.has("save", key)
+
+    output.write_bytes(b"corrupted")
+    assert not store.has("save", key)
+    output.unlink()
+    assert not store.has("save", key)
+
+
+def test_stage_writer_interrupted(tmp_path) -> None:
+    """an interrupted stage leaves neither artifacts nor state behind"""
+    store = StageStore(str(tmp_path))
+    key = stage_key("parse")
+    with pytest.raises(RuntimeError):
+        with store.writer("parse", key) as writer:
+            writer.write([{"title": "Schulen"}])
+            raise RuntimeError("parser crashed")
+    assert store.latest("parse") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_main_resumes_stages(tmp_path, monkeypatch) -> None:
+    """stages before from_stage reuse their last run, stages after
+    until_stage are not run"""
+    monkeypatch.setattr(pipeline, "STAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(pipeline, "OUTPUT_PATH", str(tmp_path / "output"))
+    calls = []
+
+    def fake_stage(name):
+        def run(store, *keys, report):
+            calls.append((name, keys))
+            key = stage_key(name, *keys)
+            store.write(name, key, {"records": []})
+            return key
+
+        return run
+
+    for name in ["corpus", "download", "parse", "enrich", "save"]:
+        monkeypatch.setattr(pipeline, f"_stage_{name}", fake_stage(name))
+
+    keys = pipeline.main(until_stage="parse")
+    assert [name for name, _ in calls] == ["corpus", "download", "parse"]
+
+    run_report = json.loads((tmp_path / "output" / "run_report.json").read_text())
+    assert list(run_report["stages"]) == ["corpus", "download", "parse"]
+
+    calls.clear()
+    resumed = pipeline.main(from_stage="enrich")
+    assert [name for name, _ in calls] == ["enrich", "save"]
+    assert calls[0][1] == (keys["corpus"], keys["parse"])
+    assert resumed["parse"] == keys["parse"]
+
+    monkeypatch.setattr(pipeline, "STAGE_DIR", str(tmp_path / "empty"))
+    with pytest.raises(ValueError):
+        pipeline.main(from_stage="enrich")
+    history = (tmp_path / "output" / "run_reports.jsonl").read_text().splitlines()
+    assert len(history) == 3
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+from src.components.parser_lxml import LxmlParser
+from src.components.scraper import Scraper
+from src.components.storage import (
+    ResponseStore,
+    ShardedResponseStore,
+    create_store,
+    get_store,
+    migrate,
+    name_from_path,
+    read_response,
+)
+from src.settings import Settings
+from src.tests.test_parser import FILE_PATHS, _normalise
+from src.tests.test_scraper import RDF_TEMPLATE
+
+settings = Settings(_env_file="paths/.env.dev")
+
+
+def test_sharded_store(tmp_path) -> None:
+    store = create_store(str(tmp_path), layout="sharded", compression="gzip")
+
+    file_path = store.write("dataset-1", b"<rdf:RDF/>")
+
+    assert isinstance(get_store(str(tmp_path)), ShardedResponseStore)
+    assert file_path.endswith(os.path.join("dataset-1.xml.gz"))
+    assert os.path.dirname(file_path) != str(tmp_path)
+    assert store.exists("dataset-1") and not store.exists("dataset-2")
+    assert read_response(file_path) == b"<rdf:RDF/>"
+    assert list(store.paths()) == [file_path]
+
+
+def test_migrate_in_place(tmp_path) -> None:
+    """a flat folder is migrated into a sharded store and parsed the same"""
+    for file_path in FILE_PATHS:
+        shutil.copy(file_path, tmp_path)
+    flat_store = get_store(str(tmp_path))
+    assert type(flat_store) is ResponseStore
+    parser = LxmlParser(current_cities=settings.CITIES_V5, offline=True)
+    expected = {
+        name_from_path(file_path): parser.parse_file(file_path)
+        for file_path in flat_store.paths()
+    }
+
+    migrate(source=str(tmp_path), target=str(tmp_path))
+
+    store = get_store(str(tmp_path))
+    assert isinstance(store, ShardedResponseStore)
+    assert list(flat_store.paths()) == []
+    assert sorted(store.names()) == sorted(expected)
+    for file_path in store.paths():
+        record = _normalise(parser.parse_file(file_path))
+        expected_record = _normalise(expected[name_from_path(file_path)])
+        del record["file_path"], expected_record["file_path"]
+        assert record == expected_record
+
+
+def test_scrape_into_sharded_store(ckan_server, tmp_path) -> None:
+    ckan_server.datasets = {"dataset-1": {"rdf": RDF_TEMPLATE.format(name="dataset-1")}}
+    store = create_store(str(tmp_path), layout="sharded", compression="gzip")
+    scraper = Scraper(
+        current_dataset_url=f"{ckan_server.url}/api/3/action",
+        dataset_url=f"{ckan_server.url}/dataset",
+    )
+
+    scraper.scrape_async(
+        file_directory=str(tmp_path), current_dataset_list=["dataset-1"]
+    )
+
+    assert store.read("dataset-1").decode("utf-8") == RDF_TEMPLATE.format(
+        name="dataset-1"
+    )
@@ -296,3 +296,14 @@ def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i : i + n]  # noqa: E203
+
+
+def iter_chunks(iterable, n):
+    """Yield successive n-sized lists from an iterable without materializing
+    it."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, n))
+        if not chunk:
+            return
+        yield chunk